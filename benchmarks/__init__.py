@@ -0,0 +1,8 @@
+"""Offline benchmarks of the API
+
+Every blueprint is exercised through Flask's test client against an
+in-memory stand-in for MongoDB, filled with a synthetic corpus and search
+results of configurable size.  No database server is needed, so the numbers
+measure the API itself: its Python code, serialization, compression, and
+caches.  See benchmarks.run for how to run them and keep baselines.
+"""
@@ -0,0 +1,167 @@
+"""Synthetic corpora and search results to benchmark against"""
+import collections
+import random
+
+import tv5api.frequencies
+import tv5api.jobs
+import tv5api.parallels
+import tesserae.db.entities
+
+LANGUAGE = 'latin'
+FEATURES = ('form', 'lemmata')
+
+
+def search_request(source_id, target_id, max_distance=10):
+    """Build the body of a search request between two texts"""
+    return {
+        'source': {'object_id': str(source_id), 'units': 'line'},
+        'target': {'object_id': str(target_id), 'units': 'line'},
+        'method': {
+            'name': 'original',
+            'feature': 'lemmata',
+            'stopwords': ['et', 'in', 'non'],
+            'freq_basis': 'corpus',
+            'max_distance': max_distance,
+            'distance_basis': 'frequency',
+        },
+    }
+
+
+def _zipf_weights(count):
+    return [1 / rank for rank in range(1, count + 1)]
+
+
+def populate(connection, texts=20, units=50, tokens=8, vocabulary=2000,
+        matches=1000, seed=0):
+    """Fill a database with texts and the results of one search
+
+    Words are drawn from a vocabulary with Zipfian frequencies, so that
+    frequency tables and stopwords lists look like those of a real corpus.
+
+    Parameters
+    ----------
+    connection : tesserae.db.TessMongoConnection
+    texts : int
+        number of texts
+    units : int
+        number of lines per text
+    tokens : int
+        number of tokens per line
+    vocabulary : int
+        number of distinct words in the corpus
+    matches : int
+        number of parallels in the finished search
+    seed : int
+        seed of the random choices, so that runs are comparable
+
+    Returns
+    -------
+    dict
+        "text_ids" of the texts, and the "results_id" and "search" request
+        of the finished search
+    """
+    rng = random.Random(seed)
+    words = ['w{}'.format(i) for i in range(vocabulary)]
+    weights = _zipf_weights(vocabulary)
+    features = {}
+    for feature in FEATURES:
+        features[feature] = [
+            tesserae.db.entities.Feature(
+                language=LANGUAGE, feature=feature, token=word, index=i,
+                frequencies={})
+            for i, word in enumerate(words)
+        ]
+    frequencies = collections.defaultdict(collections.Counter)
+
+    text_entities = [
+        tesserae.db.entities.Text(
+            author='author {}'.format(i % max(texts // 2, 1)),
+            title='title {}'.format(i), language=LANGUAGE,
+            year=-100 + 10 * i, is_prose=bool(i % 2),
+            path='text{}.tess'.format(i))
+        for i in range(texts)
+    ]
+    connection.insert(text_entities)
+    # the words of each text, in order
+    drawn_by_text = []
+    for text in text_entities:
+        drawn = rng.choices(range(vocabulary), weights, k=units * tokens)
+        frequencies[str(text.id)].update(drawn)
+        drawn_by_text.append(drawn)
+
+    # features need their identifiers before tokens can refer to them
+    for feature in FEATURES:
+        for i, entity in enumerate(features[feature]):
+            entity.frequencies = {
+                text_id: counts[i]
+                for text_id, counts in frequencies.items() if counts[i]
+            }
+        connection.insert(features[feature])
+
+    unit_entities = []
+    for text, drawn in zip(text_entities, drawn_by_text):
+        connection.insert([
+            tesserae.db.entities.Token(
+                text=text.id, index=i, display=words[w],
+                features={f: [features[f][w].id] for f in FEATURES})
+            for i, w in enumerate(drawn)
+        ])
+        lines = [
+            tesserae.db.entities.Unit(
+                text=text.id, index=i, unit_type='line',
+                tags=[str(i // 10 + 1), str(i % 10 + 1)],
+                snippet=' '.join(
+                    words[w] for w in drawn[i * tokens:(i + 1) * tokens]))
+            for i in range(units)
+        ]
+        connection.insert(lines)
+        unit_entities.append(lines)
+        tv5api.frequencies.update_text_tables(connection, text)
+
+    search = search_request(text_entities[0].id, text_entities[-1].id)
+    results_id = _finished_search(
+        connection, search, unit_entities[0], unit_entities[-1],
+        [f.id for f in features['lemmata']], matches, rng)
+    return {
+        'text_ids': [str(text.id) for text in text_entities],
+        'results_id': results_id,
+        'search': search,
+    }
+
+
+def _finished_search(connection, search, source_units, target_units,
+        feature_ids, matches, rng):
+    """Store the results of a search as if it had just run
+
+    Returns
+    -------
+    str
+        results_id of the search
+    """
+    match_set = tesserae.db.entities.MatchSet(
+        texts=[source_units[0].text, target_units[0].text],
+        unit_types=['line', 'line'], parameters=search['method'])
+    connection.insert(match_set)
+    connection.insert([
+        tesserae.db.entities.Match(
+            match_set=match_set.id,
+            units=[rng.choice(source_units).id, rng.choice(target_units).id],
+            tokens=rng.sample(feature_ids[:100], 2),
+            score=round(rng.uniform(3, 10), 3))
+        for _ in range(matches)
+    ])
+    results_id = 'benchmark-results'
+    connection.insert(tesserae.db.entities.ResultsPair(
+        match_set_id=match_set.id, results_id=results_id,
+        parameters=search))
+    database = connection.connection
+    tv5api.jobs.record_status(database, results_id, tv5api.jobs.DONE,
+            stage='done', percent=100, match_count=matches,
+            match_set_id=match_set.id)
+    # identical searches submitted later are pointed at these results
+    search_hash = tv5api.parallels._hash_search(
+        search, tv5api.parallels._corpus_version(database))
+    tv5api.jobs.claim_flight(database, search_hash, results_id)
+    tv5api.jobs.land_flight(database, search_hash, results_id,
+            match_set_id=match_set.id, match_count=matches)
+    return results_id
@@ -0,0 +1,411 @@
+"""Load tests with simulated clients
+
+    python -m benchmarks.load --users 50 --duration 60
+    python -m benchmarks.load --mix search --users 20 --think 0.5
+    python -m benchmarks.load --url http://localhost:5000 --users 100
+
+Each simulated user runs in a thread of its own and follows a script
+mimicking one kind of client, over and over until the time is up:
+
+browser
+    lists texts, looks one up with its frequencies, and builds a stopwords
+    list from it
+submitter
+    submits a search, polls its status until it finishes, and reads the
+    first page of its parallels
+poller
+    reads pages and the status of searches already submitted
+
+A traffic mix sets what share of the users follows each script; see MIXES.
+Unless --url is given, the application is started in a process of its own,
+behind Werkzeug's threaded WSGI server, with the synthetic corpus of
+benchmarks.corpus in an in-memory database.  Its search workers never run,
+so locally only searches identical to the finished one of the corpus are
+submitted; against a real deployment, submitters search between random
+texts.  The in-memory database lives in the one server process, so sizing
+worker processes takes a real deployment and --url.
+
+Requests are reported by endpoint: throughput, latency percentiles, and the
+share of requests that failed, whether with an error status or without
+reaching the server.  Clients share the interpreter lock with each other,
+so with many users, run several load generators side by side against one
+server rather than one generator with all the users.
+"""
+import argparse
+import collections
+import json
+import logging
+import math
+import multiprocessing
+import random
+import sys
+import threading
+import time
+import urllib.error
+import urllib.request
+
+import tv5api.jobs
+
+import benchmarks.corpus
+
+# share of the users following each script, by traffic mix
+MIXES = {
+    'default': {'browser': 0.8, 'submitter': 0.1, 'poller': 0.1},
+    'browse': {'browser': 1.0},
+    'search': {'submitter': 0.5, 'poller': 0.5},
+}
+
+# search states after which there is nothing more to poll
+_FINISHED = {tv5api.jobs.DONE, tv5api.jobs.FAILED, tv5api.jobs.CANCELLED}
+
+
+class Recorder:
+    """Outcomes of requests, by endpoint"""
+
+    def __init__(self):
+        self.latencies = collections.defaultdict(list)
+        self.errors = collections.Counter()
+        self._lock = threading.Lock()
+
+    def record(self, endpoint, seconds, failed):
+        with self._lock:
+            self.latencies[endpoint].append(seconds)
+            if failed:
+                self.errors[endpoint] += 1
+
+    def report(self, duration):
+        """Summarize the requests of each endpoint
+
+        Parameters
+        ----------
+        duration : float
+            seconds the load ran for
+
+        Returns
+        -------
+        dict
+            by endpoint, the "requests", "requests_per_second",
+            "error_rate", and "p50_ms", "p90_ms", "p99_ms" and "max_ms"
+            latencies
+        """
+        with self._lock:
+            latencies = {k: sorted(v) for k, v in self.latencies.items()}
+            errors = dict(self.errors)
+        report = {}
+        for endpoint, values in sorted(latencies.items()):
+            report[endpoint] = {
+                'requests': len(values),
+                'requests_per_second': len(values) / duration,
+                'error_rate': errors.get(endpoint, 0) / len(values),
+            }
+            for percent in (50, 90, 99):
+                rank = max(math.ceil(len(values) * percent / 100), 1)
+                report[endpoint]['p{}_ms'.format(percent)] = \
+                    values[rank - 1] * 1000
+            report[endpoint]['max_ms'] = values[-1] * 1000
+        return report
+
+
+class Client:
+    """HTTP client of one simulated user
+
+    Parameters
+    ----------
+    base_url : str
+    recorder : Recorder
+    timeout : float
+        seconds to wait for each response
+    """
+
+    def __init__(self, base_url, recorder, timeout):
+        self.base_url = base_url.rstrip('/')
+        self.recorder = recorder
+        self.timeout = timeout
+
+    def request(self, endpoint, path, body=None):
+        """Send a request and record how it went
+
+        Parameters
+        ----------
+        endpoint : str
+            name under which the request is reported, such as
+            "GET /texts/<object_id>/"
+        path : str
+        body : dict, optional
+            sent as JSON with a POST if given
+
+        Returns
+        -------
+        status : int or None
+            None if no response came back
+        headers : email.message.Message or None
+        data : dict, bytes, or None
+            the body, decoded if it is JSON
+        """
+        data = None
+        headers = {}
+        if body is not None:
+            data = json.dumps(body).encode()
+            headers['Content-Type'] = 'application/json'
+        request = urllib.request.Request(
+            self.base_url + path, data=data, headers=headers)
+        started = time.perf_counter()
+        try:
+            with urllib.request.urlopen(request, timeout=self.timeout) as r:
+                status, response_headers, content = \
+                    r.status, r.headers, r.read()
+        except urllib.error.HTTPError as e:
+            status, response_headers, content = e.code, e.headers, e.read()
+        except OSError:
+            self.recorder.record(endpoint, time.perf_counter() - started,
+                    True)
+            return None, None, None
+        self.recorder.record(endpoint, time.perf_counter() - started,
+                status >= 400)
+        if response_headers.get_content_type() == 'application/json':
+            content = json.loads(content)
+        return status, response_headers, content
+
+
+class World:
+    """What the simulated users know of the application's data
+
+    Parameters
+    ----------
+    text_ids : list of str
+    search : dict, optional
+        if given, the only search submitted, instead of searches between
+        random texts
+    results_ids : list of str
+        searches whose results can be read
+    """
+
+    def __init__(self, text_ids, search=None, results_ids=()):
+        self.text_ids = list(text_ids)
+        self.search = search
+        self.results_ids = list(results_ids)
+        self._lock = threading.Lock()
+
+    def add_results(self, results_id):
+        with self._lock:
+            self.results_ids.append(results_id)
+
+    def some_results(self, rng):
+        with self._lock:
+            if not self.results_ids:
+                return None
+            return rng.choice(self.results_ids)
+
+
+def browse(client, world, rng):
+    """One visit of a user browsing the catalogue"""
+    client.request('GET /texts/', '/texts/')
+    text_id = rng.choice(world.text_ids)
+    client.request('GET /texts/<object_id>/',
+            '/texts/{}/'.format(text_id))
+    client.request('GET /texts/<object_id>/frequencies/<feature>/',
+            '/texts/{}/frequencies/lemmata/'.format(text_id))
+    client.request('GET /stopwords/', '/stopwords/?works={}'.format(text_id))
+
+
+def submit(client, world, rng, poll_interval=0.5, max_polls=20):
+    """One search by a user, from submitting it to reading its results"""
+    search = world.search
+    if search is None:
+        source, target = rng.sample(world.text_ids, 2)
+        search = benchmarks.corpus.search_request(source, target)
+    status, headers, _ = client.request(
+        'POST /parallels/', '/parallels/', body=search)
+    if status != 201:
+        return
+    location = headers['Location']
+    for _ in range(max_polls):
+        status, _, data = client.request(
+            'GET /parallels/<results_id>/status/', location + 'status/')
+        if status != 200 or data['state'] in _FINISHED:
+            break
+        time.sleep(poll_interval)
+    else:
+        return
+    if status == 200 and data['state'] == tv5api.jobs.DONE:
+        world.add_results(data['results_id'])
+        client.request('GET /parallels/<results_id>/',
+                location + '?limit=100')
+
+
+def poll(client, world, rng):
+    """One look at the results of a search already submitted"""
+    results_id = world.some_results(rng)
+    if results_id is None:
+        return
+    client.request('GET /parallels/<results_id>/status/',
+            '/parallels/{}/status/'.format(results_id))
+    client.request('GET /parallels/<results_id>/',
+            '/parallels/{}/?limit=100&offset={}'.format(
+                results_id, 100 * rng.randrange(5)))
+
+
+SCRIPTS = {
+    'browser': browse,
+    'submitter': submit,
+    'poller': poll,
+}
+
+
+def _simulate(script, client, world, seed, think, deadline):
+    rng = random.Random(seed)
+    while time.monotonic() < deadline:
+        script(client, world, rng)
+        if think:
+            # pauses vary, so that users do not fall into lockstep
+            time.sleep(rng.expovariate(1 / think))
+
+
+def _scripts_for(mix, users):
+    """Assign a script to each user according to the shares of `mix`"""
+    assigned = []
+    for name, share in MIXES[mix].items():
+        assigned.extend([name] * round(users * share))
+    # rounding may leave users out, or add too many
+    while len(assigned) < users:
+        assigned.append(max(MIXES[mix], key=MIXES[mix].get))
+    return assigned[:users]
+
+
+def run_load(base_url, world, mix='default', users=10, duration=30.0,
+        think=0.0, timeout=30.0, seed=0):
+    """Simulate users against the application at `base_url`
+
+    Returns
+    -------
+    dict
+        report by endpoint, as made by Recorder.report
+    """
+    recorder = Recorder()
+    deadline = time.monotonic() + duration
+    threads = [
+        threading.Thread(
+            target=_simulate,
+            args=(SCRIPTS[name], Client(base_url, recorder, timeout), world,
+                seed + i, think, deadline),
+            daemon=True)
+        for i, name in enumerate(_scripts_for(mix, users))
+    ]
+    started = time.monotonic()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return recorder.report(time.monotonic() - started)
+
+
+def _serve(sizes, connection_end):
+    """Serve the application from an in-memory database until terminated"""
+    import werkzeug.serving
+
+    # only the server needs the in-memory database
+    import benchmarks.memorydb
+    import benchmarks.run
+
+    connection = benchmarks.memorydb.InMemoryConnection()
+    fixture = benchmarks.corpus.populate(connection, **sizes)
+    app = benchmarks.run.create_app(connection)
+    # a line per request would drown out the report
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    server = werkzeug.serving.make_server(
+        '127.0.0.1', 0, app, threaded=True)
+    connection_end.send((server.port, fixture))
+    server.serve_forever()
+
+
+def start_local_server(sizes):
+    """Start the application in a process of its own
+
+    Returns
+    -------
+    process : multiprocessing.Process
+        to terminate once done
+    base_url : str
+    world : World
+    """
+    context = multiprocessing.get_context('spawn')
+    parent_end, child_end = context.Pipe()
+    process = context.Process(target=_serve, args=(sizes, child_end),
+            daemon=True)
+    process.start()
+    port, fixture = parent_end.recv()
+    world = World(fixture['text_ids'], search=fixture['search'],
+            results_ids=[fixture['results_id']])
+    return process, 'http://127.0.0.1:{}'.format(port), world
+
+
+def discover(base_url, timeout):
+    """Learn what texts a running application has"""
+    with urllib.request.urlopen(base_url.rstrip('/') + '/texts/',
+            timeout=timeout) as response:
+        texts = json.loads(response.read())['texts']
+    return World([text['object_id'] for text in texts])
+
+
+_HEADER = '{:<48} {:>8} {:>8} {:>7} {:>8} {:>8} {:>8} {:>8}'.format(
+    'endpoint', 'requests', 'req/s', 'errors', 'p50 ms', 'p90 ms', 'p99 ms',
+    'max ms')
+
+
+def format_report(report):
+    lines = [_HEADER]
+    for endpoint, row in report.items():
+        lines.append(
+            '{:<48} {:>8} {:>8.1f} {:>6.1f}% {:>8.1f} {:>8.1f} {:>8.1f} '
+            '{:>8.1f}'.format(
+                endpoint, row['requests'], row['requests_per_second'],
+                100 * row['error_rate'], row['p50_ms'], row['p90_ms'],
+                row['p99_ms'], row['max_ms']))
+    return '\n'.join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Load test the API with simulated users.')
+    parser.add_argument('--url',
+        help='application to load; one is started locally if not given')
+    parser.add_argument('--mix', choices=sorted(MIXES), default='default')
+    parser.add_argument('--users', type=int, default=10)
+    parser.add_argument('--duration', type=float, default=30.0,
+        help='seconds to keep up the load')
+    parser.add_argument('--think', type=float, default=0.0,
+        help='mean seconds a user pauses between visits')
+    parser.add_argument('--timeout', type=float, default=30.0,
+        help='seconds to wait for each response')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', metavar='PATH',
+        help='also write the report as JSON to PATH')
+    parser.add_argument('--texts', type=int, default=20,
+        help='texts in the local corpus')
+    parser.add_argument('--matches', type=int, default=1000,
+        help='parallels in the finished search of the local corpus')
+    args = parser.parse_args(argv)
+
+    process = None
+    if args.url is None:
+        process, base_url, world = start_local_server(
+            {'texts': args.texts, 'matches': args.matches})
+    else:
+        base_url = args.url
+        world = discover(base_url, args.timeout)
+    try:
+        report = run_load(base_url, world, mix=args.mix, users=args.users,
+                duration=args.duration, think=args.think,
+                timeout=args.timeout, seed=args.seed)
+    finally:
+        if process is not None:
+            process.terminate()
+    print(format_report(report))
+    if args.json:
+        with open(args.json, 'w') as ofh:
+            json.dump(report, ofh, indent=2, sort_keys=True)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,58 @@
+"""In-memory stand-in for tesserae.db.TessMongoConnection"""
+import copy
+import weakref
+
+import mongomock
+import mongomock.aggregate
+
+import tesserae.db
+
+_scanning_lookup = mongomock.aggregate._PIPELINE_HANDLERS['$lookup']
+
+# stores of the databases of InMemoryConnections, which alone get
+# _indexed_lookup
+_indexed_stores = weakref.WeakSet()
+
+
+def _indexed_lookup(in_collection, database, options):
+    """Join on _id through a dictionary, as MongoDB would through its index
+
+    mongomock answers $lookup by scanning the joined collection once per
+    document, which makes reading results slower by orders of magnitude
+    than anything the API does, and would leave the benchmarks timing
+    mongomock.  Databases other than those of InMemoryConnections are
+    joined as mongomock would.
+    """
+    if database._store not in _indexed_stores or \
+            options.get('foreignField') != '_id' or 'pipeline' in options:
+        return _scanning_lookup(in_collection, database, options)
+    # mongomock keeps documents by _id in the collection's store
+    store = database.get_collection(options['from'])._store
+    for doc in in_collection:
+        value = doc
+        for part in options['localField'].split('.'):
+            value = value.get(part) if isinstance(value, dict) else None
+        keys = value if isinstance(value, list) else [value]
+        doc[options['as']] = [
+            copy.deepcopy(store[key]) for key in keys if key in store]
+    return in_collection
+
+
+class InMemoryConnection(tesserae.db.TessMongoConnection):
+    """TessMongoConnection whose database lives in memory
+
+    Every method of TessMongoConnection works as usual, only against a
+    mongomock database instead of a MongoDB server.  Nothing is shared
+    between instances.
+
+    Parameters
+    ----------
+    db : str
+        name of the database
+    """
+
+    def __init__(self, db='tesserae'):
+        self.connection = mongomock.MongoClient()[db]
+        _indexed_stores.add(self.connection._store)
+        # leaves the joins of every other mongomock database as they were
+        mongomock.aggregate._PIPELINE_HANDLERS['$lookup'] = _indexed_lookup
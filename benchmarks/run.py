@@ -0,0 +1,240 @@
+"""Run the benchmarks, and save or compare against baselines
+
+    python -m benchmarks.run
+    python -m benchmarks.run --save laptop
+    python -m benchmarks.run --compare laptop --tolerance 0.2
+
+Each scenario of benchmarks.scenarios is sent a number of times after a few
+warm-up requests, and its throughput and median and 99th percentile
+latencies are reported.  The scenario is then sent again with tracemalloc
+on, for the peak memory allocated while handling its requests; this is kept
+out of the timed pass, since tracing slows everything down.
+
+Baselines are kept as JSON in benchmarks/baselines/.  Comparing against one
+exits with status 1 if any scenario is slower, by throughput or 99th
+percentile latency, or takes more memory than the baseline by more than the
+tolerance.  Baselines only compare meaningfully on the same machine and
+with the same corpus sizes.
+
+Scenarios that read whole match sets spend most of their time in mongomock's
+aggregation, which copies and sorts the matches in Python; their numbers
+track changes to the API, not what MongoDB would take.
+"""
+import argparse
+import json
+import math
+import os
+import platform
+import sys
+import time
+import tracemalloc
+
+import tv5api
+
+import benchmarks.corpus
+import benchmarks.memorydb
+import benchmarks.scenarios
+
+BASELINES_DIR = os.path.join(os.path.dirname(__file__), 'baselines')
+
+
+def create_app(connection, config=None):
+    """Create the application, served from `connection`
+
+    Searches submitted to it are queued but never run, so that submitting
+    is timed apart from matching, which is Tesserae's work, not the API's.
+    """
+    test_config = {
+        'CONNECTION_FACTORY': lambda config: connection,
+        'MONGO_HOSTNAME': None,
+        'MONGO_PORT': None,
+        'MONGO_USER': None,
+        'MONGO_PASSWORD': None,
+        'DB_NAME': 'benchmark',
+        'SEARCH_EXECUTOR': 'thread',
+        'SEARCH_WORKERS': 0,
+        'SEARCH_QUEUE_MAX_PENDING': None,
+    }
+    test_config.update(config or {})
+    return tv5api.create_app(test_config)
+
+
+def _percentile(ordered, percent):
+    """Nearest-rank percentile of sorted values"""
+    rank = max(math.ceil(len(ordered) * percent / 100), 1)
+    return ordered[rank - 1]
+
+
+def _send(client, scenario, fixture, i):
+    method, url, kwargs = scenario.build(i, fixture)
+    response = client.open(url, method=method, **kwargs)
+    # streamed bodies are only produced as they are read
+    response.get_data()
+    response.close()
+    if response.status_code != scenario.status:
+        raise RuntimeError('{}: {} {} answered {}, not {}'.format(
+            scenario.name, method, url, response.status_code,
+            scenario.status))
+
+
+def measure(client, scenario, fixture, requests, warmup, memory_requests):
+    """Time `requests` requests of a scenario
+
+    Returns
+    -------
+    dict
+        "requests_per_second", "p50_ms", "p99_ms", and "peak_memory_kib"
+    """
+    sent = 0
+    for _ in range(warmup):
+        _send(client, scenario, fixture, sent)
+        sent += 1
+    latencies = []
+    started = time.perf_counter()
+    for _ in range(requests):
+        request_started = time.perf_counter()
+        _send(client, scenario, fixture, sent)
+        latencies.append(time.perf_counter() - request_started)
+        sent += 1
+    elapsed = time.perf_counter() - started
+    latencies.sort()
+
+    tracemalloc.start()
+    try:
+        for _ in range(memory_requests):
+            _send(client, scenario, fixture, sent)
+            sent += 1
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return {
+        'requests_per_second': requests / elapsed,
+        'p50_ms': _percentile(latencies, 50) * 1000,
+        'p99_ms': _percentile(latencies, 99) * 1000,
+        'peak_memory_kib': peak / 1024,
+    }
+
+
+def run(sizes, requests, warmup, memory_requests, only=None):
+    """Run every scenario, or those of the `only` blueprints
+
+    Returns
+    -------
+    dict
+        results by scenario name, as returned by measure
+    """
+    connection = benchmarks.memorydb.InMemoryConnection()
+    fixture = benchmarks.corpus.populate(connection, **sizes)
+    app = create_app(connection)
+    client = app.test_client()
+    results = {}
+    for scenario in benchmarks.scenarios.SCENARIOS:
+        if only and scenario.blueprint not in only:
+            continue
+        results[scenario.name] = measure(
+            client, scenario, fixture, requests, warmup, memory_requests)
+        print(_format_row(scenario.name, results[scenario.name]),
+                flush=True)
+    return results
+
+
+_COLUMNS = ('requests_per_second', 'p50_ms', 'p99_ms', 'peak_memory_kib')
+_HEADER = '{:<40} {:>10} {:>10} {:>10} {:>12}'.format(
+    'scenario', 'req/s', 'p50 ms', 'p99 ms', 'peak KiB')
+
+
+def _format_row(name, result):
+    return '{:<40} {:>10.1f} {:>10.2f} {:>10.2f} {:>12.1f}'.format(
+        name, *(result[c] for c in _COLUMNS))
+
+
+def compare(results, baseline, tolerance):
+    """List the ways `results` fall behind `baseline`
+
+    Returns
+    -------
+    list of str
+        one message per regression beyond `tolerance`, a fraction
+    """
+    regressions = []
+    for name, result in results.items():
+        base = baseline.get(name)
+        if base is None:
+            continue
+        if result['requests_per_second'] < \
+                base['requests_per_second'] * (1 - tolerance):
+            regressions.append('{}: {:.1f} req/s, down from {:.1f}'.format(
+                name, result['requests_per_second'],
+                base['requests_per_second']))
+        for column in ('p99_ms', 'peak_memory_kib'):
+            if result[column] > base[column] * (1 + tolerance):
+                regressions.append('{}: {} {:.2f}, up from {:.2f}'.format(
+                    name, column, result[column], base[column]))
+    return regressions
+
+
+def _baseline_path(name):
+    return os.path.join(BASELINES_DIR, '{}.json'.format(name))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Benchmark the API against an in-memory database.')
+    parser.add_argument('--texts', type=int, default=20)
+    parser.add_argument('--units', type=int, default=50,
+        help='lines per text')
+    parser.add_argument('--tokens', type=int, default=8,
+        help='tokens per line')
+    parser.add_argument('--vocabulary', type=int, default=2000)
+    parser.add_argument('--matches', type=int, default=1000,
+        help='parallels in the search whose results are retrieved')
+    parser.add_argument('--requests', type=int, default=50,
+        help='timed requests per scenario')
+    parser.add_argument('--warmup', type=int, default=5)
+    parser.add_argument('--memory-requests', type=int, default=5,
+        help='requests per scenario sent with memory tracing on')
+    parser.add_argument('--only', action='append',
+        choices=('texts', 'stopwords', 'parallels'),
+        help='run only the scenarios of this blueprint; may be repeated')
+    parser.add_argument('--save', metavar='NAME',
+        help='save the results as baseline NAME')
+    parser.add_argument('--compare', metavar='NAME',
+        help='compare the results with baseline NAME')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+        help='fraction by which results may fall behind the baseline')
+    args = parser.parse_args(argv)
+
+    sizes = {k: getattr(args, k)
+        for k in ('texts', 'units', 'tokens', 'vocabulary', 'matches')}
+    baseline = None
+    if args.compare:
+        with open(_baseline_path(args.compare)) as ifh:
+            baseline = json.load(ifh)
+        if baseline['sizes'] != sizes:
+            print('Warning: baseline {} was run with sizes {}'.format(
+                args.compare, baseline['sizes']), file=sys.stderr)
+
+    print(_HEADER)
+    results = run(sizes, args.requests, args.warmup, args.memory_requests,
+            only=args.only)
+
+    if args.save:
+        os.makedirs(BASELINES_DIR, exist_ok=True)
+        with open(_baseline_path(args.save), 'w') as ofh:
+            json.dump({
+                'sizes': sizes,
+                'requests': args.requests,
+                'python': platform.python_version(),
+                'results': results,
+            }, ofh, indent=2, sort_keys=True)
+    if baseline is not None:
+        regressions = compare(results, baseline['results'], args.tolerance)
+        for regression in regressions:
+            print('Regression: {}'.format(regression))
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,79 @@
+"""Requests the benchmarks send, by blueprint
+
+Each scenario builds its i-th request from the fixture made by
+benchmarks.corpus.populate, so that scenarios can vary their requests, for
+instance to miss the caches on purpose.
+"""
+import collections
+
+import benchmarks.corpus
+
+Scenario = collections.namedtuple(
+    'Scenario', ('name', 'blueprint', 'build', 'status'))
+Scenario.__doc__ = """A kind of request to time
+
+Parameters
+----------
+name : str
+blueprint : str
+    name of the blueprint handling the request
+build : callable
+    given the request number and the fixture, returns the method, URL, and
+    keyword arguments for the test client
+status : int
+    status code every response must have
+"""
+
+
+def _text(i, fixture):
+    return fixture['text_ids'][i % len(fixture['text_ids'])]
+
+
+def _new_search(i, fixture):
+    # a distance no earlier request used makes this a search of its own
+    ids = fixture['text_ids']
+    return 'POST', '/parallels/', {'json': benchmarks.corpus.search_request(
+        ids[0], ids[-1], max_distance=1000 + i)}
+
+
+SCENARIOS = [
+    Scenario('texts: list', 'texts',
+        lambda i, f: ('GET', '/texts/', {}), 200),
+    Scenario('texts: page sorted by year', 'texts',
+        lambda i, f: ('GET', '/texts/?limit=5&sort=-year', {}), 200),
+    Scenario('texts: one text', 'texts',
+        lambda i, f: ('GET', '/texts/{}/'.format(_text(i, f)), {}), 200),
+    Scenario('texts: frequencies', 'texts',
+        lambda i, f: ('GET', '/texts/{}/frequencies/lemmata/'.format(
+            _text(i, f)), {}), 200),
+    Scenario('stopwords: corpus', 'stopwords',
+        lambda i, f: ('GET', '/stopwords/?language={}&list_size=10'.format(
+            benchmarks.corpus.LANGUAGE), {}), 200),
+    Scenario('stopwords: works', 'stopwords',
+        lambda i, f: ('GET', '/stopwords/?works={},{}&list_size=10'.format(
+            _text(i, f), _text(i + 1, f)), {}), 200),
+    Scenario('stopwords: lists', 'stopwords',
+        lambda i, f: ('GET', '/stopwords/lists/', {}), 200),
+    Scenario('parallels: submit new search', 'parallels', _new_search, 201),
+    Scenario('parallels: submit finished search', 'parallels',
+        lambda i, f: ('POST', '/parallels/', {'json': f['search']}), 201),
+    Scenario('parallels: status', 'parallels',
+        lambda i, f: ('GET', '/parallels/{}/status/'.format(
+            f['results_id']), {}), 200),
+    Scenario('parallels: results (cached)', 'parallels',
+        lambda i, f: ('GET', '/parallels/{}/'.format(f['results_id']), {}),
+        200),
+    Scenario('parallels: results page (uncached)', 'parallels',
+        # every minimum score is new, so every page misses the cache
+        lambda i, f: ('GET', '/parallels/{}/?limit=100&sort=-score'
+            '&min_score={}'.format(f['results_id'], i * 1e-6), {}), 200),
+    Scenario('parallels: results streamed', 'parallels',
+        lambda i, f: ('GET', '/parallels/{}/?stream=ndjson'.format(
+            f['results_id']), {}), 200),
+    Scenario('parallels: results gzipped', 'parallels',
+        lambda i, f: ('GET', '/parallels/{}/'.format(f['results_id']),
+            {'headers': {'Accept-Encoding': 'gzip'}}), 200),
+    Scenario('parallels: export', 'parallels',
+        lambda i, f: ('GET', '/parallels/{}/export.csv'.format(
+            f['results_id']), {}), 200),
+]
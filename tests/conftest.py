@@ -14,6 +14,9 @@ def app():
         'MONGO_USER': None,
         'MONGO_PASSWORD': None,
         'DB_NAME': 'test_tv5api',
+        'SEARCH_QUEUE_BACKEND': 'local_broker',
+        # searches are run where tests can stand in for the matcher
+        'SEARCH_EXECUTOR': 'thread',
     })
 
     with cur_app.test_request_context():
@@ -0,0 +1,71 @@
+import pytest
+
+import tv5api
+
+pytest.importorskip('mongomock')
+
+import benchmarks.corpus
+import benchmarks.load
+import benchmarks.memorydb
+import benchmarks.run
+import benchmarks.scenarios
+
+
+def test_scenarios_run():
+    connection = benchmarks.memorydb.InMemoryConnection()
+    fixture = benchmarks.corpus.populate(connection, texts=3, units=5,
+            tokens=4, vocabulary=30, matches=20)
+    client = benchmarks.run.create_app(connection).test_client()
+    for scenario in benchmarks.scenarios.SCENARIOS:
+        result = benchmarks.run.measure(client, scenario, fixture,
+                requests=2, warmup=1, memory_requests=1)
+        assert result['requests_per_second'] > 0
+        assert result['p50_ms'] <= result['p99_ms']
+
+
+def test_benchmark_app_connects_through_its_config():
+    create_connection = tv5api.create_connection
+    connection = benchmarks.memorydb.InMemoryConnection()
+    app = benchmarks.run.create_app(connection)
+    assert tv5api.create_connection is create_connection
+    assert tv5api.create_connection(app.config) is connection
+
+
+def test_compare():
+    baseline = {'a': {'requests_per_second': 100, 'p99_ms': 10,
+        'peak_memory_kib': 50}}
+    same = {'a': dict(baseline['a'], requests_per_second=90)}
+    assert benchmarks.run.compare(same, baseline, 0.2) == []
+    slower = {'a': dict(baseline['a'], p99_ms=13)}
+    assert len(benchmarks.run.compare(slower, baseline, 0.2)) == 1
+
+
+def test_load_report():
+    recorder = benchmarks.load.Recorder()
+    for i in range(1, 101):
+        recorder.record('GET /texts/', i / 1000, failed=i > 95)
+    report = recorder.report(duration=10)['GET /texts/']
+    assert report['requests'] == 100
+    assert report['requests_per_second'] == 10
+    assert report['error_rate'] == 0.05
+    assert report['p50_ms'] == pytest.approx(50)
+    assert report['p99_ms'] == pytest.approx(99)
+
+
+def test_load_mix():
+    scripts = benchmarks.load._scripts_for('default', 10)
+    assert scripts.count('browser') == 8
+    assert len(benchmarks.load._scripts_for('default', 3)) == 3
+
+
+def test_load_local_server():
+    process, base_url, world = benchmarks.load.start_local_server({
+        'texts': 3, 'units': 5, 'tokens': 4, 'vocabulary': 30,
+        'matches': 20})
+    try:
+        report = benchmarks.load.run_load(base_url, world, mix='default',
+                users=4, duration=1)
+    finally:
+        process.terminate()
+    assert report['GET /texts/']['requests'] > 0
+    assert all(row['error_rate'] == 0 for row in report.values())
@@ -0,0 +1,89 @@
+import os
+
+import flask
+
+import tv5api.cache
+
+
+def test_results_cache_evicts_least_recently_used():
+    cache = tv5api.cache.ResultsCache(10)
+    cache.put('a', b'12345')
+    cache.put('b', b'12345')
+    assert cache.get('a') == b'12345'
+    cache.put('c', b'12345')
+    assert cache.get('b') is None
+    assert cache.get('a') == b'12345'
+    assert cache.get('c') == b'12345'
+
+
+def test_results_cache_skips_oversized_bodies():
+    cache = tv5api.cache.ResultsCache(4)
+    cache.put('a', b'12345')
+    assert cache.get('a') is None
+
+
+def test_results_cache_on_disk(tmp_path):
+    cache = tv5api.cache.ResultsCache(10, directory=str(tmp_path))
+    cache.put('a-1', b'12345')
+    cache.put('a-2', b'12345')
+    cache.put('b-1', b'12345')
+    # a fresh cache on the same directory finds what the first one stored
+    other = tv5api.cache.ResultsCache(10, directory=str(tmp_path))
+    assert other.get('a-1') == b'12345'
+
+    other.discard_prefix('a-')
+    assert other.get('a-1') is None
+    assert other.get('a-2') is None
+    assert other.get('b-1') == b'12345'
+
+
+def test_results_cache_trims_disk(tmp_path):
+    cache = tv5api.cache.ResultsCache(
+        100, directory=str(tmp_path), max_disk_bytes=10)
+    for key in ('a', 'b', 'c'):
+        cache.put(key, b'12345')
+    assert sum(p.stat().st_size for p in tmp_path.iterdir()) <= 10
+
+
+def test_results_cache_trims_least_recently_used(tmp_path):
+    cache = tv5api.cache.ResultsCache(
+        100, directory=str(tmp_path), max_disk_bytes=12)
+    cache.put('a', b'12345')
+    cache.put('b', b'12345')
+    # as if written long ago, "a" before "b"
+    os.utime(tmp_path / 'a', (1, 1))
+    os.utime(tmp_path / 'b', (2, 2))
+    assert cache.get('a') == b'12345'
+    cache.put('c', b'12345')
+    assert sorted(p.name for p in tmp_path.iterdir()) == ['a', 'c']
+
+
+def test_versioned_cache_invalidated_across_caches(app):
+    with app.test_request_context():
+        app.preprocess_request()
+        connection = flask.g.db
+    # stand-ins for the caches of two worker processes
+    first = tv5api.cache.VersionedCache(
+        connection, 'test', 10, check_interval=0)
+    second = tv5api.cache.VersionedCache(
+        connection, 'test', 10, check_interval=0)
+    assert first.lookup('a', lambda: 1) == 1
+    assert second.lookup('a', lambda: 2) == 2
+    assert first.lookup('a', lambda: 3) == 1
+
+    second.invalidate()
+    assert first.lookup('a', lambda: 3) == 3
+    assert second.lookup('a', lambda: 4) == 4
+
+
+def test_versioned_cache_evicts_least_recently_used(app):
+    with app.test_request_context():
+        app.preprocess_request()
+        connection = flask.g.db
+    cache = tv5api.cache.VersionedCache(connection, 'test-evict', 2)
+    cache.lookup('a', lambda: 1)
+    cache.lookup('b', lambda: 2)
+    cache.lookup('a', lambda: None)
+    cache.lookup('c', lambda: 3)
+    assert cache.lookup('a', lambda: None) == 1
+    assert cache.lookup('b', lambda: None) is None
@@ -0,0 +1,82 @@
+import os
+
+import flask
+import pymongo.read_preferences
+
+import tv5api
+import tv5api.connections
+
+
+class _Database:
+    def __init__(self, read_preference=None):
+        self.read_preference = read_preference
+
+    def with_options(self, read_preference=None):
+        return _Database(read_preference)
+
+
+class _Connection:
+    def __init__(self):
+        self.connection = _Database()
+
+    def find(self, collection):
+        return [collection]
+
+
+def test_client_options():
+    options = tv5api.connections.client_options({
+        'MONGO_MAX_POOL_SIZE': 10,
+        'MONGO_SOCKET_TIMEOUT_MS': None,
+        'MONGO_SERVER_SELECTION_TIMEOUT_MS': 5000,
+    })
+    assert options == {'maxPoolSize': 10, 'serverSelectionTimeoutMS': 5000}
+
+
+def test_connection_created_once_per_process(monkeypatch):
+    created = []
+
+    def create():
+        created.append(_Connection())
+        return created[-1]
+
+    db = tv5api.connections.ProcessConnection(create)
+    assert not created
+    assert db.find('texts') == ['texts']
+    assert db.current() is db.current(reading=True) is created[0]
+    assert len(created) == 1
+
+    # as in a worker forked after the connection was first used
+    pid = os.getpid()
+    monkeypatch.setattr(os, 'getpid', lambda: pid + 1)
+    assert db.current() is created[1]
+    assert len(created) == 2
+
+
+def test_reading_connection_shares_client():
+    preference = tv5api.connections.read_preference('secondaryPreferred')
+    assert preference.mode == \
+        pymongo.read_preferences.SecondaryPreferred().mode
+    db = tv5api.connections.ProcessConnection(_Connection, preference)
+    reader = db.current(reading=True)
+    assert reader is not db.current()
+    assert reader.connection.read_preference is preference
+    assert db.current().connection.read_preference is None
+
+
+def test_metadata_views_are_read_only(app):
+    for endpoint in ('texts.query_texts', 'texts.get_text',
+            'stopwords.query_stopwords'):
+        assert app.view_functions[endpoint].read_only
+    assert not getattr(
+        app.view_functions['parallels.submit_search'], 'read_only', False)
+
+
+def test_caches_filled_from_primary(app):
+    secondary = tv5api.create_app(dict(app.config,
+        MONGO_READ_ONLY_PREFERENCE='secondaryPreferred'))
+    with secondary.test_request_context('/texts/'):
+        secondary.preprocess_request()
+        assert flask.g.db.connection.read_preference.mode == \
+            pymongo.read_preferences.SecondaryPreferred().mode
+        assert flask.g.primary_db.connection.read_preference.mode == \
+            pymongo.read_preferences.Primary().mode
@@ -0,0 +1,39 @@
+import gzip
+
+import werkzeug.datastructures
+
+import tv5api.encoding
+
+
+def test_negotiate():
+    Accept = werkzeug.datastructures.Accept
+    assert tv5api.encoding.negotiate(Accept()) == tv5api.encoding.IDENTITY
+    assert tv5api.encoding.negotiate(Accept([('gzip', 1)])) == 'gzip'
+    assert tv5api.encoding.negotiate(
+        Accept([('gzip', 1), ('deflate', 1)])) == 'gzip'
+    assert tv5api.encoding.negotiate(
+        Accept([('gzip', 0)])) == tv5api.encoding.IDENTITY
+    best = tv5api.encoding.negotiate(Accept([('*', 1)]))
+    assert best == tv5api.encoding.PREFERENCE[0]
+
+
+def test_gzip_round_trip():
+    data = b'arma virumque cano ' * 100
+    compressed = tv5api.encoding.compress(data, 'gzip', 6)
+    assert gzip.decompress(compressed) == data
+    # equal inputs give equal outputs, which keeps entity tags stable
+    assert tv5api.encoding.compress(data, 'gzip', 6) == compressed
+
+
+def test_identity():
+    data = b'arma virumque cano'
+    assert tv5api.encoding.compress(
+        data, tv5api.encoding.IDENTITY, None) == data
+
+
+def test_small_responses_are_not_compressed(client):
+    response = client.get(
+        '/stopwords/', headers={'Accept-Encoding': 'gzip'})
+    assert response.status_code == 200
+    assert 'Content-Encoding' not in response.headers
+    assert 'Accept-Encoding' in response.headers['Vary']
@@ -0,0 +1,113 @@
+import flask
+
+import tesserae.db.entities
+import tv5api.cache
+import tv5api.frequencies
+
+
+def _add_text(connection, title, forms):
+    """Insert a text whose tokens bear the given form features"""
+    text = tesserae.db.entities.Text(
+        author='frequencies', title=title, language='freq_language',
+        year=1, is_prose=True, path='test.tess')
+    connection.insert(text)
+    _set_tokens(connection, text, forms)
+    return text
+
+
+def _set_tokens(connection, text, forms):
+    connection.connection[tesserae.db.entities.Token.collection].delete_many(
+        {'text': text.id})
+    connection.insert([
+        tesserae.db.entities.Token(
+            text=text.id, index=i, display=form.token,
+            features={'form': [form.id]})
+        for i, form in enumerate(forms)
+    ])
+
+
+def _corpus(connection, features):
+    table = tv5api.frequencies.get_table(
+        connection, 'form', language='freq_language')
+    if table is None:
+        return None
+    tokens = {str(f.id): f.token for f in features}
+    return {tokens[k]: v for k, v in table['counts'].items()}
+
+
+def _every_language(connection, count):
+    """Rank the features of every language by reading them all"""
+    table = tv5api.frequencies.get_table(connection, 'form')
+    by_token = {}
+    for feature in connection.connection[
+            tesserae.db.entities.Feature.collection].find(
+                {'feature': 'form'}):
+        n = table['counts'].get(str(feature['_id']))
+        if n:
+            by_token[feature['token']] = by_token.get(feature['token'], 0) + n
+    return sorted(by_token.items(), key=lambda t: (-t[1], t[0]))[:count]
+
+
+def test_corpus_tables_follow_texts(app):
+    with app.test_request_context():
+        app.preprocess_request()
+        connection = flask.g.db
+        features = [
+            tesserae.db.entities.Feature(
+                language='freq_language', feature='form', token=token,
+                index=i)
+            for i, token in enumerate(['a', 'b', 'c'])
+        ]
+        connection.insert(features)
+        a, b, c = features
+        first = _add_text(connection, 'first', [a, b, a])
+        second = _add_text(connection, 'second', [a, c])
+        for text in (first, second):
+            tv5api.frequencies.update_text_tables(connection, text)
+        assert _corpus(connection, features) == {'a': 3, 'b': 1, 'c': 1}
+        assert tv5api.frequencies.most_frequent(
+            connection, 'form', 1, language='freq_language') == [('a', 3)]
+        # ties with the last of the most frequent are broken by token
+        assert tv5api.frequencies.most_frequent(
+            connection, 'form', 2, text_ids=[first.id, second.id]) == \
+            [('a', 3), ('b', 1)]
+        assert tv5api.frequencies.most_frequent(
+            connection, 'form', 2, text_ids=[second.id]) == \
+            [('a', 1), ('c', 1)]
+        assert tv5api.frequencies.most_frequent(connection, 'form', 3) == \
+            _every_language(connection, 3)
+
+        # ingesting a text again replaces its counts
+        _set_tokens(connection, first, [b, b])
+        tv5api.frequencies.update_text_tables(connection, first)
+        assert _corpus(connection, features) == {'a': 1, 'b': 2, 'c': 1}
+
+        tv5api.frequencies.remove_text_tables(connection, second.id)
+        assert _corpus(connection, features) == {'b': 2}
+        tv5api.frequencies.remove_text_tables(connection, first.id)
+        assert _corpus(connection, features) is None
+
+        # the corpus tables can be rebuilt from the text tables
+        tv5api.frequencies.update_text_tables(connection, second)
+        database = connection.connection
+        database[tv5api.frequencies.CORPUS_FREQUENCIES_COLLECTION].update_many(
+            {'language': 'freq_language'}, {'$inc': {'count': 5}})
+        tv5api.frequencies.rebuild_corpus_tables(connection, 'freq_language')
+        assert _corpus(connection, features) == {'a': 1, 'c': 1}
+        tv5api.frequencies.remove_text_tables(connection, second.id)
+
+        connection.delete([first, second])
+        connection.delete(features)
+        database[tesserae.db.entities.Token.collection].delete_many(
+            {'text': {'$in': [first.id, second.id]}})
+
+
+def test_backfill_invalidates_cached_stopwords(app):
+    with app.test_request_context():
+        app.preprocess_request()
+        connection = flask.g.db.connection
+    versions = connection[tv5api.cache.VERSIONS_COLLECTION]
+    before = versions.find_one({'_id': 'texts'})
+    result = app.test_cli_runner().invoke(args=['build-frequencies'])
+    assert result.exit_code == 0, result.output
+    assert versions.find_one({'_id': 'texts'}) != before
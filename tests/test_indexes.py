@@ -0,0 +1,63 @@
+import flask
+import pymongo.errors
+import pytest
+
+import tesserae.db.entities
+import tv5api.indexes
+import tv5api.results
+
+
+def test_ensure_indexes_creates_only_missing(app):
+    with app.test_request_context():
+        app.preprocess_request()
+        database = flask.g.db.connection
+    tv5api.indexes.ensure_indexes(database)
+    created, conflicts = tv5api.indexes.ensure_indexes(database)
+    assert created == [] and conflicts == []
+
+    declared = [('test_indexes', [('a', 1), ('b', -1)], {})]
+    created, _ = tv5api.indexes.ensure_indexes(database, declared)
+    assert created == declared
+    created, _ = tv5api.indexes.ensure_indexes(database, declared)
+    assert created == []
+
+
+def test_startup_leaves_large_collections_alone():
+    collections = {index[0] for index in tv5api.indexes.STARTUP_INDEXES}
+    assert not collections & tv5api.indexes.LARGE_COLLECTIONS
+    assert len(tv5api.indexes.STARTUP_INDEXES) < len(tv5api.indexes.INDEXES)
+
+
+class _FailingCollection:
+    def __init__(self, code):
+        self.code = code
+
+    def index_information(self):
+        return {}
+
+    def create_index(self, keys, **options):
+        raise pymongo.errors.OperationFailure('failed', code=self.code)
+
+
+def test_only_conflicts_are_reported_as_conflicts():
+    declared = [('test_indexes', [('a', 1)], {'unique': True})]
+    conflicting = {'test_indexes': _FailingCollection(85)}
+    created, conflicts = tv5api.indexes.ensure_indexes(conflicting, declared)
+    assert created == [] and conflicts == declared
+
+    unauthorized = {'test_indexes': _FailingCollection(13)}
+    with pytest.raises(pymongo.errors.OperationFailure):
+        tv5api.indexes.ensure_indexes(unauthorized, declared)
+
+
+def test_match_orders_are_indexed():
+    declared = [
+        keys[1:] for collection, keys, _ in tv5api.indexes.INDEXES
+        if collection == tesserae.db.entities.Match.collection
+        and keys[0] == ('match_set', 1)
+    ]
+    for order in list(tv5api.results.SORTS.values()) + \
+            [tv5api.results.PAGE_ORDER]:
+        # an index serves its order and the reverse of it
+        reverse = [(field, -direction) for field, direction in order]
+        assert order in declared or reverse in declared
@@ -0,0 +1,42 @@
+import os
+
+import flask
+from bson.objectid import ObjectId
+
+import tesserae.db.entities
+import tv5api.deletion
+import tv5api.frequencies
+import tv5api.ingestion
+import tv5api.jobs
+
+
+def test_failure_after_insertion_is_recorded(app, monkeypatch):
+    def fail(connection, text):
+        raise RuntimeError('no tables')
+
+    monkeypatch.setattr(tv5api.frequencies, 'update_text_tables', fail)
+    with app.test_request_context():
+        app.preprocess_request()
+        connection = flask.g.db
+    record = {
+        'author': 'Bob', 'title': 'Unfinished', 'language': 'latin',
+        'year': 2018, 'is_prose': False,
+        'path': os.path.join(os.path.dirname(__file__), 'bob.txt'),
+    }
+    batch_id, jobs = tv5api.ingestion.create_batch(
+        connection.connection, [record])
+    tv5api.ingestion.run_ingest(connection, jobs[0])
+
+    batch = connection.connection[tv5api.ingestion.INGESTS_COLLECTION].find_one(
+        {'batch_id': batch_id})
+    entry = tv5api.ingestion.describe_batch(batch)['texts'][0]
+    assert entry['state'] == tv5api.jobs.FAILED
+    assert 'no tables' in entry['message']
+
+    # the text made it in, and is removed as any other
+    text = connection.find(
+        tesserae.db.entities.Text.collection,
+        _id=ObjectId(entry['object_id']))[0]
+    connection.delete(text)
+    _, job = tv5api.deletion.create_deletion(connection.connection, text)
+    tv5api.deletion.run_deletion(connection, None, job)
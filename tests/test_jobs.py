@@ -0,0 +1,211 @@
+import datetime
+import os
+import sys
+import threading
+import time
+
+import flask
+import pytest
+
+import tv5api.jobs
+
+
+@pytest.mark.parametrize('backend_name', ['inprocess', 'local_broker'])
+def test_job_queue_runs_jobs(backend_name):
+    seen = []
+    all_done = threading.Event()
+
+    def run_job(job):
+        seen.append(job['n'])
+        if len(seen) == 5:
+            all_done.set()
+
+    job_queue = tv5api.jobs.JobQueue(
+        tv5api.jobs.make_backend(backend_name, 'test'), run_job, workers=2)
+    job_queue.start()
+    for i in range(5):
+        job_queue.submit({'n': i})
+    assert all_done.wait(timeout=5)
+    job_queue.shutdown()
+    assert sorted(seen) == list(range(5))
+    assert job_queue.pending() == 0
+
+
+def test_job_queue_survives_failing_job():
+    done = threading.Event()
+
+    def run_job(job):
+        if job['fail']:
+            raise RuntimeError('boom')
+        done.set()
+
+    job_queue = tv5api.jobs.JobQueue(
+        tv5api.jobs.InProcessBackend(), run_job, workers=1)
+    job_queue.start()
+    job_queue.submit({'fail': True})
+    job_queue.submit({'fail': False})
+    assert done.wait(timeout=5)
+    job_queue.shutdown()
+
+
+@pytest.mark.skipif(not hasattr(os, 'fork'), reason='needs os.fork')
+def test_job_queue_restarts_workers_after_fork():
+    job_queue = tv5api.jobs.JobQueue(
+        tv5api.jobs.InProcessBackend(), lambda job: os.write(job['fd'], b'x'),
+        workers=1)
+    job_queue.start()
+    read_end, write_end = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        # the child has none of the parent's threads
+        try:
+            job_queue.submit({'fd': write_end})
+            time.sleep(5)
+        finally:
+            os._exit(0)
+    os.close(write_end)
+    try:
+        assert os.read(read_end, 1) == b'x'
+    finally:
+        os.close(read_end)
+        os.kill(pid, 9)
+        os.waitpid(pid, 0)
+        job_queue.shutdown()
+
+
+def test_local_broker_serializes_messages():
+    broker = tv5api.jobs.LocalBroker()
+    message = {'a': [1, 2]}
+    broker.publish('q', message)
+    message['a'].append(3)
+    assert broker.size('q') == 1
+    assert broker.consume('q', timeout=0) == {'a': [1, 2]}
+    assert broker.consume('q', timeout=0) is None
+
+
+def test_unknown_backend():
+    with pytest.raises(ValueError):
+        tv5api.jobs.make_backend('nonexistent', 'test')
+
+
+def test_describe_status():
+    started = datetime.datetime(2019, 1, 1, 0, 0, 0)
+    record = {
+        'results_id': 'abc',
+        'state': tv5api.jobs.DONE,
+        'stage': 'done',
+        'percent': 100,
+        'started': started,
+        'finished': started + datetime.timedelta(seconds=90),
+        'match_count': 12,
+    }
+    described = tv5api.jobs.describe_status(record)
+    assert described['elapsed'] == 90.0
+    assert described['match_count'] == 12
+    assert described['percent'] == 100
+
+    described = tv5api.jobs.describe_status(
+        {'results_id': 'abc', 'state': tv5api.jobs.QUEUED})
+    assert described['elapsed'] == 0.0
+    assert described['stage'] == tv5api.jobs.QUEUED
+
+
+def test_job_queue_refuses_jobs_when_full():
+    # no workers are started, so submitted jobs just wait
+    job_queue = tv5api.jobs.JobQueue(
+        tv5api.jobs.InProcessBackend(), lambda job: None, max_pending=2)
+    job_queue.submit({})
+    job_queue.submit({})
+    assert job_queue.full()
+    with pytest.raises(tv5api.jobs.QueueFull):
+        job_queue.submit({})
+
+
+def test_process_runner():
+    # sys.exit is picklable and turns the job into the exit code
+    runner = tv5api.jobs.ProcessRunner(sys.exit)
+    runner(0)
+    with pytest.raises(ChildProcessError):
+        runner(3)
+
+
+def test_process_runner_time_limit():
+    runner = tv5api.jobs.ProcessRunner(
+        time.sleep, time_limit=0.5, poll_interval=0.05)
+    with pytest.raises(tv5api.jobs.JobTimeout):
+        runner(30)
+
+
+def test_process_runner_cancellation():
+    runner = tv5api.jobs.ProcessRunner(time.sleep, poll_interval=0.05)
+    with pytest.raises(tv5api.jobs.JobCancelled):
+        runner(30, should_stop=lambda: True)
+
+
+def test_job_queue_heartbeat_sees_unfinished_jobs():
+    beats = []
+    release = threading.Event()
+    job_queue = tv5api.jobs.JobQueue(
+        tv5api.jobs.make_backend('local_broker', 'test-heartbeat'),
+        lambda job: release.wait(5), workers=1,
+        heartbeat=beats.append, heartbeat_interval=0.05)
+    job_queue.start()
+    job_queue.submit({'n': 1})
+    job_queue.submit({'n': 2})
+    time.sleep(0.2)
+    assert sorted(job['n'] for job in beats[-1]) == [1, 2]
+    release.set()
+    time.sleep(0.2)
+    job_queue.shutdown()
+    assert job_queue.held() == []
+
+
+def test_abandoned_flight_is_taken_over(app):
+    with app.test_request_context():
+        app.preprocess_request()
+        database = flask.g.db.connection
+    for results_id in ('lost', 'follower', 'second', 'third'):
+        tv5api.jobs.record_status(database, results_id, tv5api.jobs.QUEUED)
+    assert tv5api.jobs.claim_flight(database, 'flight', 'lost') is None
+    tv5api.jobs.record_status(database, 'follower', tv5api.jobs.QUEUED,
+            leader='lost')
+
+    # the leader's lease still holds
+    flight = tv5api.jobs.claim_flight(database, 'flight', 'second')
+    assert flight['results_id'] == 'lost'
+
+    database[tv5api.jobs.FLIGHTS_COLLECTION].update_one(
+        {'_id': 'flight'}, {'$set': {'lease': datetime.datetime(2000, 1, 1)}})
+    assert tv5api.jobs.claim_flight(database, 'flight', 'third') is None
+    lost = tv5api.jobs.get_status(database, 'lost')
+    assert lost['state'] == tv5api.jobs.FAILED
+    follower = tv5api.jobs.get_status(database, 'follower', follow=False)
+    assert follower['leader'] == 'third'
+
+    # a leader that finished without landing its flight abandoned it too
+    tv5api.jobs.record_status(database, 'third', tv5api.jobs.CANCELLED)
+    tv5api.jobs.record_status(database, 'fourth', tv5api.jobs.QUEUED)
+    assert tv5api.jobs.claim_flight(database, 'flight', 'fourth') is None
+    assert not tv5api.jobs.land_flight(database, 'flight', 'third')
+    assert tv5api.jobs.land_flight(database, 'flight', 'fourth')
+
+
+def test_lapsed_flights_are_swept(app):
+    with app.test_request_context():
+        app.preprocess_request()
+        database = flask.g.db.connection
+    tv5api.jobs.record_status(database, 'swept', tv5api.jobs.RUNNING)
+    tv5api.jobs.record_status(database, 'kept', tv5api.jobs.RUNNING)
+    tv5api.jobs.record_status(database, 'waiting', tv5api.jobs.QUEUED,
+            leader='swept')
+    tv5api.jobs.claim_flight(database, 'swept-flight', 'swept', lease=0)
+    tv5api.jobs.claim_flight(database, 'kept-flight', 'kept', lease=0)
+    tv5api.jobs.renew_flights(database, ['kept'], lease=60)
+    time.sleep(0.01)
+
+    assert tv5api.jobs.sweep_flights(database) == ['swept']
+    assert tv5api.jobs.get_flight(database, 'swept-flight') is None
+    assert tv5api.jobs.get_flight(database, 'kept-flight') is not None
+    for results_id in ('swept', 'waiting'):
+        status = tv5api.jobs.get_status(database, results_id, follow=False)
+        assert status['state'] == tv5api.jobs.FAILED
@@ -0,0 +1,29 @@
+import tv5api.metrics
+
+
+def test_histogram_exposition():
+    registry = tv5api.metrics.Registry()
+    histogram = registry.register(tv5api.metrics.Histogram(
+        'test_seconds', 'Test durations', ('stage',), buckets=(0.1, 1.0)))
+    histogram.observe(0.05, 'a')
+    histogram.observe(0.1, 'a')
+    histogram.observe(5, 'a')
+    lines = registry.exposition().splitlines()
+    assert '# TYPE test_seconds histogram' in lines
+    assert 'test_seconds_bucket{stage="a",le="0.1"} 2' in lines
+    assert 'test_seconds_bucket{stage="a",le="1.0"} 2' in lines
+    assert 'test_seconds_bucket{stage="a",le="+Inf"} 3' in lines
+    assert 'test_seconds_count{stage="a"} 3' in lines
+
+
+def test_requests_are_timed(client):
+    response = client.get('/texts/')
+    assert response.status_code == 200
+    assert 'total;dur=' in response.headers['Server-Timing']
+
+    response = client.get('/metrics')
+    assert response.status_code == 200
+    assert response.mimetype == 'text/plain'
+    body = response.get_data(as_text=True)
+    assert 'tv5api_requests_total{endpoint="texts.query_texts",method="GET",status="200"}' in body
+    assert 'tv5api_queue_pending_jobs{queue="searches"}' in body
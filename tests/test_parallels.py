@@ -1,11 +1,486 @@
+import datetime
 import gzip
 import json
+import os
+import threading
+import time
 
+from bson.objectid import ObjectId
 import flask
 import pytest
 import werkzeug.datastructures
 
+import tesserae.db.entities
+import tesserae.utils
+import tv5api
+import tv5api.deletion
+import tv5api.jobs
+import tv5api.parallels
 
-def test_search(client):
-    # TODO fill this in
-    assert False
+
+@pytest.fixture(scope='module')
+def text_ids(app):
+    """Ingest two copies of the test text to search between"""
+    ids = []
+    with app.test_request_context():
+        app.preprocess_request()
+        for title in ('Bob Bob', 'Bob Bob Again'):
+            text = tesserae.db.entities.Text(
+                author='Bob', title=title, language='latin', year=2018,
+                is_prose=False,
+                path=os.path.join(os.path.dirname(__file__), 'bob.txt'))
+            ids.append(str(tesserae.utils.ingest_text(flask.g.db, text)))
+        flask.g.text_cache.invalidate()
+    yield ids
+    with app.test_request_context():
+        app.preprocess_request()
+        for coll_name in flask.g.db.connection.list_collection_names():
+            flask.g.db.connection.drop_collection(coll_name)
+        flask.g.text_cache.invalidate()
+
+
+def _search(source_id, target_id, max_distance=10):
+    return {
+        'source': {'object_id': source_id, 'units': 'line'},
+        'target': {'object_id': target_id, 'units': 'line'},
+        'method': {
+            'name': 'original',
+            'feature': 'lemmata',
+            'stopwords': [],
+            'freq_basis': 'corpus',
+            'max_distance': max_distance,
+            'distance_basis': 'frequency',
+        },
+    }
+
+
+def _submit(client, for_post):
+    response = client.post('/parallels/', json=for_post)
+    assert response.status_code == 201
+    location = response.headers['Location']
+    return location.rstrip('/').rsplit('/', 1)[-1], location
+
+
+def _wait(client, results_id, states=('done', 'failed', 'cancelled')):
+    deadline = time.monotonic() + 60
+    while True:
+        response = client.get('/parallels/{}/status/'.format(results_id))
+        assert response.status_code == 200
+        data = response.get_json()
+        if data['state'] in states or time.monotonic() > deadline:
+            return data
+        time.sleep(0.1)
+
+
+def _match_set_id(app, results_id):
+    with app.test_request_context():
+        app.preprocess_request()
+        found = flask.g.db.find(
+            tesserae.db.entities.ResultsPair.collection,
+            results_id=results_id)
+        return found[0].match_set_id if found else None
+
+
+def test_search(app, client, text_ids):
+    results_id, location = _submit(client, _search(*text_ids))
+    status = _wait(client, results_id)
+    assert status['state'] == 'done' and status['percent'] == 100
+
+    response = client.get(location)
+    assert response.status_code == 200
+    data = response.get_json()
+    assert 'data' in data
+    everything = data['parallels']
+    assert everything
+    etag, _ = response.get_etag()
+    response = client.get(location, headers={'If-None-Match': '"' + etag + '"'})
+    assert response.status_code == 304
+
+    # the same parallels, a page at a time
+    paged = []
+    endpoint = location + '?limit=2'
+    while endpoint is not None:
+        response = client.get(endpoint)
+        assert response.status_code == 200
+        data = response.get_json()
+        assert len(data['parallels']) <= 2
+        paged.extend(data['parallels'])
+        endpoint = data.get('next', None)
+    assert sorted(json.dumps(p, sort_keys=True) for p in paged) == \
+        sorted(json.dumps(p, sort_keys=True) for p in everything)
+
+    response = client.get(location, headers={'Accept-Encoding': 'gzip'})
+    assert response.status_code == 200
+    assert response.headers['Content-Encoding'] == 'gzip'
+    assert json.loads(gzip.decompress(response.get_data())) == \
+        client.get(location).get_json()
+
+    response = client.get(location + '?stream=ndjson')
+    assert response.status_code == 200
+    lines = response.get_data(as_text=True).splitlines()
+    assert len(lines) == len(everything)
+
+
+def test_identical_searches_share_results(app, client, text_ids):
+    for_post = _search(*text_ids, max_distance=9)
+    leader, _ = _submit(client, for_post)
+    follower, follower_location = _submit(client, for_post)
+    assert _wait(client, leader)['state'] == 'done'
+    assert _wait(client, follower)['state'] == 'done'
+    assert _match_set_id(app, leader) == _match_set_id(app, follower)
+    response = client.get(follower_location)
+    assert response.status_code == 200
+    assert response.get_json()['parallels']
+
+    # pages of each search link to that search only
+    response = client.get('/parallels/{}/?limit=1'.format(leader))
+    assert leader in response.get_json()['next']
+    response = client.get(follower_location + '?limit=1')
+    assert follower in response.get_json()['next']
+
+
+def test_cancel_running_search(app, client, text_ids, monkeypatch):
+    matching = threading.Event()
+    release = threading.Event()
+    matcher = tv5api.parallels.AggregationMatcher
+
+    class BlockingMatcher(matcher):
+        def match(self, *args, **kwargs):
+            matching.set()
+            release.wait(30)
+            return super().match(*args, **kwargs)
+
+    monkeypatch.setattr(tv5api.parallels, 'AggregationMatcher',
+            BlockingMatcher)
+    with app.test_request_context():
+        app.preprocess_request()
+        match_sets = flask.g.db.connection[
+            tesserae.db.entities.MatchSet.collection]
+        before = match_sets.count_documents({})
+
+    results_id, location = _submit(client, _search(*text_ids, max_distance=8))
+    assert matching.wait(30)
+    assert _wait(client, results_id, states=('running',))['state'] == \
+        'running'
+    response = client.delete(location)
+    assert response.status_code == 202
+    assert response.get_json()['state'] == 'cancelled'
+    release.set()
+
+    assert _wait(client, results_id)['state'] == 'cancelled'
+    response = client.get(location)
+    assert response.status_code == 410
+    response = client.delete(location)
+    assert response.status_code == 409
+    # the worker throws away what the search matched once it notices
+    deadline = time.monotonic() + 30
+    while match_sets.count_documents({}) != before and \
+            time.monotonic() < deadline:
+        time.sleep(0.1)
+    assert match_sets.count_documents({}) == before
+
+
+def test_deleting_a_text_cancels_its_searches(app, client, text_ids,
+        monkeypatch):
+    matching = threading.Event()
+    release = threading.Event()
+    matcher = tv5api.parallels.AggregationMatcher
+
+    class BlockingMatcher(matcher):
+        def match(self, *args, **kwargs):
+            matching.set()
+            release.wait(30)
+            return super().match(*args, **kwargs)
+
+    monkeypatch.setattr(tv5api.parallels, 'AggregationMatcher',
+            BlockingMatcher)
+    with app.test_request_context():
+        app.preprocess_request()
+        connection = flask.g.db
+        text = tesserae.db.entities.Text(
+            author='Bob', title='Doomed', language='latin', year=2018,
+            is_prose=False,
+            path=os.path.join(os.path.dirname(__file__), 'bob.txt'))
+        tesserae.utils.ingest_text(connection, text)
+    match_sets = connection.connection[
+        tesserae.db.entities.MatchSet.collection]
+    before = match_sets.count_documents({})
+
+    results_id, _ = _submit(client, _search(text_ids[0], str(text.id)))
+    assert matching.wait(30)
+    connection.delete(text)
+    _, job = tv5api.deletion.create_deletion(connection.connection, text)
+    tv5api.deletion.run_deletion(connection, None, job)
+    release.set()
+
+    status = _wait(client, results_id)
+    assert status['state'] == 'cancelled'
+    deadline = time.monotonic() + 30
+    while match_sets.count_documents({}) != before and \
+            time.monotonic() < deadline:
+        time.sleep(0.1)
+    assert match_sets.count_documents({}) == before
+
+
+def test_batch_search(app, client, text_ids):
+    source_id, target_id = text_ids
+    for_post = _search(source_id, target_id, max_distance=7)
+    del for_post['target']
+    for_post['targets'] = [
+        {'object_id': target_id, 'units': 'line'},
+        {'object_id': source_id, 'units': 'line'},
+    ]
+    response = client.post('/parallels/batch/', json=for_post)
+    assert response.status_code == 201
+    endpoint = response.headers['Location']
+
+    deadline = time.monotonic() + 60
+    while True:
+        response = client.get(endpoint)
+        assert response.status_code == 200
+        data = response.get_json()
+        if data['counts'].get('done', 0) == 2 or \
+                time.monotonic() > deadline:
+            break
+        time.sleep(0.1)
+    assert data['counts'] == {'done': 2}
+    assert [r['target'] for r in data['results']] == for_post['targets']
+    for result in data['results']:
+        response = client.get(result['location'])
+        assert response.status_code == 200
+        assert 'parallels' in response.get_json()
+
+    for_post = _search(source_id, target_id, max_distance=7)
+    del for_post['target']
+    for_post['target_filter'] = {'author': 'Bob', 'units': 'line'}
+    response = client.post('/parallels/batch/', json=for_post)
+    assert response.status_code == 201
+    data = client.get(response.headers['Location']).get_json()
+    # the source is not searched against itself
+    assert [r['target']['object_id'] for r in data['results']] == [target_id]
+
+
+def test_deleting_a_text_removes_its_results(app, client, text_ids):
+    with app.test_request_context():
+        app.preprocess_request()
+        connection = flask.g.db
+        text = tesserae.db.entities.Text(
+            author='Bob', title='Removed', language='latin', year=2018,
+            is_prose=False,
+            path=os.path.join(os.path.dirname(__file__), 'bob.txt'))
+        tesserae.utils.ingest_text(connection, text)
+    for_post = _search(text_ids[0], str(text.id), max_distance=6)
+    del for_post['target']
+    for_post['targets'] = [{'object_id': str(text.id), 'units': 'line'}]
+    response = client.post('/parallels/batch/', json=for_post)
+    assert response.status_code == 201
+    endpoint = response.headers['Location']
+    results_id = client.get(endpoint).get_json()['results'][0]['results_id']
+    assert _wait(client, results_id)['state'] == 'done'
+    match_set_id = _match_set_id(app, results_id)
+    matches = connection.connection[tesserae.db.entities.Match.collection]
+    # as stored by older versions of tesserae
+    matches.insert_one({'match_set': str(match_set_id)})
+
+    connection.delete(text)
+    _, job = tv5api.deletion.create_deletion(connection.connection, text)
+    tv5api.deletion.run_deletion(connection, None, job)
+    assert matches.count_documents(
+        {'match_set': {'$in': [match_set_id, str(match_set_id)]}}) == 0
+    data = client.get(endpoint).get_json()
+    assert data['counts'] == {'removed': 1}
+
+
+def test_refused_search_lets_go_of_followers(app):
+    class FullQueue:
+        def submit(self, job):
+            # an identical search joins in before the queue refuses this one
+            tv5api.jobs.record_status(database, 'refused-follower',
+                    tv5api.jobs.QUEUED, leader=job['results_id'])
+            raise tv5api.jobs.QueueFull('full')
+
+    with app.test_request_context():
+        app.preprocess_request()
+        database = flask.g.db.connection
+        flask.g.search_queue = FullQueue()
+        with pytest.raises(tv5api.jobs.QueueFull):
+            tv5api.parallels._queue_search('refused-leader', flask.g.db,
+                    _search('abc', 'def'))
+    assert tv5api.jobs.get_status(database, 'refused-leader') is None
+    follower = tv5api.jobs.get_status(database, 'refused-follower')
+    assert follower['state'] == tv5api.jobs.FAILED
+    tv5api.jobs.discard_status(database, 'refused-follower')
+
+
+def test_status_of_nonexistent_search(app, client):
+    with app.test_request_context():
+        endpoint = flask.url_for(
+            'parallels.retrieve_status', results_id='i-dont-exist')
+    response = client.get(endpoint)
+    assert response.status_code == 404
+    data = response.get_json()
+    assert data['results_id'] == 'i-dont-exist'
+    assert 'message' in data
+
+
+def test_identical_searches_share_hash():
+    received = {
+        'source': {'object_id': 'abc', 'units': 'line'},
+        'target': {'object_id': 'def', 'units': 'line'},
+        'method': {
+            'name': 'original',
+            'feature': 'lemmata',
+            'stopwords': ['et', 'in', 'et'],
+            'freq_basis': 'corpus',
+            'max_distance': 10,
+            'distance_basis': 'frequency',
+        },
+    }
+    reordered = json.loads(json.dumps(received))
+    reordered['method']['stopwords'] = ['in', 'et']
+    reordered['source']['ignored'] = True
+    assert tv5api.parallels._hash_search(received) == \
+        tv5api.parallels._hash_search(reordered)
+
+    different = json.loads(json.dumps(received))
+    different['method']['max_distance'] = 5
+    assert tv5api.parallels._hash_search(received) != \
+        tv5api.parallels._hash_search(different)
+
+    # corpus frequencies change as texts come and go
+    assert tv5api.parallels._hash_search(received, 'a') != \
+        tv5api.parallels._hash_search(received, 'b')
+    by_texts = json.loads(json.dumps(received))
+    by_texts['method']['freq_basis'] = 'texts'
+    assert tv5api.parallels._hash_search(by_texts, 'a') == \
+        tv5api.parallels._hash_search(by_texts, 'b')
+
+
+def test_bad_page_arguments(app, client):
+    for args in ({'limit': 'x'}, {'offset': -1}, {'sort': 'author'},
+            {'top_k': 5, 'limit': 5}):
+        with app.test_request_context():
+            endpoint = flask.url_for(
+                'parallels.retrieve_results', results_id='abc', **args)
+        response = client.get(endpoint)
+        assert response.status_code == 400
+        assert 'message' in response.get_json()
+
+
+def test_bad_stream_argument(app, client):
+    with app.test_request_context():
+        endpoint = flask.url_for(
+            'parallels.retrieve_results', results_id='abc', stream='xml')
+    response = client.get(endpoint)
+    assert response.status_code == 400
+    assert 'message' in response.get_json()
+
+
+def test_bad_export_arguments(app, client):
+    with app.test_request_context():
+        endpoint = flask.url_for(
+            'parallels.export_results', results_id='abc',
+            file_format='csv', columns='score,nonexistent')
+    response = client.get(endpoint)
+    assert response.status_code == 400
+    assert 'nonexistent' in response.get_json()['message']
+
+    with app.test_request_context():
+        endpoint = flask.url_for(
+            'parallels.export_results', results_id='abc', file_format='xls')
+    response = client.get(endpoint)
+    assert response.status_code == 404
+
+
+def test_cancel_nonexistent_search(app, client):
+    with app.test_request_context():
+        endpoint = flask.url_for(
+            'parallels.retrieve_results', results_id='i-dont-exist')
+    response = client.delete(endpoint)
+    assert response.status_code == 404
+    assert response.get_json()['results_id'] == 'i-dont-exist'
+
+
+def test_batch_search_without_targets(app, client):
+    with app.test_request_context():
+        endpoint = flask.url_for('parallels.submit_batch_search')
+    for_post = {
+        'source': {'object_id': 'abc', 'units': 'line'},
+        'method': {'name': 'original'},
+    }
+    headers = werkzeug.datastructures.Headers()
+    headers['Content-Type'] = 'application/json; charset=utf-8'
+    response = client.post(
+        endpoint,
+        data=json.dumps(for_post).encode(encoding='utf-8'),
+        headers=headers,
+    )
+    assert response.status_code == 400
+    assert 'targets' in response.get_json()['message']
+
+
+def test_nonexistent_batch(app, client):
+    with app.test_request_context():
+        endpoint = flask.url_for(
+            'parallels.retrieve_batch', batch_id='i-dont-exist')
+    response = client.get(endpoint)
+    assert response.status_code == 404
+    assert response.get_json()['batch_id'] == 'i-dont-exist'
+
+
+def test_stopped_search_leaves_no_match_sets(app, client):
+    source, target = str(ObjectId()), str(ObjectId())
+    started = datetime.datetime(2020, 1, 1, 12, 0, 0)
+
+    def match_set(seconds):
+        created = ObjectId.from_datetime(
+            started + datetime.timedelta(seconds=seconds))
+        return tesserae.db.entities.MatchSet(
+            id=created, texts=[ObjectId(source), ObjectId(target)],
+            unit_types=['line', 'line'])
+
+    with app.test_request_context():
+        app.preprocess_request()
+        connection = flask.g.db
+        database = connection.connection
+        # from before the search started, or with results of its own
+        earlier, paired = match_set(-10), match_set(5)
+        # what the stopped search left behind
+        partial = match_set(10)
+        # possibly another search's, which started meanwhile
+        other = match_set(30)
+        connection.insert([earlier, paired, partial, other])
+        connection.insert(tesserae.db.entities.ResultsPair(
+            match_set_id=paired.id, results_id='someone-else'))
+        for results_id, offset in (('stopped', 0), ('other', 20)):
+            tv5api.jobs.record_status(database, results_id,
+                    tv5api.jobs.RUNNING)
+            database[tv5api.jobs.STATUS_COLLECTION].update_one(
+                {'results_id': results_id},
+                {'$set': {'started': started + datetime.timedelta(
+                    seconds=offset), 'texts': [source, target]}})
+        job = {
+            'results_id': 'stopped',
+            'search_hash': 'stopped-hash',
+            'received': _search(source, target),
+        }
+        tv5api.parallels._cancel_search(connection, job, 'Cancelled')
+
+        left = {doc['_id'] for doc in database[
+            tesserae.db.entities.MatchSet.collection].find(
+                {'_id': {'$in': [earlier.id, paired.id, partial.id,
+                    other.id]}})}
+    assert left == {earlier.id, paired.id, other.id}
+
+
+def test_limits_need_process_executor():
+    with pytest.raises(ValueError):
+        tv5api.create_app({
+            'MONGO_HOSTNAME': 'localhost',
+            'MONGO_PORT': 27017,
+            'MONGO_USER': None,
+            'MONGO_PASSWORD': None,
+            'DB_NAME': 'test_tv5api',
+            'SEARCH_EXECUTOR': 'thread',
+            'SEARCH_TIME_LIMIT': 60,
+        })
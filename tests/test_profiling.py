@@ -0,0 +1,66 @@
+import marshal
+import os
+
+import tv5api.profiling
+
+
+class _Connection:
+    connection = 'database'
+
+    def find(self, collection, **kwargs):
+        return [collection]
+
+
+def test_timed_connection_only_while_profiling():
+    connection = _Connection()
+    assert tv5api.profiling.timed_connection(connection) is connection
+
+    recorder = tv5api.profiling.Recorder()
+    tv5api.profiling._local.recorder = recorder
+    try:
+        timed = tv5api.profiling.timed_connection(connection)
+        assert timed.find('texts') == ['texts']
+        assert timed.find('tokens') == ['tokens']
+        assert timed.connection == 'database'
+    finally:
+        tv5api.profiling._local.recorder = None
+    methods = recorder.breakdown()['methods']
+    assert [(m['method'], m['calls']) for m in methods] == [('find', 2)]
+
+
+if os.environ.get('ADMIN_INSTANCE') == 'true':
+    def test_profile_request(client):
+        response = client.get('/texts/')
+        assert 'X-Profile-Location' not in response.headers
+
+        response = client.get('/texts/', headers={'X-Profile': 'pstats'})
+        assert response.status_code == 200
+        location = response.headers['X-Profile-Location']
+
+        response = client.get(location)
+        assert response.status_code == 200
+        profile = response.get_json()
+        assert profile['kind'] == 'pstats'
+        assert profile['endpoint'] == 'texts.query_texts'
+        assert profile['top_functions']
+        assert 'methods' in profile['database']
+
+        response = client.get(profile['download'])
+        assert response.status_code == 200
+        assert isinstance(marshal.loads(response.get_data()), dict)
+
+    def test_profile_request_as_collapsed_stacks(app, client):
+        app.config['PROFILE_SAMPLE_INTERVAL'] = 0.0001
+        response = client.get('/texts/', headers={'X-Profile': 'collapsed'})
+        location = response.headers['X-Profile-Location']
+        response = client.get(location)
+        assert response.get_json()['kind'] == 'collapsed'
+        response = client.get(response.get_json()['download'])
+        assert response.status_code == 200
+        for line in response.get_data(as_text=True).splitlines():
+            stack, count = line.rsplit(' ', 1)
+            assert int(count) > 0
+
+    def test_nonexistent_profile(client):
+        response = client.get('/profiles/nonexistent/')
+        assert response.status_code == 404
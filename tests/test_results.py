@@ -0,0 +1,69 @@
+import io
+import json
+
+import pytest
+
+import tv5api.results
+
+
+def _matches(count):
+    return [
+        {
+            'source_tag': '1.{}'.format(i),
+            'target_tag': '2.{}'.format(i),
+            'source_snippet': 'arma virumque cano',
+            'target_snippet': 'bella per Emathios',
+            'matched_features': ['arma'],
+            'score': float(i),
+        }
+        for i in range(count)
+    ]
+
+
+def test_pages_have_a_stable_order():
+    pipeline = tv5api.results.match_pipeline('abc', offset=10, limit=5)
+    assert pipeline[1] == {'$sort': {'_id': 1}}
+    pipeline = tv5api.results.match_pipeline('abc', sort='-score', limit=5)
+    assert pipeline[1] == {'$sort': {'score': -1, '_id': -1}}
+    pipeline = tv5api.results.match_pipeline('abc')
+    assert not any('$sort' in stage for stage in pipeline)
+
+
+def test_stream_json():
+    chunks = tv5api.results.stream_json({'a': 1}, _matches(3))
+    data = json.loads(''.join(chunks))
+    assert data['data'] == {'a': 1}
+    assert data['parallels'] == _matches(3)
+
+
+def test_stream_msgpack():
+    msgpack = pytest.importorskip('msgpack')
+    body = b''.join(tv5api.results.stream_msgpack(
+        {'a': 1}, _matches(5), batch_size=2))
+    objects = list(msgpack.Unpacker(io.BytesIO(body), raw=False))
+    assert objects[0] == {'data': {'a': 1}}
+    assert [len(o['score']) for o in objects[1:]] == [2, 2, 1]
+    assert sum((o['score'] for o in objects[1:]), []) == \
+        [float(i) for i in range(5)]
+
+
+def test_stream_arrow():
+    pyarrow = pytest.importorskip('pyarrow')
+    import pyarrow.ipc
+    body = b''.join(tv5api.results.stream_arrow(
+        {'a': 1}, _matches(5), batch_size=2))
+    table = pyarrow.ipc.open_stream(body).read_all()
+    assert table.num_rows == 5
+    assert table.column('source_tag').to_pylist()[4] == '1.4'
+    assert table.schema.metadata[b'data'] == b'{"a": 1}'
+
+
+def test_stream_delimited():
+    rows = list(tv5api.results.stream_delimited(
+        _matches(2), ['source_tag', 'source_snippet', 'matched_features'],
+        delimiter='\t'))
+    assert rows == [
+        'source_tag\tsource_snippet\tmatched_features\n',
+        '1.0\tarma virumque cano\tarma\n',
+        '1.1\tarma virumque cano\tarma\n',
+    ]
@@ -4,12 +4,54 @@ import os
 import flask
 import werkzeug.datastructures
 
+import tv5api.frequencies
 import tesserae.db.entities
 
 
-def test_stopwords(client):
-    # TODO fill this in
-    assert False
+def test_stopwords(app, client):
+    text = tesserae.db.entities.Text(
+        author='stopwords', title='test', language='test_language',
+        year=1, is_prose=True, path='test.tess')
+    with app.test_request_context():
+        app.preprocess_request()
+        flask.g.db.insert(text)
+        features = [
+            tesserae.db.entities.Feature(
+                language='test_language', feature='form', token=token,
+                index=i)
+            for i, token in enumerate(['et', 'in', 'arma'])
+        ]
+        flask.g.db.insert(features)
+        # "et" three times, "in" twice, "arma" once
+        flask.g.db.insert([
+            tesserae.db.entities.Token(
+                text=text.id, index=i, display=features[f].token,
+                features={'form': [features[f].id]})
+            for i, f in enumerate([0, 1, 0, 2, 1, 0])
+        ])
+        tv5api.frequencies.update_text_tables(flask.g.db, text)
+
+    for args in ('language=test_language', 'works={}'.format(text.id)):
+        response = client.get(
+            '/stopwords/?feature=form&list_size=2&' + args)
+        assert response.status_code == 200
+        data = response.get_json()
+        assert data['stopwords'] == ['et', 'in']
+        assert data['counts'] == [3, 2]
+
+    for args in ('list_size=0', 'works=nope',
+            'works={}&language=test_language'.format(text.id),
+            'feature=lemmata&works={}'.format(text.id)):
+        response = client.get('/stopwords/?' + args)
+        assert response.status_code == 400
+
+    with app.test_request_context():
+        app.preprocess_request()
+        tv5api.frequencies.remove_text_tables(flask.g.db, text.id)
+        flask.g.db.connection[tesserae.db.entities.Token.collection].delete_many(
+            {'text': text.id})
+        flask.g.db.delete(features)
+        flask.g.db.delete(text)
 
 
 def test_stopwords_lists(app, client):
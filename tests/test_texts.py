@@ -1,11 +1,13 @@
 import json
 import os
+import time
 import urllib.parse
 
 import flask
 import werkzeug.datastructures
 
 import tesserae.db.entities
+import tv5api.frequencies
 
 
 def test_query_texts(client):
@@ -29,6 +31,49 @@ def test_query_texts_with_fields(app, client):
         assert text['language'] == lang
 
 
+def test_query_texts_in_pages(client):
+    response = client.get('/texts/')
+    everything = {t['object_id'] for t in response.get_json()['texts']}
+
+    paged = []
+    endpoint = '/texts/?limit=1&sort=title&fields=title'
+    while endpoint is not None:
+        response = client.get(endpoint)
+        assert response.status_code == 200
+        data = response.get_json()
+        for text in data['texts']:
+            assert set(text) == {'object_id', 'title'}
+        paged.extend(t['object_id'] for t in data['texts'])
+        endpoint = data.get('next', None)
+    assert len(paged) == len(set(paged))
+    assert set(paged) == everything
+
+
+def test_query_texts_bad_listing_args(client):
+    for args in ('limit=0', 'limit=many', 'sort=path', 'fields=,',
+            'fields=_id', 'cursor=WzFd', 'limit=1&cursor=WzFd',
+            'limit=1&cursor=!'):
+        response = client.get('/texts/?' + args)
+        assert response.status_code == 400
+
+
+def test_query_texts_conditionally(client):
+    response = client.get('/texts/')
+    assert response.status_code == 200
+    assert response.cache_control.max_age is not None
+    etag, _ = response.get_etag()
+    assert etag is not None
+
+    response = client.get('/texts/', headers={'If-None-Match': '"' + etag + '"'})
+    assert response.status_code == 304
+    assert response.get_data() == b''
+
+    # every text shares the tag, which must not vouch for texts that do not
+    # exist
+    response = client.get('/texts/DEADBEEFDEADBEEFDEADBEEF/',
+            headers={'If-None-Match': '"' + etag + '"'})
+    assert response.status_code == 404
+
 if os.environ.get('ADMIN_INSTANCE') == 'true':
     def test_add_and_remove_text(app, client):
 
@@ -77,10 +122,24 @@ if os.environ.get('ADMIN_INSTANCE') == 'true':
 
         response = client.delete(endpoint)
         # make sure the new text has been deleted
-        assert response.status_code == 204
+        assert response.status_code == 202
+        deletion_endpoint = response.headers['Location']
         response = client.get(endpoint)
         assert response.status_code == 404
 
+        # make sure what was derived from the text is removed in time
+        deadline = time.monotonic() + 60
+        while True:
+            response = client.get(deletion_endpoint)
+            assert response.status_code == 200
+            data = response.get_json()
+            if data['state'] == 'done' or time.monotonic() > deadline:
+                break
+            time.sleep(0.5)
+        assert data['state'] == 'done'
+        assert data['object_id'] == new_obj_id
+        assert data['counts']['tokens'] > 0
+
         # make sure adding then deleting doesn't mess up the database
         after_delete = {
             text['object_id']: text
@@ -90,6 +149,71 @@ if os.environ.get('ADMIN_INSTANCE') == 'true':
             assert k in before and v == before[k]
 
 
+    def test_add_text_with_failing_tables(app, client, monkeypatch):
+        def fail(connection, text):
+            raise RuntimeError('no tables')
+
+        monkeypatch.setattr(tv5api.frequencies, 'update_text_tables', fail)
+        response = client.post('/texts/', json={
+            'author': 'Bob',
+            'is_prose': False,
+            'language': 'latin',
+            'path': os.path.join(os.path.dirname(__file__), 'bob.txt'),
+            'title': 'Bob Without Tables',
+            'year': 2018
+        })
+        # the text was added, and the client is told which it is, lest it
+        # add the text again
+        assert response.status_code == 500
+        object_id = response.get_json()['object_id']
+        assert client.get('/texts/{}/'.format(object_id)).status_code == 200
+
+        response = client.delete('/texts/{}/'.format(object_id))
+        assert response.status_code == 202
+        deletion_endpoint = response.headers['Location']
+        deadline = time.monotonic() + 60
+        while client.get(deletion_endpoint).get_json()['state'] != 'done' \
+                and time.monotonic() < deadline:
+            time.sleep(0.1)
+
+
+    def test_add_texts_in_bulk(client):
+        to_be_added = {
+            'author': 'Bob',
+            'is_prose': False,
+            'language': 'latin',
+            'path': os.path.join(os.path.dirname(__file__), 'bob.txt'),
+            'title': 'Bob Bob in Bulk',
+            'year': 2018
+        }
+        response = client.post('/texts/batch/', json={'texts': [to_be_added]})
+        assert response.status_code == 201
+        endpoint = response.headers['Location']
+
+        deadline = time.monotonic() + 60
+        while True:
+            response = client.get(endpoint)
+            assert response.status_code == 200
+            data = response.get_json()
+            if data['state'] == 'done' or time.monotonic() > deadline:
+                break
+            time.sleep(0.5)
+        assert data['state'] == 'done' and data['percent'] == 100
+        entry = data['texts'][0]
+        assert entry['state'] == 'done' and entry['title'] == to_be_added['title']
+
+        response = client.delete('/texts/{}/'.format(entry['object_id']))
+        assert response.status_code == 202
+
+        incomplete = dict(to_be_added)
+        del incomplete['path']
+        response = client.post(
+            '/texts/batch/', json={'texts': [to_be_added, incomplete]})
+        assert response.status_code == 400
+        response = client.post('/texts/batch/', json={'texts': []})
+        assert response.status_code == 400
+
+
     def test_add_text_insufficient_data(client):
         to_be_added = {
         }
@@ -154,7 +278,7 @@ if os.environ.get('ADMIN_INSTANCE') == 'true':
                 assert k in before and before[k] == v
 
         response = client.delete(endpoint)
-        assert response.status_code == 204
+        assert response.status_code == 202
         response = client.get(endpoint)
         assert response.status_code == 404
 
@@ -186,7 +310,7 @@ if os.environ.get('ADMIN_INSTANCE') == 'true':
                 'texts.get_text',
                 object_id=data['object_id'])
         response = client.delete(endpoint)
-        assert response.status_code == 204
+        assert response.status_code == 202
         response = client.get(endpoint)
         assert response.status_code == 404
 
@@ -223,3 +347,16 @@ if os.environ.get('ADMIN_INSTANCE') == 'true':
         assert 'message' in data
 
     # TODO check for 400 errors when object_ids are bad
+
+
+def test_frequencies_of_malformed_id(app, client):
+    with app.test_request_context():
+        endpoint = flask.url_for(
+            'texts.get_text_frequencies',
+            object_id='not-an-id',
+            feature='lemmata',
+        )
+    response = client.get(endpoint)
+    assert response.status_code == 400
+    data = response.get_json()
+    assert 'object_id' in data and data['object_id'] == 'not-an-id'
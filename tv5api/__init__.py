@@ -1,12 +1,94 @@
 """Tesserae API implementation"""
+import datetime
+import functools
+import os
 import urllib.parse
 
+import click
 import flask
 
 import tesserae.db
+import tesserae.db.entities
 
 def _load_config(app, test_config):
     """Load configuration into `app`"""
+    app.config.from_mapping(
+        # 'inprocess' or 'local_broker'
+        SEARCH_QUEUE_BACKEND='inprocess',
+        # run searches in child processes ('process'), out of the way of
+        # the web worker's requests, or in its threads ('thread'), as for
+        # tests; SEARCH_WORKERS caps how many run at once
+        SEARCH_EXECUTOR='process',
+        SEARCH_WORKERS=2,
+        SEARCH_PROCESS_START_METHOD='spawn',
+        # seconds a search may run before it is cancelled, and bytes of
+        # memory it may use; searches in worker threads cannot be stopped,
+        # so these need SEARCH_EXECUTOR='process'
+        SEARCH_TIME_LIMIT=None,
+        SEARCH_MEMORY_LIMIT=None,
+        # searches allowed to wait for a worker before new ones are refused
+        SEARCH_QUEUE_MAX_PENDING=100,
+        # seconds clients are told to wait when searches are refused
+        SEARCH_RETRY_AFTER=30,
+        # seconds a search waiting or running in a worker keeps identical
+        # searches waiting on it without the worker renewing its claim;
+        # searches whose workers die are taken over once this lapses
+        SEARCH_LEASE_SECONDS=60,
+        # the same, for texts ingested in bulk on admin instances
+        INGEST_QUEUE_BACKEND='inprocess',
+        INGEST_EXECUTOR='process',
+        INGEST_WORKERS=2,
+        INGEST_PROCESS_START_METHOD='spawn',
+        INGEST_TIME_LIMIT=None,
+        INGEST_MEMORY_LIMIT=None,
+        # threads removing the data derived from deleted texts
+        DELETION_WORKERS=1,
+        RESULTS_CACHE_MAX_BYTES=256 * 1024 * 1024,
+        # keep cached results on disk too, if set
+        RESULTS_CACHE_DIR=None,
+        RESULTS_CACHE_DIR_MAX_BYTES=None,
+        TEXT_CACHE_MAX_ENTRIES=1024,
+        # seconds a worker may serve text metadata after another worker has
+        # changed it
+        TEXT_CACHE_CHECK_INTERVAL=1.0,
+        STOPWORDS_CACHE_MAX_ENTRIES=1024,
+        STOPWORDS_CACHE_CHECK_INTERVAL=1.0,
+        # seconds browsers and proxies may reuse metadata responses without
+        # asking again
+        TEXTS_MAX_AGE=300,
+        STOPWORDS_MAX_AGE=300,
+        # have MongoDB record queries taking at least this many milliseconds,
+        # or scanning whole collections, for "flask slow-queries" to report
+        MONGO_PROFILE_SLOW_MS=None,
+        # MongoDB client pools of each process; options left as None are
+        # left to pymongo's defaults.  MONGO_MAX_CONNECTING caps how many
+        # connections a pool opens at once, which spares the server a storm
+        # of connections when many workers start together
+        MONGO_MAX_POOL_SIZE=None,
+        MONGO_MIN_POOL_SIZE=None,
+        MONGO_MAX_CONNECTING=None,
+        MONGO_MAX_IDLE_TIME_MS=None,
+        # milliseconds a request may wait for a pooled connection
+        MONGO_WAIT_QUEUE_TIMEOUT_MS=None,
+        MONGO_SERVER_SELECTION_TIMEOUT_MS=None,
+        MONGO_CONNECT_TIMEOUT_MS=None,
+        MONGO_SOCKET_TIMEOUT_MS=None,
+        # read preference, such as 'secondaryPreferred', for requests that
+        # only read text and stopwords metadata; reads from secondaries may
+        # lag writes, so what the metadata caches keep is read from the
+        # primary all the same
+        MONGO_READ_ONLY_PREFERENCE=None,
+        # callable taking this configuration and returning a
+        # TessMongoConnection, to connect to a stand-in for MongoDB instead;
+        # it must be picklable for jobs run in child processes
+        CONNECTION_FACTORY=None,
+        # seconds between stack samples of requests profiled as "collapsed"
+        # on admin instances
+        PROFILE_SAMPLE_INTERVAL=0.005,
+        COMPRESSION_LEVELS={'gzip': 6, 'br': 5, 'zstd': 3},
+        # bodies smaller than this many bytes are sent uncompressed
+        COMPRESSION_MIN_SIZE=1024,
+    )
     if test_config is None:
         # load the instance config, if it exists, when not testing
         app.config.from_pyfile('config.py', silent=True)
@@ -15,25 +97,319 @@ def _load_config(app, test_config):
         app.config.from_mapping(test_config)
 
 
+# configuration needed to connect to the database
+_CONNECTION_KEYS = ('MONGO_HOSTNAME', 'MONGO_PORT', 'MONGO_USER',
+        'MONGO_PASSWORD', 'DB_NAME', 'MONGO_MAX_POOL_SIZE',
+        'MONGO_MIN_POOL_SIZE', 'MONGO_MAX_CONNECTING',
+        'MONGO_MAX_IDLE_TIME_MS', 'MONGO_WAIT_QUEUE_TIMEOUT_MS',
+        'MONGO_SERVER_SELECTION_TIMEOUT_MS', 'MONGO_CONNECT_TIMEOUT_MS',
+        'MONGO_SOCKET_TIMEOUT_MS', 'CONNECTION_FACTORY')
+
+
+def create_connection(config):
+    """Connect to MongoDB as described by `config`
+
+    A CONNECTION_FACTORY in `config` is called with `config` to connect
+    instead.
+    """
+    factory = config.get('CONNECTION_FACTORY')
+    if factory is not None:
+        return factory(config)
+    from . import connections
+    return tesserae.db.TessMongoConnection(config['MONGO_HOSTNAME'],
+            config['MONGO_PORT'], config['MONGO_USER'],
+            config['MONGO_PASSWORD'], db=config['DB_NAME'],
+            **connections.client_options(config))
+
+
+def _enable_metrics(app):
+    """Count and time every request
+
+    Registered ahead of every other hook, so that timings cover the others.
+    """
+    from . import metrics
+    app.before_request(metrics.start_timing)
+    app.after_request(metrics.finish_timing)
+
+
+def _enable_profiling(app):
+    """Profile requests that ask for it, on admin instances
+
+    Registered ahead of connecting to the database, so that the connection's
+    commands can be timed.
+    """
+    if os.environ.get('ADMIN_INSTANCE') != 'true':
+        return
+    from . import profiling
+    profiling.register_command_timer()
+    app.before_request(profiling.start_profile)
+    app.after_request(profiling.finish_profile)
+
+
 def _connect_database(app):
     """Initiate connection with MongoDB
 
     From this point forward, before_request exposes access to the database via
-    g.db.
+    g.db.  Each process connects on its first use of the database; see
+    tv5api.connections.  GET and HEAD requests to views marked read_only are
+    served through a connection with MONGO_READ_ONLY_PREFERENCE.  Values
+    kept in caches are to be read through g.primary_db instead, since a
+    secondary may not yet hold changes that invalidated the caches.
     """
+    from . import connections, profiling
     # http://librelist.com/browser/flask/2013/8/21/flask-pymongo-and-blueprint/#811dd1b119757bc09d28425a5bda86d9
-    db = tesserae.db.TessMongoConnection(app.config['MONGO_HOSTNAME'],
-            app.config['MONGO_PORT'], app.config['MONGO_USER'],
-            app.config['MONGO_PASSWORD'], db=app.config['DB_NAME'])
+    db = connections.ProcessConnection(
+        lambda: create_connection(app.config),
+        connections.read_preference(app.config['MONGO_READ_ONLY_PREFERENCE']))
+
+    @app.before_request
+    def before_request():
+        view = app.view_functions.get(flask.request.endpoint)
+        reading = getattr(view, 'read_only', False) and \
+            flask.request.method in ('GET', 'HEAD')
+        flask.g.db = profiling.timed_connection(db.current(reading=reading))
+        flask.g.primary_db = flask.g.db
+        if reading:
+            flask.g.primary_db = profiling.timed_connection(db.current())
+
+    return db
+
+
+def _ensure_indexes(app, db):
+    """Create missing indexes, and start profiling queries if configured
+
+    Indexes on the largest collections are only reported if missing, since
+    building them could hold up startup; "flask ensure-indexes" creates them.
+
+    This connects the process creating the application to the database;
+    processes forked from it still connect on their own.
+    """
+    from . import indexes
+    _, conflicts = indexes.ensure_indexes(
+        db.connection, indexes.STARTUP_INDEXES)
+    for collection, keys, options in conflicts:
+        app.logger.warning(
+            'Index on %s %s conflicts with an existing index', collection,
+            keys)
+    for collection, keys, options in indexes.missing_indexes(
+            db.connection):
+        app.logger.warning(
+            'Index on %s %s is missing; run "flask ensure-indexes"',
+            collection, keys)
+    if app.config['MONGO_PROFILE_SLOW_MS'] is not None:
+        indexes.enable_profiling(
+            db.connection, app.config['MONGO_PROFILE_SLOW_MS'])
+
+
+def _check_limits(app, prefix):
+    """Refuse limits that jobs run in worker threads would not be held to
+
+    A job in a worker thread cannot be stopped before it finishes, so
+    limiting its time or memory would free no capacity.
+
+    Raises
+    ------
+    ValueError
+        if a time or memory limit is set without the process executor
+    """
+    if app.config[prefix + '_EXECUTOR'] == 'process':
+        return
+    for limit in ('_TIME_LIMIT', '_MEMORY_LIMIT'):
+        if app.config[prefix + limit] is not None:
+            raise ValueError(
+                "{}{} is only enforced with {}_EXECUTOR='process'".format(
+                    prefix, limit, prefix))
+
+
+def _start_search_queue(app, db):
+    """Start the workers that run submitted searches
+
+    From this point forward, before_request exposes access to the search
+    queue via g.search_queue.
+    """
+    from . import jobs, metrics, parallels
+    _check_limits(app, 'SEARCH')
+    if app.config['SEARCH_EXECUTOR'] == 'process':
+        runner = jobs.ProcessRunner(
+            functools.partial(parallels.run_search_in_process,
+                {k: app.config[k] for k in _CONNECTION_KEYS}),
+            start_method=app.config['SEARCH_PROCESS_START_METHOD'],
+            time_limit=app.config['SEARCH_TIME_LIMIT'],
+            memory_limit=app.config['SEARCH_MEMORY_LIMIT'])
+        run_job = functools.partial(parallels.supervise_search, db, runner)
+    else:
+        run_job = functools.partial(parallels.run_search, db)
+    search_queue = jobs.JobQueue(
+        jobs.make_backend(app.config['SEARCH_QUEUE_BACKEND'], 'searches'),
+        metrics.timed_job('searches', run_job),
+        workers=app.config['SEARCH_WORKERS'],
+        max_pending=app.config['SEARCH_QUEUE_MAX_PENDING'],
+        heartbeat=functools.partial(parallels.keep_flights, db,
+            lease=app.config['SEARCH_LEASE_SECONDS']),
+        heartbeat_interval=app.config['SEARCH_LEASE_SECONDS'] / 3)
+    metrics.watch_queue('searches', search_queue)
+    search_queue.start()
+
+    @app.before_request
+    def before_request():
+        flask.g.search_queue = search_queue
+
+
+def _start_ingest_queue(app, db):
+    """Start the workers that ingest texts submitted in bulk
+
+    Only admin instances ingest texts.  From this point forward,
+    before_request exposes access to the ingest queue via g.ingest_queue.
+    """
+    if os.environ.get('ADMIN_INSTANCE') != 'true':
+        return
+    from . import ingestion, jobs, metrics
+    _check_limits(app, 'INGEST')
+    if app.config['INGEST_EXECUTOR'] == 'process':
+        runner = jobs.ProcessRunner(
+            functools.partial(ingestion.run_ingest_in_process,
+                {k: app.config[k] for k in _CONNECTION_KEYS}),
+            start_method=app.config['INGEST_PROCESS_START_METHOD'],
+            time_limit=app.config['INGEST_TIME_LIMIT'],
+            memory_limit=app.config['INGEST_MEMORY_LIMIT'])
+        run_job = functools.partial(ingestion.supervise_ingest, db, runner)
+    else:
+        run_job = functools.partial(ingestion.run_ingest, db)
+    ingest_queue = jobs.JobQueue(
+        jobs.make_backend(app.config['INGEST_QUEUE_BACKEND'], 'ingests'),
+        metrics.timed_job('ingests', run_job),
+        workers=app.config['INGEST_WORKERS'])
+    metrics.watch_queue('ingests', ingest_queue)
+    ingest_queue.start()
+
+    @app.before_request
+    def before_request():
+        flask.g.ingest_queue = ingest_queue
+
+
+def _start_deletion_queue(app, db, results_cache):
+    """Start the workers that remove the data derived from deleted texts
+
+    Only admin instances delete texts.  From this point forward,
+    before_request exposes access to the deletion queue via
+    g.deletion_queue.
+    """
+    if os.environ.get('ADMIN_INSTANCE') != 'true':
+        return
+    from . import deletion, jobs, metrics
+    deletion_queue = jobs.JobQueue(
+        jobs.make_backend(app.config['INGEST_QUEUE_BACKEND'], 'deletions'),
+        metrics.timed_job('deletions',
+            functools.partial(deletion.run_deletion, db, results_cache)),
+        workers=app.config['DELETION_WORKERS'])
+    metrics.watch_queue('deletions', deletion_queue)
+    deletion_queue.start()
 
     @app.before_request
     def before_request():
-        flask.g.db = db
+        flask.g.deletion_queue = deletion_queue
+
+
+def _create_results_cache(app):
+    """Set up the cache of finished search results
+
+    From this point forward, before_request exposes access to the cache via
+    g.results_cache.
+    """
+    from . import cache
+    results_cache = cache.ResultsCache(
+        app.config['RESULTS_CACHE_MAX_BYTES'],
+        directory=app.config['RESULTS_CACHE_DIR'],
+        max_disk_bytes=app.config['RESULTS_CACHE_DIR_MAX_BYTES'])
+
+    @app.before_request
+    def before_request():
+        flask.g.results_cache = results_cache
+
+    return results_cache
+
+
+def _create_metadata_caches(app, db):
+    """Set up the caches of encoded text and stopwords metadata
+
+    From this point forward, before_request exposes access to the caches via
+    g.text_cache and g.stopwords_cache.
+    """
+    from . import cache
+    text_cache = cache.VersionedCache(
+        db, 'texts',
+        app.config['TEXT_CACHE_MAX_ENTRIES'],
+        check_interval=app.config['TEXT_CACHE_CHECK_INTERVAL'])
+    stopwords_cache = cache.VersionedCache(
+        db, 'stopwords',
+        app.config['STOPWORDS_CACHE_MAX_ENTRIES'],
+        check_interval=app.config['STOPWORDS_CACHE_CHECK_INTERVAL'])
+
+    @app.before_request
+    def before_request():
+        flask.g.text_cache = text_cache
+        flask.g.stopwords_cache = stopwords_cache
+
+
+def _enable_compression(app):
+    """Compress responses according to the Accept-Encoding of requests"""
+    from . import encoding
+    app.after_request(encoding.compress_response)
+
+
+def _register_commands(app):
+    """Add maintenance commands to the flask command line"""
+    from . import cache, frequencies, indexes
+
+    @app.cli.command('build-frequencies')
+    def build_frequencies():
+        """Compute frequency tables for every text in the database"""
+        db = create_connection(app.config)
+        indexes.ensure_indexes(db.connection)
+        languages = set()
+        for text in db.find(tesserae.db.entities.Text.collection):
+            frequencies.update_text_tables(db, text)
+            languages.add(text.language)
+            print('{}: {}'.format(text.id, text.title))
+        # repairs corpus tables that drifted from, or predate, the text tables
+        for language in sorted(languages):
+            frequencies.rebuild_corpus_tables(db, language)
+        # stopwords lists computed from the old tables are cached under the
+        # version of the texts
+        cache.invalidate_version(db.connection, 'texts')
+
+    @app.cli.command('ensure-indexes')
+    def ensure_indexes():
+        """Create the indexes the API relies on, if they are missing"""
+        db = create_connection(app.config)
+        created, conflicts = indexes.ensure_indexes(db.connection)
+        for collection, keys, _ in created:
+            print('created: {} {}'.format(collection, keys))
+        for collection, keys, _ in conflicts:
+            print('conflicts with an existing index: {} {}'.format(
+                collection, keys))
+
+    @app.cli.command('slow-queries')
+    @click.option('--minutes', type=int, default=None,
+            help='Only report queries from this many minutes back.')
+    def slow_queries(minutes):
+        """Summarize slow and collection-scanning queries"""
+        db = create_connection(app.config)
+        since = None
+        if minutes is not None:
+            since = datetime.datetime.utcnow() - datetime.timedelta(
+                minutes=minutes)
+        for summary in indexes.slow_queries(db.connection, since=since):
+            print('{ns} {op} {plan}: {count} times, {total_ms} ms in all, '
+                    '{max_ms} ms at most'.format(**summary))
+            print('    e.g. {}'.format(summary['example']))
 
 
 def _register_blueprints(app):
-    from . import parallels, stopwords, texts
+    from . import metrics, parallels, profiling, stopwords, texts
+    app.register_blueprint(metrics.bp)
     app.register_blueprint(parallels.bp)
+    app.register_blueprint(profiling.bp)
     app.register_blueprint(stopwords.bp)
     app.register_blueprint(texts.bp)
 
@@ -43,7 +419,17 @@ def create_app(test_config=None):
     app = flask.Flask(__name__, instance_relative_config=True)
 
     _load_config(app, test_config)
-    _connect_database(app)
+    _enable_metrics(app)
+    _enable_profiling(app)
+    db = _connect_database(app)
+    _ensure_indexes(app, db)
+    _start_search_queue(app, db)
+    _start_ingest_queue(app, db)
+    results_cache = _create_results_cache(app)
+    _start_deletion_queue(app, db, results_cache)
+    _create_metadata_caches(app, db)
     _register_blueprints(app)
+    _register_commands(app)
+    _enable_compression(app)
 
     return app
@@ -0,0 +1,341 @@
+"""Caches for response bodies that rarely or never change"""
+import collections
+import os
+import tempfile
+import threading
+import time
+import uuid
+
+import flask
+import pymongo
+import pymongo.errors
+
+import tv5api.encoding
+
+# documents holding the versions of VersionedCaches, by name
+VERSIONS_COLLECTION = 'cache_versions'
+
+# seconds between scans of a ResultsCache's directory, which other processes
+# write to as well, and the fraction of its budget a scan trims it down to,
+# so that one over budget is not scanned again at every put
+_DISK_SCAN_INTERVAL = 60.0
+_DISK_TRIM_TO = 0.9
+
+
+class ResultsCache:
+    """Size-capped cache of finished response bodies
+
+    Bodies are kept in a least-recently-used memory tier and, if a directory
+    is given, also on local disk, so that they survive eviction from memory
+    and are shared by every worker process on the host.  Files on disk are
+    evicted least recently used first too, by modification time, which is
+    renewed whenever a body is read, since access times are not kept on
+    many mounts.
+
+    Keys must be usable as file names.  Keys beginning with the same prefix
+    can be dropped together with discard_prefix.
+
+    Parameters
+    ----------
+    max_bytes : int
+        most bytes to hold in memory
+    directory : str, optional
+        where to keep bodies on disk; bodies are kept only in memory if not
+        given
+    max_disk_bytes : int, optional
+        most bytes to hold on disk; unlimited if not given
+    """
+
+    def __init__(self, max_bytes, directory=None, max_disk_bytes=None):
+        self.max_bytes = max_bytes
+        self.directory = directory
+        self.max_disk_bytes = max_disk_bytes
+        self._entries = collections.OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+        # bytes on disk as of the last scan, plus those written here since
+        self._disk_bytes = 0
+        self._scanned = None
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+
+    def get(self, key):
+        """Return the body stored under `key`, or None if there is none"""
+        with self._lock:
+            body = self._entries.get(key)
+            if body is not None:
+                self._entries.move_to_end(key)
+        if self.directory is None:
+            return body
+        path = os.path.join(self.directory, key)
+        if body is None:
+            try:
+                with open(path, 'rb') as ifh:
+                    body = ifh.read()
+            except FileNotFoundError:
+                return None
+            self._remember(key, body)
+        _touch(path)
+        return body
+
+    def put(self, key, body):
+        """Store `body` under `key`"""
+        self._remember(key, body)
+        if self.directory is None:
+            return
+        # write to a temporary file first, so that readers never see a
+        # partially written body
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, prefix='.')
+        with os.fdopen(fd, 'wb') as ofh:
+            ofh.write(body)
+        os.replace(tmp_path, os.path.join(self.directory, key))
+        if self.max_disk_bytes is None:
+            return
+        with self._lock:
+            self._disk_bytes += len(body)
+            due = self._disk_bytes > self.max_disk_bytes or \
+                self._scanned is None or \
+                time.monotonic() - self._scanned >= _DISK_SCAN_INTERVAL
+        if due:
+            self._trim_disk()
+
+    def discard_prefix(self, prefix):
+        """Drop every body whose key begins with `prefix`"""
+        with self._lock:
+            for key in [k for k in self._entries if k.startswith(prefix)]:
+                self._size -= len(self._entries.pop(key))
+        if self.directory is None:
+            return
+        for entry in os.scandir(self.directory):
+            if entry.name.startswith(prefix):
+                _remove(entry.path)
+
+    def _remember(self, key, body):
+        if len(body) > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._size -= len(self._entries.pop(key))
+            self._entries[key] = body
+            self._size += len(body)
+            while self._size > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._size -= len(evicted)
+
+    def _trim_disk(self):
+        """Remove the least recently used files if over budget"""
+        entries = [
+            e for e in os.scandir(self.directory)
+            if not e.name.startswith('.')
+        ]
+        stats = {}
+        for entry in entries:
+            try:
+                stats[entry.path] = entry.stat()
+            except FileNotFoundError:
+                pass
+        total = sum(s.st_size for s in stats.values())
+        if total > self.max_disk_bytes:
+            for path in sorted(stats, key=lambda p: stats[p].st_mtime):
+                if total <= self.max_disk_bytes * _DISK_TRIM_TO:
+                    break
+                _remove(path)
+                total -= stats[path].st_size
+        with self._lock:
+            self._disk_bytes = total
+            self._scanned = time.monotonic()
+
+
+class VersionedCache:
+    """Size-capped cache of values derived from data that rarely changes
+
+    Every process holds its own cache, but they share a version in the
+    database.  Whoever changes the underlying data calls invalidate, which
+    empties the local cache and changes the version; other processes notice
+    the new version, and empty their caches too, at most `check_interval`
+    seconds later.  The version also serves to tag what the cache holds for
+    HTTP caching.
+
+    Parameters
+    ----------
+    connection : tesserae.db.TessMongoConnection
+        connection to the database where the version is kept
+    name : str
+        name of the version
+    max_entries : int
+        most values to hold; the least recently used are evicted first
+    check_interval : float
+        seconds to go between consulting the version
+    """
+
+    def __init__(self, connection, name, max_entries, check_interval=1.0):
+        self.connection = connection
+        self.name = name
+        self.max_entries = max_entries
+        self.check_interval = check_interval
+        self._entries = collections.OrderedDict()
+        self._version = None
+        self._checked = None
+        # advanced whenever the entries are emptied
+        self._generation = 0
+        self._lock = threading.Lock()
+
+    @property
+    def collection(self):
+        # looked up anew, since the connection may differ from one process to
+        # the next
+        return self.connection.connection[VERSIONS_COLLECTION]
+
+    def _current_version(self):
+        return current_version(self.collection.database, self.name)
+
+    def _sync(self):
+        now = time.monotonic()
+        if self._checked is not None and \
+                now - self._checked < self.check_interval:
+            return
+        version = self._current_version()
+        with self._lock:
+            if version != self._version:
+                self._clear()
+                self._version = version
+            self._checked = now
+
+    @property
+    def version(self):
+        """Opaque string that changes whenever the cache is invalidated"""
+        self._sync()
+        return self._version
+
+    def lookup(self, key, compute):
+        """Return the value stored under `key`, computing it if need be
+
+        Parameters
+        ----------
+        key : hashable
+        compute : callable
+            called with no arguments to produce the value when none is
+            stored; None results are passed on but not stored
+
+        Returns
+        -------
+        the stored or computed value
+        """
+        self._sync()
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                return self._entries[key]
+            generation = self._generation
+        value = compute()
+        with self._lock:
+            # a value computed while the cache was emptied may be stale
+            if value is not None and generation == self._generation:
+                self._entries[key] = value
+                while len(self._entries) > self.max_entries:
+                    self._entries.popitem(last=False)
+        return value
+
+    def invalidate(self):
+        """Forget every value, here and in every other process"""
+        version = invalidate_version(self.collection.database, self.name)
+        with self._lock:
+            self._clear()
+            self._version = version
+            self._checked = time.monotonic()
+
+    def _clear(self):
+        self._entries.clear()
+        self._generation += 1
+
+
+def current_version(database, name):
+    """Look up the version of the VersionedCaches named `name`
+
+    For processes that depend on cached data without holding a cache.
+
+    Returns
+    -------
+    str
+        the version, created if there was none
+    """
+    collection = database[VERSIONS_COLLECTION]
+    doc = collection.find_one({'_id': name})
+    if doc is None:
+        try:
+            doc = collection.find_one_and_update(
+                {'_id': name},
+                {'$setOnInsert': {'version': uuid.uuid4().hex}},
+                upsert=True, return_document=pymongo.ReturnDocument.AFTER)
+        except pymongo.errors.DuplicateKeyError:
+            # another process created it first
+            doc = collection.find_one({'_id': name})
+    return doc['version']
+
+
+def invalidate_version(database, name):
+    """Change the version of the VersionedCaches named `name`
+
+    For processes that change cached data without holding a cache.
+
+    Returns
+    -------
+    str
+        the new version
+    """
+    # random rather than counted, so that versions are not reused if the
+    # version record is lost
+    version = uuid.uuid4().hex
+    database[VERSIONS_COLLECTION].update_one(
+        {'_id': name}, {'$set': {'version': version}}, upsert=True)
+    return version
+
+
+def not_modified(etag, max_age):
+    """Build a 304 response if the client already holds what `etag` tags
+
+    Call before doing the work of producing the response.  Tags that
+    compress_response suffixed with the encoding it chose also match.
+
+    Parameters
+    ----------
+    etag : str
+        entity tag of the response that would be produced
+    max_age : int
+        seconds that caches may reuse the response for
+
+    Returns
+    -------
+    flask.Response or None
+        the 304 response, or None if the response must be produced
+    """
+    encoding = tv5api.encoding.negotiate(flask.request.accept_encodings)
+    for candidate in (etag, '{}-{}'.format(etag, encoding)):
+        if flask.request.if_none_match.contains(candidate):
+            response = flask.Response()
+            response.status_code = 304
+            return cacheable(response, candidate, max_age)
+    return None
+
+
+def cacheable(response, etag, max_age):
+    """Tag `response` with `etag` and let caches reuse it for `max_age` s"""
+    response.set_etag(etag)
+    response.cache_control.public = True
+    response.cache_control.max_age = max_age
+    return response
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def _touch(path):
+    """Mark a cached file as just used"""
+    try:
+        os.utime(path)
+    except FileNotFoundError:
+        pass
@@ -0,0 +1,131 @@
+"""Database connections that are safe to share across forked workers
+
+pymongo clients must not be used across a fork: their pooled sockets and
+monitoring threads belong to the process that made them.  WSGI servers
+commonly create the application once and then fork workers, so the
+application holds a ProcessConnection, which creates its client on first
+use in each process.  Each worker thus gets a pool of its own, sized and
+timed out as configured, once it starts handling requests.
+
+The process creating the application does connect right away, to create
+missing indexes (see tv5api._ensure_indexes).  That client is left to the
+creating process: workers forked from it never use it, and connect anew.
+"""
+import copy
+import os
+import threading
+
+import pymongo.read_preferences
+
+# configuration keys, and the pymongo client options they set
+CLIENT_OPTIONS = {
+    'MONGO_MAX_POOL_SIZE': 'maxPoolSize',
+    'MONGO_MIN_POOL_SIZE': 'minPoolSize',
+    'MONGO_MAX_CONNECTING': 'maxConnecting',
+    'MONGO_MAX_IDLE_TIME_MS': 'maxIdleTimeMS',
+    'MONGO_WAIT_QUEUE_TIMEOUT_MS': 'waitQueueTimeoutMS',
+    'MONGO_SERVER_SELECTION_TIMEOUT_MS': 'serverSelectionTimeoutMS',
+    'MONGO_CONNECT_TIMEOUT_MS': 'connectTimeoutMS',
+    'MONGO_SOCKET_TIMEOUT_MS': 'socketTimeoutMS',
+}
+
+
+def client_options(config):
+    """Gather the pymongo client options set in `config`
+
+    Options left as None are left to pymongo's defaults.
+    """
+    return {
+        option: config[key]
+        for key, option in CLIENT_OPTIONS.items()
+        if config.get(key) is not None
+    }
+
+
+def read_preference(name):
+    """Look up a read preference by its name, such as "secondaryPreferred"
+
+    Returns
+    -------
+    pymongo.read_preferences._ServerMode or None
+        None if `name` is None
+    """
+    if name is None:
+        return None
+    return pymongo.read_preferences.make_read_preference(
+        pymongo.read_preferences.read_pref_mode_from_name(name), None)
+
+
+def read_only(view):
+    """Mark a view as only reading from the database
+
+    GET and HEAD requests to such views are served through the connection
+    for reading, which may read from secondaries; see
+    ProcessConnection.current.  What such views cache is still read from
+    the primary, through g.primary_db, lest values a secondary has yet to
+    update be kept under the version that replaced them.
+    """
+    view.read_only = True
+    return view
+
+
+class ProcessConnection:
+    """Stand-in for a TessMongoConnection created anew in every process
+
+    Attributes are looked up on the current process's connection, so a
+    ProcessConnection can be handed wherever a TessMongoConnection is
+    expected, such as to job workers.
+
+    Parameters
+    ----------
+    create : callable
+        called with no arguments to connect, once per process
+    reader_preference : pymongo.read_preferences._ServerMode, optional
+        read preference of the connection for reading; the same connection
+        serves both if not given
+    """
+
+    def __init__(self, create, reader_preference=None):
+        self._create = create
+        self._reader_preference = reader_preference
+        self._pid = None
+        self._connection = None
+        self._reader = None
+        self._lock = threading.Lock()
+        # a lock held by another thread while forking stays held in the
+        # child, where no thread will ever release it
+        os.register_at_fork(after_in_child=self._reset_lock)
+
+    def _reset_lock(self):
+        self._lock = threading.Lock()
+
+    def current(self, reading=False):
+        """Return the connection of the current process
+
+        Parameters
+        ----------
+        reading : bool
+            whether the connection is only to be read from, so that it may
+            read from secondaries
+
+        Returns
+        -------
+        tesserae.db.TessMongoConnection
+        """
+        pid = os.getpid()
+        if self._pid != pid:
+            with self._lock:
+                if self._pid != pid:
+                    connection = self._create()
+                    reader = connection
+                    if self._reader_preference is not None:
+                        # shares the client, and so the pool, of connection
+                        reader = copy.copy(connection)
+                        reader.connection = connection.connection.with_options(
+                            read_preference=self._reader_preference)
+                    self._connection, self._reader = connection, reader
+                    self._pid = pid
+        return self._reader if reading else self._connection
+
+    def __getattr__(self, name):
+        return getattr(self.current(), name)
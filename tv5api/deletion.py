@@ -0,0 +1,182 @@
+"""Removing the data derived from deleted texts
+
+Deleting a text removes its metadata right away; everything derived from
+it, from its tokens to the results of searches involving it, is removed
+afterwards in the background, a collection at a time.
+"""
+import datetime
+import uuid
+
+from bson.objectid import ObjectId
+
+import tv5api.cache
+import tv5api.frequencies
+import tv5api.jobs
+import tv5api.parallels
+import tesserae.db.entities
+
+DELETIONS_COLLECTION = 'text_deletions'
+
+
+def create_deletion(connection, text):
+    """Record that the derived data of `text` is to be removed
+
+    Parameters
+    ----------
+    connection : pymongo.database.Database
+    text : tesserae.db.entities.Text
+        text whose metadata has just been deleted
+
+    Returns
+    -------
+    deletion_id : str
+    job : dict
+        deletion job, ready to be queued
+    """
+    deletion_id = uuid.uuid4().hex
+    connection[DELETIONS_COLLECTION].insert_one({
+        'deletion_id': deletion_id,
+        'text_id': str(text.id),
+        'title': text.title,
+        'state': tv5api.jobs.QUEUED,
+        'submitted': datetime.datetime.utcnow(),
+    })
+    return deletion_id, {
+        'deletion_id': deletion_id,
+        'text_id': str(text.id),
+        'language': text.language,
+    }
+
+
+def _remove_results(connection, text_id, results_cache):
+    """Remove the results of every search involving a text
+
+    Returns
+    -------
+    dict
+        number of documents removed, by collection
+    """
+    database = connection.connection
+    match_set_ids = [
+        doc['_id'] for doc in
+        database[tesserae.db.entities.MatchSet.collection].find(
+            {'texts': {'$in': [text_id, str(text_id)]}}, {'_id': True})
+    ]
+    counts = {'matches': 0, 'results_pairs': 0, 'match_sets': 0}
+    if not match_set_ids:
+        return counts
+    either = {'$in': match_set_ids + [str(i) for i in match_set_ids]}
+    counts['matches'] = database[
+        tesserae.db.entities.Match.collection].delete_many(
+            {'match_set': either}).deleted_count
+    results_ids = database[
+        tesserae.db.entities.ResultsPair.collection].distinct(
+            'results_id', {'match_set_id': either})
+    counts['results_pairs'] = database[
+        tesserae.db.entities.ResultsPair.collection].delete_many(
+            {'match_set_id': either}).deleted_count
+    counts['match_sets'] = database[
+        tesserae.db.entities.MatchSet.collection].delete_many(
+            {'_id': {'$in': match_set_ids}}).deleted_count
+    # identical searches submitted later must run again, rather than be
+    # pointed at the removed results
+    database[tv5api.jobs.FLIGHTS_COLLECTION].delete_many(
+        {'match_set_id': either})
+    database[tv5api.jobs.STATUS_COLLECTION].delete_many(
+        {'results_id': {'$in': results_ids}})
+    if results_cache is not None:
+        # other processes can no longer reach what they cached, since the
+        # results pairs are gone, and will evict it in time
+        for match_set_id in match_set_ids:
+            results_cache.discard_prefix('{}-'.format(match_set_id))
+    return counts
+
+
+def _remove_text_data(connection, text_id, language):
+    """Remove the tokens, units, and frequencies of a text
+
+    Returns
+    -------
+    dict
+        number of documents removed, by collection
+    """
+    database = connection.connection
+    counts = {}
+    counts['tokens'] = database[
+        tesserae.db.entities.Token.collection].delete_many(
+            {'text': text_id}).deleted_count
+    counts['units'] = database[
+        tesserae.db.entities.Unit.collection].delete_many(
+            {'text': text_id}).deleted_count
+    # features are shared by the texts of a language, so only those no
+    # other text has are removed
+    frequency = 'frequencies.{}'.format(text_id)
+    database[tesserae.db.entities.Feature.collection].update_many(
+        {frequency: {'$exists': True}}, {'$unset': {frequency: ''}})
+    counts['features'] = database[
+        tesserae.db.entities.Feature.collection].delete_many(
+            {'language': language, 'frequencies': {}}).deleted_count
+    tv5api.frequencies.remove_text_tables(connection, text_id)
+    return counts
+
+
+def run_deletion(connection, results_cache, job):
+    """Remove the data derived from a deleted text and record the counts
+
+    Parameters
+    ----------
+    connection : tesserae.db.TessMongoConnection
+    results_cache : tv5api.cache.ResultsCache, optional
+        cache from which to drop results of searches involving the text
+    job : dict
+        deletion job, as made by create_deletion
+    """
+    database = connection.connection
+    deletions = database[DELETIONS_COLLECTION]
+    deletions.update_one(
+        {'deletion_id': job['deletion_id']},
+        {'$set': {'state': tv5api.jobs.RUNNING,
+            'started': datetime.datetime.utcnow()}})
+    text_id = ObjectId(job['text_id'])
+    try:
+        # searches still to store results involving the text would leave
+        # them behind once its results are removed
+        tv5api.parallels.cancel_text_searches(connection, text_id,
+                'Text {} was deleted'.format(job['text_id']))
+        counts = _remove_results(connection, text_id, results_cache)
+        counts.update(_remove_text_data(connection, text_id, job['language']))
+    except Exception as e:
+        deletions.update_one(
+            {'deletion_id': job['deletion_id']},
+            {'$set': {'state': tv5api.jobs.FAILED, 'message': str(e),
+                'finished': datetime.datetime.utcnow()}})
+        raise
+    finally:
+        # stopwords generated from the text's frequencies are now stale
+        tv5api.cache.invalidate_version(database, 'texts')
+    deletions.update_one(
+        {'deletion_id': job['deletion_id']},
+        {'$set': {'state': tv5api.jobs.DONE, 'counts': counts,
+            'finished': datetime.datetime.utcnow()}})
+
+
+def describe_deletion(record):
+    """Report on a deletion for clients
+
+    Returns
+    -------
+    dict
+        the deletion's "deletion_id", "object_id" of the text, "title",
+        "state", and, once finished, the "counts" of documents removed by
+        collection or the error "message"
+    """
+    report = {
+        'deletion_id': record['deletion_id'],
+        'object_id': record['text_id'],
+        'title': record['title'],
+        'state': record['state'],
+    }
+    for key in ('counts', 'message'):
+        if key in record:
+            report[key] = record[key]
+    return report
@@ -0,0 +1,138 @@
+"""Content-Encoding negotiation and compression
+
+gzip is always available.  zstd and brotli are offered when the optional
+zstandard and brotli packages are installed.
+"""
+import zlib
+
+import flask
+
+import tv5api.metrics
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+IDENTITY = 'identity'
+
+# in order of preference, when the client accepts several equally
+PREFERENCE = [
+    name for name, module in (('zstd', zstandard), ('br', brotli),
+        ('gzip', zlib))
+    if module is not None
+]
+
+
+def negotiate(accept_encodings):
+    """Pick the content encoding to use for a response
+
+    Parameters
+    ----------
+    accept_encodings : werkzeug.datastructures.Accept
+        parsed Accept-Encoding header of the request
+
+    Returns
+    -------
+    str
+        one of PREFERENCE, or IDENTITY if the client accepts none of them
+    """
+    best = IDENTITY
+    best_quality = 0
+    for name in PREFERENCE:
+        quality = accept_encodings[name]
+        if quality > best_quality:
+            best = name
+            best_quality = quality
+    return best
+
+
+class _Identity:
+
+    def compress(self, data):
+        return data
+
+    def flush(self):
+        return b''
+
+
+class _Brotli:
+
+    def __init__(self, level):
+        self._compressor = brotli.Compressor(quality=level)
+
+    def compress(self, data):
+        return self._compressor.process(data)
+
+    def flush(self):
+        return self._compressor.finish()
+
+
+def compressor(encoding, level):
+    """Make an incremental compressor for `encoding`
+
+    Parameters
+    ----------
+    encoding : str
+        one of PREFERENCE or IDENTITY
+    level : int
+        compression level, on the scale of the chosen encoding
+
+    Returns
+    -------
+    object with compress(bytes) and flush() methods, like zlib.compressobj
+    """
+    if encoding == 'gzip':
+        # the gzip header written by zlib carries no timestamp, so equal
+        # inputs compress to equal outputs
+        return zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    if encoding == 'zstd':
+        return zstandard.ZstdCompressor(level=level).compressobj()
+    if encoding == 'br':
+        return _Brotli(level)
+    return _Identity()
+
+
+def compress(data, encoding, level):
+    """Compress all of `data` at once; see compressor"""
+    comp = compressor(encoding, level)
+    return comp.compress(data) + comp.flush()
+
+
+def level_for(encoding):
+    """Look up the configured compression level for `encoding`"""
+    return flask.current_app.config['COMPRESSION_LEVELS'].get(encoding)
+
+
+def compress_response(response):
+    """Compress a response body with the encoding the client prefers
+
+    Responses that are streamed, already encoded, or smaller than
+    COMPRESSION_MIN_SIZE are left as they are.
+    """
+    response.vary.add('Accept-Encoding')
+    if (response.direct_passthrough or response.is_streamed
+            or 'Content-Encoding' in response.headers
+            or response.status_code < 200
+            or response.status_code in (204, 304)
+            or response.content_length is None
+            or response.content_length
+                < flask.current_app.config['COMPRESSION_MIN_SIZE']):
+        return response
+    encoding = negotiate(flask.request.accept_encodings)
+    if encoding == IDENTITY:
+        return response
+    with tv5api.metrics.stage('compress'):
+        response.set_data(compress(
+            response.get_data(), encoding, level_for(encoding)))
+    response.headers['Content-Encoding'] = encoding
+    etag, weak = response.get_etag()
+    if etag is not None:
+        # a different encoding is a different representation
+        response.set_etag('{}-{}'.format(etag, encoding), weak=weak)
+    return response
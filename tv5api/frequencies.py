@@ -0,0 +1,349 @@
+"""Precomputed feature frequency tables
+
+A text's feature frequencies change only when the text is ingested again, so
+they are counted once, when texts are added, updated, or deleted, and kept
+in the database.  Each text has one table per feature type, mapping the
+string form of a feature identifier to the number of tokens in the text
+bearing that feature.
+
+The corpus tables of each language and feature type hold the same counts
+summed over the language's texts.  They keep one document per feature, so
+that no table outgrows a document however large the corpus gets, and they
+are kept up to date by adding or taking away the counts of the one text that
+changed, with $inc, so that texts ingested at once never overwrite each
+other's counts.
+"""
+import collections
+import heapq
+
+from bson.objectid import ObjectId
+import pymongo
+
+import tesserae.db.entities
+
+FREQUENCIES_COLLECTION = 'feature_frequencies'
+CORPUS_FREQUENCIES_COLLECTION = 'corpus_frequencies'
+
+# most updates sent to the database at once
+_BATCH_SIZE = 1000
+
+
+def _count_text(database, text_id, feature):
+    """Count tokens of a text bearing each feature of type `feature`"""
+    pipeline = [
+        {'$match': {'text': text_id}},
+        {'$project': {'_id': False, 'feature': '$features.' + feature}},
+        # tokens may carry a single feature or a list of them
+        {'$unwind': '$feature'},
+        {'$group': {'_id': '$feature', 'count': {'$sum': 1}}},
+    ]
+    return {
+        str(doc['_id']): doc['count']
+        for doc in database[tesserae.db.entities.Token.collection].aggregate(
+            pipeline, allowDiskUse=True)
+        if doc['_id'] is not None
+    }
+
+
+def _feature_types(database, text_id):
+    """List the feature types the tokens of a text carry"""
+    token = database[tesserae.db.entities.Token.collection].find_one(
+        {'text': text_id}, {'features': True})
+    if token is None or not token.get('features'):
+        return []
+    return sorted(token['features'])
+
+
+def _store(database, text_id, language, feature, counts):
+    """Store the table of a text, returning the one it replaces, if any"""
+    return database[FREQUENCIES_COLLECTION].find_one_and_replace(
+        {'text': text_id, 'feature': feature},
+        {
+            'text': text_id,
+            'language': language,
+            'feature': feature,
+            'counts': counts,
+            'total': sum(counts.values()),
+        },
+        upsert=True)
+
+
+def _add_to_corpus(database, language, feature, counts, sign=1):
+    """Add the counts of a text to the corpus tables, or take them away
+
+    Parameters
+    ----------
+    database : pymongo.database.Database
+    language : str
+    feature : str
+    counts : dict
+        a text's table
+    sign : int
+        1 to add the counts, -1 to take them away
+    """
+    updates = [
+        pymongo.UpdateOne(
+            {'language': language, 'feature': feature, 'value': value},
+            {'$inc': {'count': sign * count}},
+            upsert=True)
+        for value, count in counts.items()
+    ]
+    for start in range(0, len(updates), _BATCH_SIZE):
+        database[CORPUS_FREQUENCIES_COLLECTION].bulk_write(
+            updates[start:start + _BATCH_SIZE], ordered=False)
+    if sign < 0:
+        database[CORPUS_FREQUENCIES_COLLECTION].delete_many({
+            'language': language,
+            'feature': feature,
+            'value': {'$in': list(counts)},
+            'count': {'$lte': 0},
+        })
+
+
+def rebuild_corpus_tables(connection, language):
+    """Recompute the corpus tables of `language` from the text tables
+
+    Reads every text table of the language, so this is only for repairing
+    corpus tables, as after backfilling text tables; ingesting and deleting
+    texts keeps them up to date.
+
+    Parameters
+    ----------
+    connection : tesserae.db.TessMongoConnection
+    language : str
+    """
+    database = connection.connection
+    totals = collections.defaultdict(collections.Counter)
+    for table in database[FREQUENCIES_COLLECTION].find(
+            {'text': {'$ne': None}, 'language': language}):
+        totals[table['feature']].update(table['counts'])
+    database[CORPUS_FREQUENCIES_COLLECTION].delete_many(
+        {'language': language})
+    # corpus tables were once single documents among the text tables
+    database[FREQUENCIES_COLLECTION].delete_many(
+        {'text': None, 'language': language})
+    for feature, counts in totals.items():
+        _add_to_corpus(database, language, feature, counts)
+
+
+def update_text_tables(connection, text):
+    """Recompute the tables of `text`, and update the corpus tables
+
+    Parameters
+    ----------
+    connection : tesserae.db.TessMongoConnection
+    text : tesserae.db.entities.Text
+        text whose tokens are already in the database
+    """
+    database = connection.connection
+    features = _feature_types(database, text.id)
+    for feature in features:
+        counts = _count_text(database, text.id, feature)
+        previous = _store(database, text.id, text.language, feature, counts)
+        _add_to_corpus(database, text.language, feature, counts)
+        if previous is not None:
+            _add_to_corpus(database, previous['language'], feature,
+                    previous['counts'], sign=-1)
+    _remove_tables(database, {'text': text.id, 'feature': {'$nin': features}})
+
+
+def remove_text_tables(connection, text_id):
+    """Forget the tables of a text, and take it out of the corpus tables
+
+    Parameters
+    ----------
+    connection : tesserae.db.TessMongoConnection
+    text_id : bson.objectid.ObjectId
+        text whose tables are to be forgotten
+    """
+    _remove_tables(connection.connection, {'text': text_id})
+
+
+def _remove_tables(database, query):
+    """Remove the text tables matching `query`, along with their counts"""
+    for table in database[FREQUENCIES_COLLECTION].find(query, {'_id': True}):
+        # only whichever process removes the table takes its counts away
+        removed = database[FREQUENCIES_COLLECTION].find_one_and_delete(
+            {'_id': table['_id']})
+        if removed is not None:
+            _add_to_corpus(database, removed['language'], removed['feature'],
+                    removed['counts'], sign=-1)
+
+
+def get_table(connection, feature, text_id=None, language=None):
+    """Retrieve a frequency table
+
+    Parameters
+    ----------
+    connection : tesserae.db.TessMongoConnection
+    feature : str
+        feature type, such as 'form' or 'lemmata'
+    text_id : bson.objectid.ObjectId, optional
+        text whose table is wanted
+    language : str, optional
+        language whose corpus-wide table is wanted, if text_id is not given
+
+    Returns
+    -------
+    dict or None
+        the table, with its "counts" and "total", or None if there is none
+    """
+    database = connection.connection
+    if text_id is not None:
+        return database[FREQUENCIES_COLLECTION].find_one(
+            {'feature': feature, 'text': text_id}, {'_id': False})
+    counts = _corpus_counts(database, feature, language)
+    if not counts:
+        return None
+    return {'text': None, 'language': language, 'feature': feature,
+            'counts': counts, 'total': sum(counts.values())}
+
+
+def _corpus_counts(database, feature, language=None):
+    """Read the corpus counts of `feature` in a language, or in all
+
+    Parameters
+    ----------
+    database : pymongo.database.Database
+    feature : str
+    language : str, optional
+        language whose counts are wanted; those of every language are
+        summed if not given
+
+    Returns
+    -------
+    dict
+        counts by the string form of feature identifiers
+    """
+    query = {'feature': feature}
+    if language is not None:
+        query['language'] = language
+    totals = collections.Counter()
+    for doc in database[CORPUS_FREQUENCIES_COLLECTION].find(
+            query, {'_id': False, 'value': True, 'count': True}):
+        totals[doc['value']] += doc['count']
+    return dict(totals)
+
+
+def _top_of_language(database, feature, language, most):
+    """Read the most frequent features of a language, through the count index
+
+    Returns
+    -------
+    counts : dict
+        the `most` most frequent features, along with any tied with the
+        last of them, by the string form of their identifiers
+    exhausted : bool
+        whether these are all the language's features
+    """
+    collection = database[CORPUS_FREQUENCIES_COLLECTION]
+    query = {'language': language, 'feature': feature}
+    projection = {'_id': False, 'value': True, 'count': True}
+    top = list(collection.find(query, projection).sort(
+        'count', pymongo.DESCENDING).limit(most))
+    if len(top) < most:
+        return {doc['value']: doc['count'] for doc in top}, True
+    query['count'] = {'$gte': top[-1]['count']}
+    return {
+        doc['value']: doc['count']
+        for doc in collection.find(query, projection)
+    }, False
+
+
+def _top_of_texts(database, feature, text_ids, most):
+    """Sum the tables of some texts in MongoDB, keeping the most frequent
+
+    Returns
+    -------
+    counts : dict
+        the `most` most frequent features, along with any tied with the
+        last of them, by the string form of their identifiers
+    exhausted : bool
+        whether these are all the texts' features
+    """
+    summed = [
+        {'$match': {'feature': feature, 'text': {'$in': text_ids}}},
+        {'$project': {'_id': False, 'counts': {'$objectToArray': '$counts'}}},
+        {'$unwind': '$counts'},
+        {'$group': {'_id': '$counts.k', 'count': {'$sum': '$counts.v'}}},
+    ]
+    collection = database[FREQUENCIES_COLLECTION]
+    top = list(collection.aggregate(
+        summed + [{'$sort': {'count': -1}}, {'$limit': most}],
+        allowDiskUse=True))
+    if len(top) == most:
+        top = collection.aggregate(
+            summed + [{'$match': {'count': {'$gte': top[-1]['count']}}}],
+            allowDiskUse=True)
+    counts = {doc['_id']: doc['count'] for doc in top}
+    return counts, len(counts) < most
+
+
+def most_frequent(connection, feature, count, text_ids=None, language=None):
+    """Find the most frequent features of some texts, a language, or all
+
+    The tables of the texts, or of the corpus, are summed and ranked in the
+    database, so that neither tokens nor whole tables need be read; only the
+    most frequent features are looked up by their tokens.
+
+    Parameters
+    ----------
+    connection : tesserae.db.TessMongoConnection
+    feature : str
+        feature type, such as 'form' or 'lemmata'
+    count : int
+        most features to report
+    text_ids : list of bson.objectid.ObjectId, optional
+        texts whose features are counted
+    language : str, optional
+        if text_ids is not given, language whose corpus is counted; the
+        whole corpus is counted if neither is given
+
+    Returns
+    -------
+    list of (str, int)
+        tokens of the most frequent features and their frequencies, most
+        frequent first; ties are broken by token
+    """
+    if count <= 0:
+        return []
+    database = connection.connection
+    if text_ids is None and language is None:
+        languages = sorted(database[CORPUS_FREQUENCIES_COLLECTION].distinct(
+            'language', {'feature': feature}))
+    else:
+        languages = [language]
+    most = count
+    while True:
+        if text_ids is not None:
+            totals, exhausted = _top_of_texts(
+                database, feature, text_ids, most)
+        else:
+            totals, exhausted = {}, True
+            for name in languages:
+                counts, done = _top_of_language(
+                    database, feature, name, most)
+                totals.update(counts)
+                exhausted = exhausted and done
+        ids = [ObjectId(i) for i in totals]
+        tokens = {
+            str(doc['_id']): doc['token']
+            for doc in database[tesserae.db.entities.Feature.collection].find(
+                {'_id': {'$in': ids}}, {'token': True})
+        }
+        # features of different languages may share a token, leaving fewer
+        # tokens than features; they are only merged among the most
+        # frequent features of each language
+        by_token = collections.Counter()
+        for i, n in totals.items():
+            by_token[tokens.get(i, i)] += n
+        if len(by_token) >= count or exhausted:
+            return heapq.nsmallest(
+                count, by_token.items(), key=lambda t: (-t[1], t[0]))
+        most *= 2
+
+
+def texts_with_tables(connection, feature, text_ids):
+    """Pick out which of `text_ids` have a table for `feature`"""
+    return set(connection.connection[FREQUENCIES_COLLECTION].distinct(
+        'text', {'feature': feature, 'text': {'$in': text_ids}}))
@@ -0,0 +1,230 @@
+"""Indexes the API's queries rely on, and reports on queries that lack them
+
+The indexes are declared in INDEXES and created, where missing, by the
+"flask ensure-indexes" command.  When the application starts, it creates
+only those of STARTUP_INDEXES, on collections small enough to index in
+moments; building indexes on the tokens, units, and matches of a populated
+database could hold up a worker's startup for long enough to time it out.
+With MONGO_PROFILE_SLOW_MS set, MongoDB's profiler records operations that
+are slow or scan whole collections, and "flask slow-queries" summarizes
+them.
+"""
+import pymongo.errors
+
+import tv5api.deletion
+import tv5api.frequencies
+import tv5api.ingestion
+import tv5api.jobs
+import tv5api.parallels
+import tv5api.profiling
+import tesserae.db.entities
+
+# (collection, keys, options) of every index the API relies on
+INDEXES = [
+    # filtering on language and year; sorting and paging by author, title,
+    # or year
+    (tesserae.db.entities.Text.collection,
+        [('language', 1), ('year', 1)], {}),
+    (tesserae.db.entities.Text.collection,
+        [('author', 1), ('_id', 1)], {}),
+    (tesserae.db.entities.Text.collection,
+        [('title', 1), ('_id', 1)], {}),
+    (tesserae.db.entities.Text.collection,
+        [('year', 1), ('_id', 1)], {}),
+    (tesserae.db.entities.Text.collection,
+        [('is_prose', 1)], {}),
+    (tesserae.db.entities.ResultsPair.collection,
+        [('results_id', 1)], {}),
+    (tesserae.db.entities.ResultsPair.collection,
+        [('match_set_id', 1)], {}),
+    (tesserae.db.entities.StopwordsList.collection,
+        [('name', 1)], {}),
+    # reading results filtered and sorted by score, or paged in _id order;
+    # see tv5api.results.SORTS and PAGE_ORDER
+    (tesserae.db.entities.Match.collection,
+        [('match_set', 1), ('score', 1), ('_id', 1)], {}),
+    (tesserae.db.entities.Match.collection,
+        [('match_set', 1), ('_id', 1)], {}),
+    # counting feature frequencies, and removing the tokens, units, and
+    # results of deleted texts
+    (tesserae.db.entities.Token.collection,
+        [('text', 1)], {}),
+    (tesserae.db.entities.Unit.collection,
+        [('text', 1)], {}),
+    (tesserae.db.entities.MatchSet.collection,
+        [('texts', 1)], {}),
+    (tv5api.jobs.STATUS_COLLECTION,
+        [('results_id', 1)], {'unique': True}),
+    (tv5api.jobs.STATUS_COLLECTION,
+        [('leader', 1)], {'sparse': True}),
+    # sweeping up abandoned flights; landed flights hold no lease
+    (tv5api.jobs.FLIGHTS_COLLECTION,
+        [('lease', 1)], {'sparse': True}),
+    (tv5api.parallels.BATCHES_COLLECTION,
+        [('batch_id', 1)], {'unique': True}),
+    (tv5api.deletion.DELETIONS_COLLECTION,
+        [('deletion_id', 1)], {'unique': True}),
+    (tv5api.ingestion.INGESTS_COLLECTION,
+        [('batch_id', 1)], {'unique': True}),
+    (tv5api.profiling.PROFILES_COLLECTION,
+        [('profile_id', 1)], {'unique': True}),
+    (tv5api.frequencies.FREQUENCIES_COLLECTION,
+        [('text', 1), ('language', 1), ('feature', 1)], {'unique': True}),
+    # updating corpus counts, and reading a language's most frequent
+    # features
+    (tv5api.frequencies.CORPUS_FREQUENCIES_COLLECTION,
+        [('language', 1), ('feature', 1), ('value', 1)], {'unique': True}),
+    (tv5api.frequencies.CORPUS_FREQUENCIES_COLLECTION,
+        [('language', 1), ('feature', 1), ('count', -1)], {}),
+]
+
+# collections that only "flask ensure-indexes" indexes
+LARGE_COLLECTIONS = {
+    tesserae.db.entities.Match.collection,
+    tesserae.db.entities.Token.collection,
+    tesserae.db.entities.Unit.collection,
+}
+
+STARTUP_INDEXES = [
+    index for index in INDEXES if index[0] not in LARGE_COLLECTIONS]
+
+# codes of the errors MongoDB reports for an index on the same keys, or of
+# the same name, but with different options
+_CONFLICT_CODES = {
+    85,  # IndexOptionsConflict
+    86,  # IndexKeySpecsConflict
+}
+# code of the error for lacking the privileges for a command
+_UNAUTHORIZED = 13
+
+PROFILE_COLLECTION = 'system.profile'
+
+
+def missing_indexes(database, indexes=None):
+    """List the declared indexes that do not exist yet
+
+    Parameters
+    ----------
+    database : pymongo.database.Database
+    indexes : list of tuple, optional
+        indexes in the form of INDEXES; INDEXES if not given
+
+    Returns
+    -------
+    list of tuple
+    """
+    if indexes is None:
+        indexes = INDEXES
+    existing = {}
+    missing = []
+    for collection, keys, options in indexes:
+        if collection not in existing:
+            existing[collection] = {
+                tuple(tuple(k) for k in info['key'])
+                for info in database[collection].index_information().values()
+            }
+        if tuple(keys) not in existing[collection]:
+            missing.append((collection, keys, options))
+    return missing
+
+
+def ensure_indexes(database, indexes=None):
+    """Create whichever declared indexes are missing
+
+    Parameters
+    ----------
+    database : pymongo.database.Database
+    indexes : list of tuple, optional
+        indexes in the form of INDEXES; INDEXES if not given
+
+    Returns
+    -------
+    created : list of tuple
+        the indexes that were created
+    conflicts : list of tuple
+        the indexes that could not be created because an index on the same
+        keys but with different options already exists
+
+    Raises
+    ------
+    pymongo.errors.OperationFailure
+        if an index could not be created for any other reason, such as
+        lacking the privileges to create it
+    """
+    created = []
+    conflicts = []
+    for collection, keys, options in missing_indexes(database, indexes):
+        try:
+            database[collection].create_index(keys, **options)
+        except pymongo.errors.OperationFailure as e:
+            if e.code not in _CONFLICT_CODES:
+                raise
+            conflicts.append((collection, keys, options))
+            continue
+        created.append((collection, keys, options))
+    return created, conflicts
+
+
+def enable_profiling(database, slow_ms):
+    """Have MongoDB record operations that are slow or scan collections
+
+    Parameters
+    ----------
+    database : pymongo.database.Database
+    slow_ms : int
+        operations taking at least this many milliseconds are recorded
+    """
+    try:
+        database.command('profile', 1, slowms=slow_ms, filter={'$or': [
+            {'millis': {'$gte': slow_ms}},
+            {'planSummary': {'$regex': 'COLLSCAN'}},
+        ]})
+    except pymongo.errors.OperationFailure as e:
+        if e.code == _UNAUTHORIZED:
+            raise
+        # servers before 4.4 cannot filter, so only slow operations are
+        # recorded
+        database.command('profile', 1, slowms=slow_ms)
+
+
+def slow_queries(database, since=None):
+    """Summarize the operations the profiler has recorded
+
+    Parameters
+    ----------
+    database : pymongo.database.Database
+    since : datetime.datetime, optional
+        if given, leave out operations recorded before this
+
+    Returns
+    -------
+    list of dict
+        one summary per collection, kind of operation, query plan, and
+        query shape, with the most time-consuming first; each holds "ns",
+        "op", "plan", "count", "total_ms", "max_ms", and an "example"
+        command
+    """
+    query = {'ns': {'$not': {'$regex': r'\.system\.'}}}
+    if since is not None:
+        query['ts'] = {'$gte': since}
+    summaries = {}
+    for entry in database[PROFILE_COLLECTION].find(query):
+        key = (entry.get('ns'), entry.get('op'), entry.get('planSummary'),
+                entry.get('queryHash'))
+        summary = summaries.get(key)
+        if summary is None:
+            summary = summaries[key] = {
+                'ns': key[0],
+                'op': key[1],
+                'plan': key[2],
+                'count': 0,
+                'total_ms': 0,
+                'max_ms': 0,
+                'example': entry.get('command', entry.get('query')),
+            }
+        summary['count'] += 1
+        summary['total_ms'] += entry.get('millis', 0)
+        summary['max_ms'] = max(summary['max_ms'], entry.get('millis', 0))
+    return sorted(
+        summaries.values(), key=lambda s: s['total_ms'], reverse=True)
+
@@ -0,0 +1,186 @@
+"""Ingesting batches of texts in the background
+
+Each text of a batch becomes a job of its own, so that the texts of a batch
+are ingested in parallel, as many at once as the ingest queue has workers.
+The progress of every text is kept on the batch's record in the database.
+"""
+import datetime
+import logging
+import uuid
+
+import tv5api
+import tv5api.cache
+import tv5api.frequencies
+import tv5api.jobs
+import tesserae.db.entities
+import tesserae.utils
+
+INGESTS_COLLECTION = 'ingest_batches'
+
+logger = logging.getLogger(__name__)
+
+
+def create_batch(connection, records):
+    """Record a new batch of texts to ingest
+
+    Parameters
+    ----------
+    connection : pymongo.database.Database
+    records : list of dict
+        text metadata, as accepted by POST /texts/
+
+    Returns
+    -------
+    batch_id : str
+    jobs : list of dict
+        one ingest job per text, ready to be queued
+    """
+    batch_id = uuid.uuid4().hex
+    connection[INGESTS_COLLECTION].insert_one({
+        'batch_id': batch_id,
+        'submitted': datetime.datetime.utcnow(),
+        'texts': [
+            {
+                'author': record['author'],
+                'title': record['title'],
+                'state': tv5api.jobs.QUEUED,
+            }
+            for record in records
+        ],
+    })
+    return batch_id, [
+        {'batch_id': batch_id, 'index': i, 'record': record}
+        for i, record in enumerate(records)
+    ]
+
+
+def _record_progress(connection, job, state, only_if=None, **fields):
+    """Update the entry of a job's text on its batch record
+
+    Returns whether the entry was updated.
+    """
+    prefix = 'texts.{}.'.format(job['index'])
+    fields['state'] = state
+    fields[
+        'started' if state == tv5api.jobs.RUNNING else 'finished'
+    ] = datetime.datetime.utcnow()
+    query = {'batch_id': job['batch_id']}
+    if only_if is not None:
+        query[prefix + 'state'] = {'$in': list(only_if)}
+    result = connection[INGESTS_COLLECTION].update_one(
+        query, {'$set': {prefix + k: v for k, v in fields.items()}})
+    return result.matched_count == 1
+
+
+def run_ingest(connection, job):
+    """Ingest one text of a batch and record the outcome
+
+    Parameters
+    ----------
+    connection : tesserae.db.TessMongoConnection
+    job : dict
+        ingest job, as made by create_batch
+    """
+    database = connection.connection
+    if not _record_progress(database, job, tv5api.jobs.RUNNING,
+            only_if=(tv5api.jobs.QUEUED,)):
+        return
+    insert_id = None
+    try:
+        insert_id = tesserae.utils.ingest_text(
+            connection, tesserae.db.entities.Text(**job['record']))
+        text = connection.find(
+            tesserae.db.entities.Text.collection, _id=insert_id)[0]
+        tv5api.frequencies.update_text_tables(connection, text)
+        _record_progress(database, job, tv5api.jobs.DONE,
+                object_id=str(insert_id))
+    except Exception as e:
+        logger.exception('Ingest failed: %r', job)
+        if insert_id is None:
+            _record_progress(database, job, tv5api.jobs.FAILED,
+                    message='Could not add to database: {}'.format(e))
+        else:
+            # the text is in the database, and can be removed through its id
+            _record_progress(database, job, tv5api.jobs.FAILED,
+                    object_id=str(insert_id),
+                    message='Added to database, but could not finish: '
+                    '{}'.format(e))
+    finally:
+        # even a failed ingest may have left part of the text behind
+        tv5api.cache.invalidate_version(database, 'texts')
+
+
+def run_ingest_in_process(config, job):
+    """Ingest one text of a batch in a fresh process
+
+    Parameters
+    ----------
+    config : dict
+        application configuration, for connecting to the database
+    job : dict
+        ingest job, as made by create_batch
+    """
+    run_ingest(tv5api.create_connection(config), job)
+
+
+def supervise_ingest(connection, runner, job):
+    """Run an ingest job through `runner`
+
+    Failures the job cannot record itself, such as its process dying or
+    running over the runner's time limit, are recorded here.
+
+    Parameters
+    ----------
+    connection : tesserae.db.TessMongoConnection
+    runner : tv5api.jobs.ProcessRunner
+    job : dict
+        ingest job, as made by create_batch
+    """
+    try:
+        runner(job)
+    except (tv5api.jobs.JobStopped, ChildProcessError) as e:
+        _record_progress(connection.connection, job, tv5api.jobs.FAILED,
+                only_if=(tv5api.jobs.QUEUED, tv5api.jobs.RUNNING),
+                message=str(e))
+        raise
+
+
+def describe_batch(batch):
+    """Summarize the progress of an ingest batch
+
+    Parameters
+    ----------
+    batch : dict
+        batch record, as stored by create_batch
+
+    Returns
+    -------
+    dict
+        the batch's "batch_id", overall "state" and "percent" finished, the
+        "counts" of texts in each state, and the entries of its "texts"
+    """
+    texts = []
+    counts = {}
+    for text in batch['texts']:
+        entry = {
+            k: v for k, v in text.items()
+            if k in ('author', 'title', 'state', 'object_id', 'message')
+        }
+        counts[text['state']] = counts.get(text['state'], 0) + 1
+        texts.append(entry)
+    finished = counts.get(tv5api.jobs.DONE, 0) + \
+        counts.get(tv5api.jobs.FAILED, 0)
+    if finished == len(texts):
+        state = tv5api.jobs.DONE
+    elif counts.get(tv5api.jobs.QUEUED, 0) == len(texts):
+        state = tv5api.jobs.QUEUED
+    else:
+        state = tv5api.jobs.RUNNING
+    return {
+        'batch_id': batch['batch_id'],
+        'state': state,
+        'percent': 100 * finished // len(texts) if texts else 100,
+        'counts': counts,
+        'texts': texts,
+    }
+
@@ -0,0 +1,682 @@
+"""Background execution of long-running jobs
+
+Jobs are plain dicts.  They are handed to a backend, which holds them until
+one of the worker threads of a JobQueue picks them up and passes them to the
+queue's job runner.  Progress is reported through status records kept in the
+database, so that any worker process can answer questions about a job.
+"""
+import collections
+import datetime
+import json
+import logging
+import multiprocessing
+import os
+import queue
+import threading
+import time
+
+import pymongo.errors
+
+STATUS_COLLECTION = 'search_status'
+FLIGHTS_COLLECTION = 'search_flights'
+
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+CANCELLED = 'cancelled'
+
+logger = logging.getLogger(__name__)
+
+
+class QueueFull(Exception):
+    """Raised when a job queue cannot take on more jobs"""
+
+
+class JobStopped(Exception):
+    """Raised when a job is stopped before it could finish"""
+
+
+class JobCancelled(JobStopped):
+    """Raised when a job is stopped because it was cancelled"""
+
+
+class JobTimeout(JobStopped):
+    """Raised when a job is stopped for running longer than allowed"""
+
+
+class InProcessBackend:
+    """Hold pending jobs in a process-local queue"""
+
+    def __init__(self):
+        self._queue = queue.Queue()
+        # jobs pending in the parent are the parent's to run
+        os.register_at_fork(after_in_child=self._reset)
+
+    def _reset(self):
+        self._queue = queue.Queue()
+
+    def put(self, job):
+        self._queue.put(job)
+
+    def get(self, timeout=None):
+        """Return the next job, or None if none arrived within `timeout`"""
+        try:
+            return self._queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def qsize(self):
+        return self._queue.qsize()
+
+
+class LocalBroker:
+    """In-memory stand-in for an external message broker
+
+    Messages are serialized to JSON on publish and deserialized on consume, so
+    that jobs sent through this broker are held to the same constraints they
+    would be held to with a networked broker.
+    """
+
+    def __init__(self):
+        self._reset()
+        # like a networked broker, a forked child does not get the parent's
+        # messages
+        os.register_at_fork(after_in_child=self._reset)
+
+    def _reset(self):
+        self._queues = collections.defaultdict(collections.deque)
+        self._cond = threading.Condition()
+
+    def publish(self, queue_name, message):
+        with self._cond:
+            self._queues[queue_name].append(json.dumps(message))
+            self._cond.notify()
+
+    def consume(self, queue_name, timeout=None):
+        """Pop the oldest message on `queue_name`
+
+        Returns None if no message arrived within `timeout` seconds.
+        """
+        with self._cond:
+            if not self._cond.wait_for(
+                    lambda: self._queues[queue_name], timeout=timeout):
+                return None
+            return json.loads(self._queues[queue_name].popleft())
+
+    def size(self, queue_name):
+        with self._cond:
+            return len(self._queues[queue_name])
+
+
+class BrokerBackend:
+    """Exchange jobs through a named queue on a message broker"""
+
+    def __init__(self, broker, queue_name):
+        self.broker = broker
+        self.queue_name = queue_name
+
+    def put(self, job):
+        self.broker.publish(self.queue_name, job)
+
+    def get(self, timeout=None):
+        return self.broker.consume(self.queue_name, timeout=timeout)
+
+    def qsize(self):
+        return self.broker.size(self.queue_name)
+
+
+def make_backend(name, queue_name):
+    """Build the job backend registered under `name`
+
+    Parameters
+    ----------
+    name : str
+        either 'inprocess' or 'local_broker'
+    queue_name : str
+        name of the broker queue to use, for broker backends
+
+    Raises
+    ------
+    ValueError
+        if `name` is not a recognized backend
+    """
+    if name == 'inprocess':
+        return InProcessBackend()
+    if name == 'local_broker':
+        return BrokerBackend(LocalBroker(), queue_name)
+    raise ValueError('Unrecognized job queue backend: {}'.format(name))
+
+
+def _run_limited(target, memory_limit, job):
+    if memory_limit is not None:
+        # imported here since the resource module is not available everywhere
+        import resource
+        resource.setrlimit(resource.RLIMIT_AS, (memory_limit, memory_limit))
+    target(job)
+
+
+class ProcessRunner:
+    """Run each job in a child process of its own
+
+    A job that runs in its own process neither competes with request
+    handling for the GIL nor keeps any memory it used once it finishes, and
+    it can be stopped at any moment by terminating the process.
+
+    Parameters
+    ----------
+    target : callable
+        called with the job in the child process; it must be picklable, so
+        a module-level function or a functools.partial of one
+    start_method : str
+        multiprocessing start method; 'spawn' and 'forkserver' keep the child
+        from inheriting the parent's database connections
+    time_limit : float, optional
+        seconds a job may run before it is stopped
+    memory_limit : int, optional
+        bytes of address space a job may use; allocations beyond it raise
+        MemoryError in the child
+    poll_interval : float
+        seconds between checks on whether a running job should be stopped
+    """
+
+    def __init__(self, target, start_method='spawn', time_limit=None,
+            memory_limit=None, poll_interval=1.0):
+        self.target = target
+        self.time_limit = time_limit
+        self.memory_limit = memory_limit
+        self.poll_interval = poll_interval
+        self._context = multiprocessing.get_context(start_method)
+
+    def __call__(self, job, should_stop=None):
+        """Run `job` and wait for it to finish
+
+        Parameters
+        ----------
+        job
+            job to pass to the target; it must be picklable
+        should_stop : callable, optional
+            polled while the job runs; the job is stopped once it returns
+            True
+
+        Raises
+        ------
+        JobCancelled
+            if the job was stopped because should_stop returned True
+        JobTimeout
+            if the job was stopped for running longer than time_limit
+        ChildProcessError
+            if the child process exited unsuccessfully
+        """
+        process = self._context.Process(
+            target=_run_limited, args=(self.target, self.memory_limit, job),
+            daemon=True)
+        started = time.monotonic()
+        process.start()
+        while True:
+            process.join(self.poll_interval)
+            if process.exitcode is not None:
+                break
+            if self.time_limit is not None and \
+                    time.monotonic() - started > self.time_limit:
+                _stop(process)
+                raise JobTimeout(
+                    'Job ran longer than {} seconds'.format(self.time_limit))
+            if should_stop is not None and should_stop():
+                _stop(process)
+                raise JobCancelled('Job was cancelled')
+        if process.exitcode != 0:
+            raise ChildProcessError(
+                'Job process exited with code {}'.format(process.exitcode))
+
+
+def _stop(process):
+    process.terminate()
+    process.join(5)
+    if process.exitcode is None:
+        process.kill()
+        process.join()
+
+
+class JobQueue:
+    """Pool of worker threads running jobs taken from a backend
+
+    The number of workers caps how many jobs run at once; jobs submitted
+    while all workers are busy wait in the backend.
+
+    Threads do not survive a fork, so a process forked from one whose queue
+    was started, as WSGI servers fork workers from the process that created
+    the application, starts workers of its own when a job is first submitted
+    to it.
+
+    Parameters
+    ----------
+    backend
+        object with put(job), get(timeout) and qsize() methods
+    run_job : callable
+        called with each job in one of the worker threads
+    workers : int
+        number of worker threads
+    max_pending : int, optional
+        most jobs allowed to wait for a worker; unlimited if not given
+    heartbeat : callable, optional
+        called every `heartbeat_interval` seconds, from a thread of its own,
+        with the list of jobs submitted to this queue that have yet to
+        finish, whether waiting or running
+    heartbeat_interval : float
+    """
+
+    def __init__(self, backend, run_job, workers=1, max_pending=None,
+            heartbeat=None, heartbeat_interval=10.0):
+        self.backend = backend
+        self.run_job = run_job
+        self.workers = workers
+        self.max_pending = max_pending
+        self.heartbeat = heartbeat
+        self.heartbeat_interval = heartbeat_interval
+        self._started = False
+        self._stopping = threading.Event()
+        self._reset()
+        os.register_at_fork(after_in_child=self._reset)
+
+    def _reset(self):
+        """Forget the workers and jobs of the process this one forked from"""
+        self._pid = None
+        self._threads = []
+        # a lock held by another thread while forking stays held in the
+        # child, where no thread will ever release it
+        self._start_lock = threading.Lock()
+        self._submit_lock = threading.Lock()
+        # unfinished jobs, told apart by their JSON form, since backends may
+        # hand workers copies of what was submitted
+        self._held = collections.Counter()
+        self._held_lock = threading.Lock()
+
+    def start(self):
+        """Start the workers of this process"""
+        self._stopping.clear()
+        self._started = True
+        self._ensure_workers()
+
+    def _ensure_workers(self):
+        pid = os.getpid()
+        if not self._started or self._pid == pid:
+            return
+        with self._start_lock:
+            if self._pid == pid:
+                return
+            self._start_threads()
+            self._pid = pid
+
+    def _start_threads(self):
+        for i in range(self.workers):
+            thread = threading.Thread(
+                target=self._work, name='tv5api-worker-{}'.format(i),
+                daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        if self.heartbeat is not None:
+            thread = threading.Thread(
+                target=self._beat, name='tv5api-heartbeat', daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def submit(self, job):
+        """Hand `job` to the backend to be run by the next free worker
+
+        Raises
+        ------
+        QueueFull
+            if max_pending jobs are already waiting
+        """
+        self._ensure_workers()
+        with self._submit_lock:
+            if self.full():
+                raise QueueFull('{} jobs are already waiting'.format(
+                    self.max_pending))
+            self._hold(job, 1)
+            self.backend.put(job)
+
+    def held(self):
+        """List the jobs submitted here that have yet to finish"""
+        with self._held_lock:
+            return [json.loads(key) for key in self._held]
+
+    def _hold(self, job, count):
+        key = json.dumps(job, sort_keys=True)
+        with self._held_lock:
+            self._held[key] += count
+            if self._held[key] <= 0:
+                del self._held[key]
+
+    def full(self):
+        """Whether the queue has room for no more jobs"""
+        return not self.has_room(1)
+
+    def has_room(self, count):
+        """Whether `count` more jobs could be submitted right now"""
+        return (self.max_pending is None
+                or self.backend.qsize() + count <= self.max_pending)
+
+    def pending(self):
+        """Number of jobs waiting for a worker"""
+        return self.backend.qsize()
+
+    def shutdown(self, wait=True):
+        """Stop the workers once they finish their current jobs"""
+        self._started = False
+        self._stopping.set()
+        if wait:
+            for thread in self._threads:
+                thread.join()
+        self._threads = []
+        self._pid = None
+
+    def _work(self):
+        while not self._stopping.is_set():
+            job = self.backend.get(timeout=0.1)
+            if job is None:
+                continue
+            try:
+                self.run_job(job)
+            except Exception:
+                logger.exception('Job failed: %r', job)
+            finally:
+                self._hold(job, -1)
+
+    def _beat(self):
+        while not self._stopping.wait(self.heartbeat_interval):
+            try:
+                self.heartbeat(self.held())
+            except Exception:
+                logger.exception('Job queue heartbeat failed')
+
+
+def _now():
+    return datetime.datetime.utcnow()
+
+
+def record_status(connection, results_id, state, only_if=None, **fields):
+    """Create or update the status record for `results_id`
+
+    The time at which the job was queued, started running, and finished are
+    noted on the record as the job passes through those states.
+
+    Parameters
+    ----------
+    connection : pymongo.database.Database
+        database in which status records are kept
+    results_id : str
+        identifier of the job
+    state : str
+        one of QUEUED, RUNNING, DONE, FAILED, or CANCELLED
+    only_if : collection of str, optional
+        if given, the record is updated only if it is currently in one of
+        these states, and no record is created
+    **fields
+        any other values to store on the record, such as stage, percent, or
+        match_count
+
+    Returns
+    -------
+    bool
+        whether the record was created or updated
+    """
+    now = _now()
+    fields['state'] = state
+    fields['updated'] = now
+    update = {'$set': fields}
+    if state == QUEUED:
+        fields['submitted'] = now
+    elif state == RUNNING:
+        # only the first transition to RUNNING counts as the start
+        update['$min'] = {'started': now}
+    else:
+        fields['finished'] = now
+    query = {'results_id': results_id}
+    if only_if is not None:
+        query['state'] = {'$in': list(only_if)}
+    result = connection[STATUS_COLLECTION].update_one(
+        query,
+        update,
+        upsert=only_if is None)
+    return result.matched_count == 1 or result.upserted_id is not None
+
+
+def discard_status(connection, results_id):
+    """Forget the status record for `results_id`"""
+    connection[STATUS_COLLECTION].delete_one({'results_id': results_id})
+
+
+def get_status(connection, results_id, follow=True):
+    """Retrieve the status record for `results_id`, or None if there is none
+
+    Unless `follow` is False, a job still waiting on an identical job (see
+    claim_flight) reports the progress of the job it is waiting on.
+    """
+    record = connection[STATUS_COLLECTION].find_one(
+        {'results_id': results_id}, {'_id': False})
+    if not follow or record is None or record['state'] != QUEUED \
+            or 'leader' not in record:
+        return record
+    leader = connection[STATUS_COLLECTION].find_one(
+        {'results_id': record['leader']}, {'_id': False})
+    if leader is None or leader['state'] not in (QUEUED, RUNNING):
+        return record
+    leader['results_id'] = results_id
+    return leader
+
+
+def claim_flight(connection, flight_key, results_id, lease=60):
+    """Make `results_id` the run for `flight_key`, unless another run is
+
+    Jobs that would compute the same thing share a flight key.  The first job
+    to claim a key leads the flight and is the only one that actually runs;
+    later jobs follow it and take on its outcome.
+
+    A leader holds its flight for `lease` seconds, and must renew the lease
+    with renew_flights until it lands the flight.  A running flight whose
+    lease has lapsed, or whose leader has no status record or has already
+    finished, was abandoned, as by a worker process that died: it is taken
+    over, its leader is recorded as failed, and the jobs following it follow
+    the new leader instead.
+
+    Parameters
+    ----------
+    connection : pymongo.database.Database
+    flight_key : str
+        key shared by identical jobs
+    results_id : str
+        identifier of the job asking to lead; its status record must exist
+        already
+    lease : float
+        seconds the flight is held for if `results_id` leads it
+
+    Returns
+    -------
+    dict or None
+        None if `results_id` now leads the flight; otherwise the existing
+        flight record, with the leader's results_id, its state (RUNNING or
+        DONE), and, once done, whatever the leader stored with land_flight
+    """
+    abandoned = []
+    while True:
+        now = _now()
+        try:
+            connection[FLIGHTS_COLLECTION].insert_one({
+                '_id': flight_key,
+                'results_id': results_id,
+                'state': RUNNING,
+                'updated': now,
+                'lease': now + datetime.timedelta(seconds=lease),
+            })
+            flight = None
+            leader = results_id
+            break
+        except pymongo.errors.DuplicateKeyError:
+            flight = get_flight(connection, flight_key)
+            # the leader may have aborted between our insert and our find
+            if flight is None:
+                continue
+            if _is_abandoned(connection, flight):
+                if _abandon_flight(connection, flight):
+                    abandoned.append(flight['results_id'])
+                continue
+            leader = flight['results_id']
+            break
+    for lost in abandoned:
+        connection[STATUS_COLLECTION].update_many(
+            {'leader': lost, 'state': QUEUED}, {'$set': {'leader': leader}})
+    return flight
+
+
+def _is_abandoned(connection, flight):
+    if flight['state'] != RUNNING:
+        return False
+    if flight.get('lease') is None or flight['lease'] < _now():
+        return True
+    leader = get_status(connection, flight['results_id'], follow=False)
+    return leader is None or leader['state'] not in (QUEUED, RUNNING)
+
+
+def _abandon_flight(connection, flight):
+    """Remove an abandoned flight, and fail its leader
+
+    Returns whether this call removed the flight, rather than another that
+    found it abandoned too.
+    """
+    removed = connection[FLIGHTS_COLLECTION].delete_one({
+        '_id': flight['_id'],
+        'results_id': flight['results_id'],
+        'state': RUNNING,
+    })
+    if removed.deleted_count != 1:
+        return False
+    logger.warning('Flight %s of %s was abandoned', flight['_id'],
+            flight['results_id'])
+    record_status(connection, flight['results_id'], FAILED,
+            only_if=(QUEUED, RUNNING), stage=FAILED,
+            message='The search was lost before it finished; please resubmit.')
+    return True
+
+
+def renew_flights(connection, results_ids, lease=60):
+    """Extend the leases of the running flights led by `results_ids`"""
+    if not results_ids:
+        return
+    now = _now()
+    connection[FLIGHTS_COLLECTION].update_many(
+        {'results_id': {'$in': list(results_ids)}, 'state': RUNNING},
+        {'$set': {'lease': now + datetime.timedelta(seconds=lease),
+                  'updated': now}})
+
+
+def sweep_flights(connection):
+    """Remove running flights whose leases have lapsed
+
+    Their leaders, and the jobs still following them, are recorded as
+    failed, so that nothing waits on them forever.
+
+    Returns
+    -------
+    list of str
+        results_ids of the leaders of the flights removed
+    """
+    swept = []
+    lapsed = connection[FLIGHTS_COLLECTION].find(
+        {'state': RUNNING, 'lease': {'$lt': _now()}})
+    for flight in lapsed:
+        if not _abandon_flight(connection, flight):
+            continue
+        swept.append(flight['results_id'])
+        for follower in find_followers(connection, flight['results_id']):
+            if claim_follower(connection, follower):
+                record_status(connection, follower, FAILED,
+                        message='Identical search {} was lost before it '
+                        'finished; please resubmit.'.format(
+                            flight['results_id']))
+    return swept
+
+
+def get_flight(connection, flight_key):
+    """Retrieve the flight record for `flight_key`, or None if there is none"""
+    return connection[FLIGHTS_COLLECTION].find_one({'_id': flight_key})
+
+
+def land_flight(connection, flight_key, results_id, **outcome):
+    """Mark the flight for `flight_key` as done, storing `outcome` on it
+
+    Only the leader, `results_id`, lands its flight; a leader whose flight
+    was taken over lands nothing.
+
+    Returns
+    -------
+    bool
+        whether the flight was landed
+    """
+    outcome['state'] = DONE
+    outcome['updated'] = _now()
+    landed = connection[FLIGHTS_COLLECTION].update_one(
+        {'_id': flight_key, 'results_id': results_id},
+        {'$set': outcome, '$unset': {'lease': ''}})
+    return landed.matched_count == 1
+
+
+def abort_flight(connection, flight_key, results_id):
+    """Forget the flight for `flight_key`, so that the next job leads anew
+
+    Only the leader, `results_id`, aborts its flight.
+    """
+    connection[FLIGHTS_COLLECTION].delete_one(
+        {'_id': flight_key, 'results_id': results_id})
+
+
+def find_followers(connection, results_id):
+    """List results_ids of queued jobs following the job `results_id`"""
+    return [
+        record['results_id']
+        for record in connection[STATUS_COLLECTION].find(
+            {'leader': results_id, 'state': QUEUED}, {'results_id': True})
+    ]
+
+
+def claim_follower(connection, results_id):
+    """Take responsibility for finishing the following job `results_id`
+
+    Both the leader and the follower itself may try to finish a follower;
+    only the first to claim it gets True.
+    """
+    updated = connection[STATUS_COLLECTION].update_one(
+        {'results_id': results_id, 'state': QUEUED},
+        {'$set': {'state': RUNNING, 'stage': 'storing', 'percent': 90,
+                  'updated': _now()}})
+    return updated.modified_count == 1
+
+
+def describe_status(record):
+    """Summarize a status record for API clients
+
+    Parameters
+    ----------
+    record : dict
+        status record, as returned by get_status
+
+    Returns
+    -------
+    dict
+        state, stage, percent done, seconds elapsed since the job started
+        running, and the number of matches found so far
+    """
+    started = record.get('started')
+    if started is None:
+        elapsed = 0.0
+    else:
+        elapsed = ((record.get('finished') or _now()) - started).total_seconds()
+    return {
+        'results_id': record['results_id'],
+        'state': record['state'],
+        'stage': record.get('stage', record['state']),
+        'percent': record.get('percent', 0),
+        'elapsed': elapsed,
+        'match_count': record.get('match_count', 0),
+    }
@@ -0,0 +1,294 @@
+"""Timing of requests and jobs, and their report in Prometheus text format
+
+Every request is counted and timed by endpoint.  Code that wants the time
+spent in one stage of handling a request reported as well wraps that stage
+in stage(), and the stage timings of a request are sent back in its
+Server-Timing header.  Metrics are kept per process, so each worker process
+reports its own on /metrics.
+"""
+import bisect
+import contextlib
+import threading
+import time
+
+import flask
+
+bp = flask.Blueprint('metrics', __name__)
+
+# upper bounds, in seconds, of the histogram buckets for requests and for
+# the longer-running jobs
+REQUEST_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+        10.0)
+JOB_BUCKETS = (0.1, 1.0, 5.0, 15.0, 30.0, 60.0, 120.0, 300.0, 600.0, 1800.0,
+        3600.0)
+
+
+def _format_labels(names, values):
+    if not names:
+        return ''
+    return '{' + ','.join(
+        '{}="{}"'.format(n, str(v).replace('\\', '\\\\').replace('"', '\\"')
+            .replace('\n', '\\n'))
+        for n, v in zip(names, values)
+    ) + '}'
+
+
+def _format_value(value):
+    if isinstance(value, int):
+        return str(value)
+    return repr(float(value)) if value != float('inf') else '+Inf'
+
+
+class Counter:
+    """Count of events, by label values"""
+
+    kind = 'counter'
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *label_values, amount=1):
+        with self._lock:
+            self._values[label_values] = \
+                self._values.get(label_values, 0) + amount
+
+    def value(self, *label_values):
+        with self._lock:
+            return self._values.get(label_values, 0)
+
+    def samples(self):
+        with self._lock:
+            items = sorted(self._values.items())
+        for label_values, value in items:
+            yield self.name, _format_labels(self.labels, label_values), value
+
+
+class Gauge:
+    """Value read when metrics are collected, by label values
+
+    Parameters
+    ----------
+    name : str
+    documentation : str
+    labels : tuple of str
+    """
+
+    kind = 'gauge'
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._functions = {}
+        self._lock = threading.Lock()
+
+    def set_function(self, function, *label_values):
+        """Have the gauge report what `function` returns when collected"""
+        with self._lock:
+            self._functions[label_values] = function
+
+    def samples(self):
+        with self._lock:
+            items = sorted(self._functions.items(), key=lambda i: i[0])
+        for label_values, function in items:
+            yield self.name, _format_labels(self.labels, label_values), \
+                function()
+
+
+class Histogram:
+    """Distribution of observed values, by label values
+
+    Parameters
+    ----------
+    name : str
+    documentation : str
+    labels : tuple of str
+    buckets : tuple of float
+        upper bounds of the buckets, in increasing order
+    """
+
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labels=(),
+            buckets=REQUEST_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets) + (float('inf'),)
+        # counts per bucket, then the sum of observed values
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *label_values):
+        with self._lock:
+            counts = self._values.get(label_values)
+            if counts is None:
+                counts = self._values[label_values] = \
+                    [0] * len(self.buckets) + [0.0]
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            counts[-1] += value
+
+    def count(self, *label_values):
+        with self._lock:
+            counts = self._values.get(label_values)
+            return sum(counts[:-1]) if counts is not None else 0
+
+    def samples(self):
+        with self._lock:
+            items = sorted(
+                (k, list(v)) for k, v in self._values.items())
+        names = self.labels + ('le',)
+        for label_values, counts in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                yield (self.name + '_bucket',
+                    _format_labels(
+                        names, label_values + (_format_value(bound),)),
+                    cumulative)
+            labels = _format_labels(self.labels, label_values)
+            yield self.name + '_sum', labels, counts[-1]
+            yield self.name + '_count', labels, cumulative
+
+
+class Registry:
+    """Collection of metrics to report together"""
+
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        """Add `metric`, or return the one already registered by its name"""
+        with self._lock:
+            return self._metrics.setdefault(metric.name, metric)
+
+    def exposition(self):
+        """Render every metric in the Prometheus text format"""
+        with self._lock:
+            metrics = sorted(self._metrics.values(), key=lambda m: m.name)
+        lines = []
+        for metric in metrics:
+            lines.append('# HELP {} {}'.format(
+                metric.name, metric.documentation))
+            lines.append('# TYPE {} {}'.format(metric.name, metric.kind))
+            for name, labels, value in metric.samples():
+                lines.append('{}{} {}'.format(
+                    name, labels, _format_value(value)))
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+REQUESTS = REGISTRY.register(Counter(
+    'tv5api_requests_total', 'Requests handled',
+    ('endpoint', 'method', 'status')))
+REQUEST_SECONDS = REGISTRY.register(Histogram(
+    'tv5api_request_duration_seconds',
+    'Time taken to handle requests, up to sending the response body',
+    ('endpoint', 'method')))
+STAGE_SECONDS = REGISTRY.register(Histogram(
+    'tv5api_request_stage_duration_seconds',
+    'Time taken by stages of handling requests',
+    ('endpoint', 'stage')))
+QUEUE_DEPTH = REGISTRY.register(Gauge(
+    'tv5api_queue_pending_jobs', 'Jobs waiting for a worker', ('queue',)))
+JOBS = REGISTRY.register(Counter(
+    'tv5api_jobs_total', 'Jobs run', ('queue', 'outcome')))
+JOB_SECONDS = REGISTRY.register(Histogram(
+    'tv5api_job_duration_seconds', 'Time taken to run jobs', ('queue',),
+    buckets=JOB_BUCKETS))
+SEARCH_STAGE_SECONDS = REGISTRY.register(Histogram(
+    'tv5api_search_stage_duration_seconds',
+    'Time taken by stages of searches run in this process', ('stage',),
+    buckets=JOB_BUCKETS))
+
+
+@contextlib.contextmanager
+def stage(name):
+    """Time a stage of handling the current request
+
+    The time is observed by endpoint and reported in the Server-Timing
+    header of the response.  Outside of requests, nothing is recorded.
+    """
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        if flask.has_request_context() and 'timings' in flask.g:
+            elapsed = time.perf_counter() - started
+            flask.g.timings.append((name, elapsed))
+            STAGE_SECONDS.observe(elapsed, _endpoint(), name)
+
+
+def _endpoint():
+    return flask.request.endpoint or 'unknown'
+
+
+def start_timing():
+    """Note when the current request began; a before_request hook"""
+    flask.g.request_started = time.perf_counter()
+    flask.g.timings = []
+
+
+def finish_timing(response):
+    """Count and time the current request; an after_request hook
+
+    The times of the request's stages, and of the request as a whole up to
+    now, are added to the response as a Server-Timing header.
+    """
+    started = flask.g.get('request_started', None)
+    if started is None:
+        return response
+    elapsed = time.perf_counter() - started
+    endpoint = _endpoint()
+    REQUESTS.inc(endpoint, flask.request.method, response.status_code)
+    REQUEST_SECONDS.observe(elapsed, endpoint, flask.request.method)
+    response.headers['Server-Timing'] = ', '.join(
+        '{};dur={:.3f}'.format(name, seconds * 1000)
+        for name, seconds in flask.g.timings + [('total', elapsed)])
+    return response
+
+
+def timed_job(queue_name, run_job):
+    """Wrap a job runner so that its jobs are counted and timed
+
+    Parameters
+    ----------
+    queue_name : str
+        label for the metrics of the queue's jobs
+    run_job : callable
+        job runner, as given to tv5api.jobs.JobQueue
+
+    Returns
+    -------
+    callable
+        job runner that runs jobs with run_job
+    """
+    def run(job):
+        started = time.perf_counter()
+        outcome = 'failed'
+        try:
+            run_job(job)
+            outcome = 'finished'
+        finally:
+            JOB_SECONDS.observe(time.perf_counter() - started, queue_name)
+            JOBS.inc(queue_name, outcome)
+    return run
+
+
+def watch_queue(queue_name, job_queue):
+    """Report how many jobs wait in `job_queue`"""
+    QUEUE_DEPTH.set_function(job_queue.pending, queue_name)
+
+
+@bp.route('/metrics')
+def get_metrics():
+    """Report metrics in the Prometheus text format"""
+    return flask.Response(
+        REGISTRY.exposition(),
+        content_type='text/plain; version=0.0.4; charset=utf-8')
@@ -1,17 +1,33 @@
 """The family of /parallels/ endpoints"""
-import gzip
+import functools
+import hashlib
+import json
 import os
+import time
 import uuid
 
+from bson.errors import InvalidId
 from bson.objectid import ObjectId
 import flask
 
 import tesserae.db.entities
 from tesserae.matchers import AggregationMatcher
+import tv5api.cache
+import tv5api.encoding
 import tv5api.errors
+import tv5api.jobs
+import tv5api.metrics
+import tv5api.results
 
 bp = flask.Blueprint('parallels', __name__, url_prefix='/parallels')
 
+_METHOD_REQUIREDS = {
+    'original': {
+        'name', 'feature', 'stopwords', 'freq_basis', 'max_distance',
+        'distance_basis'
+    }
+}
+
 
 def _validate_units(specs, name):
     """Provide error messages if units are not specified correctly
@@ -40,22 +56,439 @@ def _validate_units(specs, name):
     return result
 
 
+def _hash_search(received, corpus_version=None):
+    """Compute a key shared by all requests for the same search
+
+    Parameters
+    ----------
+    received : dict
+        validated request data from submit_search
+    corpus_version : str, optional
+        version of the texts, for searches whose scores depend on every
+        text of the language; see _corpus_version
+
+    Returns
+    -------
+    str
+        hex digest of the canonical form of the search parameters
+    """
+    method = received['method']
+    canonical = {
+        'source': {k: received['source'][k] for k in ('object_id', 'units')},
+        'target': {k: received['target'][k] for k in ('object_id', 'units')},
+        'method': {k: method[k] for k in _METHOD_REQUIREDS[method['name']]},
+    }
+    stopwords = canonical['method']['stopwords']
+    if isinstance(stopwords, list):
+        # order and repetition do not affect the search
+        canonical['method']['stopwords'] = sorted(set(stopwords))
+    if method['freq_basis'] == 'corpus':
+        canonical['corpus_version'] = corpus_version
+    return hashlib.sha256(json.dumps(
+        canonical, sort_keys=True, separators=(',', ':')).encode()).hexdigest()
+
+
+def _link_results(connection, results_id, outcome):
+    """Point `results_id` at the results of an identical, finished search
+
+    `outcome` holds the "match_set_id" and "match_count" of those results,
+    as stored on a landed flight.
+    """
+    database = connection.connection
+    if not tv5api.jobs.claim_follower(database, results_id):
+        return
+    connection.insert(tesserae.db.entities.ResultsPair(
+        match_set_id=outcome['match_set_id'], results_id=results_id))
+    tv5api.jobs.record_status(database, results_id, tv5api.jobs.DONE,
+            stage='done', percent=100, match_count=outcome['match_count'],
+            match_set_id=outcome['match_set_id'])
+
+
+def _fail_follower(connection, results_id, message):
+    database = connection.connection
+    if tv5api.jobs.claim_follower(database, results_id):
+        tv5api.jobs.record_status(database, results_id, tv5api.jobs.FAILED,
+                message=message)
+
+
+def _discard_results(connection, job):
+    """Remove whatever results a stopped search managed to store
+
+    Besides the match set the search got as far as recording on its status,
+    any match set it left unrecorded, as when its process was stopped or
+    died while matching, is removed: a match set between the search's texts,
+    created since the search started, that no results point at.  Match sets
+    that another search between the same texts, running meanwhile, may have
+    created are left alone.
+    """
+    database = connection.connection
+    results_id = job['results_id']
+    status = tv5api.jobs.get_status(database, results_id, follow=False)
+    if status is None:
+        return
+    match_set_ids = []
+    if 'match_set_id' in status:
+        match_set_ids.append(ObjectId(status['match_set_id']))
+    if status.get('started') is not None:
+        received = job['received']
+        match_set_ids.extend(_unrecorded_match_sets(
+            database, results_id,
+            [received['source']['object_id'],
+                received['target']['object_id']],
+            status['started']))
+    if match_set_ids:
+        either = {'$in': match_set_ids + [str(i) for i in match_set_ids]}
+        database[tesserae.db.entities.Match.collection].delete_many(
+            {'match_set': either})
+        database[tesserae.db.entities.MatchSet.collection].delete_many(
+            {'_id': {'$in': match_set_ids}})
+    database[tesserae.db.entities.ResultsPair.collection].delete_many(
+        {'results_id': results_id})
+
+
+def _either_id(object_id):
+    """Match an id stored either as an ObjectId or as a string"""
+    try:
+        return {'$in': [ObjectId(object_id), str(object_id)]}
+    except (InvalidId, TypeError):
+        return str(object_id)
+
+
+def _unrecorded_match_sets(database, results_id, texts, started):
+    """List match sets that a search may have left without recording them
+
+    Parameters
+    ----------
+    database : pymongo.database.Database
+    results_id : str
+        the search that was stopped
+    texts : list of str
+        object_ids of the search's source and target
+    started : datetime.datetime
+        when the search started running
+
+    Returns
+    -------
+    list of bson.objectid.ObjectId
+    """
+    between = [{'texts': _either_id(text)} for text in texts]
+    # match sets created once another search between the same texts was
+    # running may be that search's
+    others = database[tv5api.jobs.STATUS_COLLECTION].find({
+        '$and': between,
+        'results_id': {'$ne': results_id},
+        'state': tv5api.jobs.RUNNING,
+        'started': {'$exists': True},
+    }, {'started': True})
+    until = min((other['started'] for other in others), default=None)
+    # ObjectIds only hold whole seconds
+    created = {'$gte': ObjectId.from_datetime(started.replace(microsecond=0))}
+    if until is not None:
+        created['$lt'] = ObjectId.from_datetime(until.replace(microsecond=0))
+    candidates = [
+        doc['_id'] for doc in
+        database[tesserae.db.entities.MatchSet.collection].find(
+            {'$and': between, '_id': created}, {'_id': True})
+    ]
+    if not candidates:
+        return []
+    paired = set(
+        database[tesserae.db.entities.ResultsPair.collection].distinct(
+            'match_set_id',
+            {'match_set_id': {'$in': candidates + [str(i) for i in candidates]}}))
+    return [i for i in candidates if i not in paired and str(i) not in paired]
+
+
+def _release_followers(connection, job, state, message):
+    """Let go of the searches waiting on a search that did not finish"""
+    database = connection.connection
+    tv5api.jobs.abort_flight(database, job['search_hash'], job['results_id'])
+    for follower in tv5api.jobs.find_followers(database, job['results_id']):
+        _fail_follower(connection, follower,
+                'Identical search {} {}: {}'.format(
+                    job['results_id'], state, message))
+
+
+def _fail_search(connection, job, message):
+    """Record that a search failed and clean up after it
+
+    The searches waiting on it fail too.
+    """
+    tv5api.jobs.record_status(connection.connection, job['results_id'],
+            tv5api.jobs.FAILED, only_if=(tv5api.jobs.QUEUED,
+                tv5api.jobs.RUNNING),
+            stage=tv5api.jobs.FAILED, message=message)
+    _discard_results(connection, job)
+    _release_followers(connection, job, tv5api.jobs.FAILED, message)
+
+
+def _cancel_search(connection, job, message):
+    """Record that a search was stopped and clean up after it"""
+    tv5api.jobs.record_status(connection.connection, job['results_id'],
+            tv5api.jobs.CANCELLED, only_if=(tv5api.jobs.QUEUED,
+                tv5api.jobs.RUNNING),
+            stage=tv5api.jobs.CANCELLED, message=message)
+    _discard_results(connection, job)
+    _release_followers(connection, job, tv5api.jobs.CANCELLED, message)
+
+
+def _stop_search(connection, status, message):
+    """Cancel a search if it is still queued or running
+
+    A running search is stopped and cleaned up by its worker.
+
+    Parameters
+    ----------
+    connection : tesserae.db.TessMongoConnection
+    status : dict
+        status record of the search
+    message : str
+        why the search was cancelled
+
+    Returns
+    -------
+    bool
+        whether the search was queued or running
+    """
+    if not tv5api.jobs.record_status(connection.connection,
+            status['results_id'], tv5api.jobs.CANCELLED,
+            only_if=(tv5api.jobs.QUEUED, tv5api.jobs.RUNNING),
+            stage=tv5api.jobs.CANCELLED, message=message):
+        return False
+    if status['state'] == tv5api.jobs.QUEUED and 'leader' not in status:
+        # workers skip cancelled searches, so nothing else will let go of
+        # the searches waiting on this one
+        _release_followers(connection, status, tv5api.jobs.CANCELLED,
+                message)
+    return True
+
+
+def cancel_text_searches(connection, text_id, message):
+    """Cancel the queued and running searches involving a text
+
+    Parameters
+    ----------
+    connection : tesserae.db.TessMongoConnection
+    text_id : bson.objectid.ObjectId or str
+        object_id of the text, as source or target
+    message : str
+        why the searches were cancelled
+
+    Returns
+    -------
+    list of str
+        results_ids of the searches cancelled
+    """
+    statuses = connection.connection[tv5api.jobs.STATUS_COLLECTION].find({
+        'texts': _either_id(text_id),
+        'state': {'$in': [tv5api.jobs.QUEUED, tv5api.jobs.RUNNING]},
+    })
+    return [
+        status['results_id'] for status in list(statuses)
+        if _stop_search(connection, status, message)
+    ]
+
+
+def _is_cancelled(connection, results_id):
+    status = tv5api.jobs.get_status(connection.connection, results_id,
+            follow=False)
+    return status is not None and status['state'] == tv5api.jobs.CANCELLED
+
+
+def run_search(connection, job):
+    """Run a queued search and record its outcome
+
+    Searches queued while this one ran with the same parameters are pointed
+    at its results once it finishes.
+
+    A search cancelled while it waited is skipped.  Since matching cannot be
+    interrupted from within the same process, a search cancelled while it
+    matches is only stopped once matching is over; see supervise_search for
+    stopping searches right away, and for limits on their time and memory.
+
+    Parameters
+    ----------
+    connection : tesserae.db.TessMongoConnection
+    job : dict
+        search job, as queued by _queue_search
+    """
+    database = connection.connection
+    results_id = job['results_id']
+    received = job['received']
+    search_hash = job['search_hash']
+    if not tv5api.jobs.record_status(database, results_id,
+            tv5api.jobs.RUNNING, only_if=(tv5api.jobs.QUEUED,),
+            stage='matching', percent=10):
+        return
+    started = time.monotonic()
+    try:
+        matcher = AggregationMatcher(connection)
+        received_method = received['method']
+        matches, match_set = matcher.match(
+            texts=[received['source']['object_id'], received['target']['object_id']],
+            unit_type=[received['source']['units'], received['target']['units']],
+            feature=received_method['feature'],
+            stopwords_list=received_method['stopwords'],
+            frequency_basis=received_method['freq_basis'],
+            max_distance=received_method['max_distance'],
+            distance_metric=received_method['distance_basis']
+        )
+        tv5api.metrics.SEARCH_STAGE_SECONDS.observe(
+            time.monotonic() - started, 'matching')
+        if not tv5api.jobs.record_status(database, results_id,
+                tv5api.jobs.RUNNING, only_if=(tv5api.jobs.RUNNING,),
+                stage='storing', percent=90, match_count=len(matches),
+                match_set_id=match_set.id):
+            # cancelled while matching; the match set was not recorded on
+            # the status, so it is discarded here
+            database[tesserae.db.entities.Match.collection].delete_many(
+                {'match_set': match_set.id})
+            database[tesserae.db.entities.MatchSet.collection].delete_one(
+                {'_id': match_set.id})
+            _release_followers(connection, job, tv5api.jobs.CANCELLED,
+                    'Cancelled by request')
+            return
+        results_pair = tesserae.db.entities.ResultsPair(
+                match_set_id=match_set.id, results_id=results_id)
+        connection.insert(results_pair)
+    except MemoryError:
+        _cancel_search(connection, job, 'Search exceeded its memory limit')
+        return
+    except Exception as e:
+        _fail_search(connection, job, str(e))
+        raise
+    if not tv5api.jobs.record_status(database, results_id,
+            tv5api.jobs.DONE, only_if=(tv5api.jobs.RUNNING,),
+            stage='done', percent=100):
+        _cancel_search(connection, job, 'Cancelled by request')
+        return
+    outcome = {'match_set_id': match_set.id, 'match_count': len(matches)}
+    tv5api.jobs.land_flight(database, search_hash, results_id, **outcome)
+    for follower in tv5api.jobs.find_followers(database, results_id):
+        _link_results(connection, follower, outcome)
+
+
+def run_search_in_process(config, job):
+    """Run a queued search in a fresh process
+
+    Parameters
+    ----------
+    config : dict
+        application configuration, for connecting to the database
+    job : dict
+        search job, as queued by _queue_search
+    """
+    run_search(tv5api.create_connection(config), job)
+
+
+def supervise_search(connection, runner, job):
+    """Run a queued search through `runner`
+
+    The search is stopped as soon as it is cancelled or runs over the
+    runner's time limit.  Outcomes the search cannot record itself, such as
+    being stopped or its process dying, are recorded here.
+
+    Parameters
+    ----------
+    connection : tesserae.db.TessMongoConnection
+    runner : tv5api.jobs.ProcessRunner
+    job : dict
+        search job, as queued by _queue_search
+    """
+    if _is_cancelled(connection, job['results_id']):
+        return
+    try:
+        runner(job, should_stop=functools.partial(
+            _is_cancelled, connection, job['results_id']))
+    except tv5api.jobs.JobCancelled:
+        _cancel_search(connection, job, 'Cancelled by request')
+    except tv5api.jobs.JobTimeout as e:
+        _cancel_search(connection, job, str(e))
+    except ChildProcessError as e:
+        _fail_search(connection, job, str(e))
+        raise
+
+
+def _corpus_version(database):
+    """Version of the texts, which changes as texts are added or removed
+
+    Searches with frequencies based on the corpus score differently once
+    any text of the language comes or goes, so they are only identical
+    under the same version.
+    """
+    return tv5api.cache.current_version(database, 'texts')
+
+
 def _queue_search(results_id, connection, received):
-    """Queue up search for processing"""
-    matcher = AggregationMatcher(connection)
-    received_method = received['method']
-    matches, match_set = matcher.match(
-        texts=[received['source']['object_id'], received['target']['object_id']],
-        unit_type=[received['source']['units'], received['target']['units']],
-        feature=received_method['feature'],
-        stopwords_list=received_method['stopwords'],
-        frequency_basis=received_method['freq_basis'],
-        max_distance=received_method['max_distance'],
-        distance_metric=received_method['distance_basis']
-    )
-    results_pair = tesserae.db.entities.ResultsPair(match_set_id=match_set.id,
-            results_id=results_id)
-    connection.insert(results_pair)
+    """Queue up search for processing
+
+    If an identical search has already finished, its results are reused; if
+    one is queued or running, this search waits for it instead of running
+    again.
+
+    Raises
+    ------
+    tv5api.jobs.QueueFull
+        if the search would have to run but too many searches are waiting
+    """
+    database = connection.connection
+    search_hash = _hash_search(received, _corpus_version(database))
+    # recorded ahead of claiming the flight, since a flight whose leader has
+    # no status is taken for abandoned
+    tv5api.jobs.record_status(database, results_id,
+            tv5api.jobs.QUEUED, stage='queued', percent=0,
+            search_hash=search_hash,
+            texts=[received['source']['object_id'],
+                received['target']['object_id']])
+    flight = tv5api.jobs.claim_flight(database, search_hash, results_id,
+            lease=flask.current_app.config['SEARCH_LEASE_SECONDS'])
+    if flight is None:
+        job = {
+            'results_id': results_id,
+            'received': received,
+            'search_hash': search_hash,
+        }
+        try:
+            flask.g.search_queue.submit(job)
+        except tv5api.jobs.QueueFull:
+            # identical searches may already be waiting on this one
+            _release_followers(connection, job, tv5api.jobs.FAILED,
+                    'too many searches are waiting; please resubmit.')
+            tv5api.jobs.discard_status(database, results_id)
+            raise
+        return
+
+    tv5api.jobs.record_status(database, results_id,
+            tv5api.jobs.QUEUED, only_if=(tv5api.jobs.QUEUED,),
+            leader=flight['results_id'])
+    # the leader may have finished before it could see this follower
+    flight = tv5api.jobs.get_flight(database, search_hash)
+    if flight is None:
+        _fail_follower(connection, results_id,
+                'Identical search failed; please resubmit.')
+    elif flight['state'] == tv5api.jobs.DONE:
+        _link_results(connection, results_id, flight)
+
+
+def keep_flights(connection, jobs, lease=60):
+    """Renew the flights of searches held by a worker, and sweep up others
+
+    Meant as the heartbeat of the search queue, so that flights stay held
+    for as long as their searches wait or run in a live worker, and flights
+    whose workers died are cleaned up; see tv5api.jobs.claim_flight.
+
+    Parameters
+    ----------
+    connection : tesserae.db.TessMongoConnection
+    jobs : list of dict
+        search jobs, as queued by _queue_search, not yet finished
+    lease : float
+        seconds to extend their leases by
+    """
+    database = connection.connection
+    tv5api.jobs.renew_flights(
+        database, [job['results_id'] for job in jobs], lease)
+    tv5api.jobs.sweep_flights(database)
 
 
 @bp.route('/', methods=('POST',))
@@ -84,12 +517,26 @@ def submit_search():
             data=received,
             message='The following errors were found in source and target unit specifications:\n{}'.format('\n\t'.join(errors)))
 
-    method_requireds = {
-        'original': {
-            'name', 'feature', 'stopwords', 'freq_basis', 'max_distance',
-            'distance_basis'
-        }
-    }
+    method_error = _method_error(received)
+    if method_error is not None:
+        return method_error
+
+    response = flask.Response()
+    response.status_code = 201
+    response.status = '201 Created'
+    results_id = uuid.uuid4().hex
+    # we want the final '/' on the URL
+    response.headers['Location'] = os.path.join(bp.url_prefix, results_id, '')
+
+    try:
+        _queue_search(results_id, flask.g.db, received)
+    except tv5api.jobs.QueueFull:
+        return _queue_full_error(received)
+    return response
+
+
+def _method_error(received):
+    """Build the error response for a bad method specification, if any"""
     method = received['method']
     if 'name' not in method:
         return tv5api.errors.error(
@@ -97,7 +544,7 @@ def submit_search():
             data=received,
             message='No specified method name.')
     missing = []
-    for req in method_requireds[method['name']]:
+    for req in _METHOD_REQUIREDS[method['name']]:
         if req not in method:
             missing.append(req)
     if missing:
@@ -105,49 +552,526 @@ def submit_search():
             400,
             data=received,
             message='The specified method is missing the following required key(s): {}'.format(', '.join(missing)))
+    return None
+
+
+def _queue_full_error(received):
+    response = tv5api.errors.error(
+        503,
+        data=received,
+        message='Too many searches are waiting to run; please try again later.')
+    response.headers['Retry-After'] = str(
+        flask.current_app.config['SEARCH_RETRY_AFTER'])
+    return response
+
+
+BATCHES_COLLECTION = 'search_batches'
+
+# text metadata that may be used to pick the targets of a batch search
+_TARGET_FILTERS = {'author', 'is_prose', 'language', 'title'}
+
+
+def _batch_targets(received):
+    """Work out the targets of a batch search
+
+    Returns
+    -------
+    targets : list of dict
+        unit specifications of the targets
+    errors : list of str
+        error messages corresponding to errors encountered
+    """
+    if 'targets' in received:
+        targets = received['targets']
+        if not isinstance(targets, list):
+            return [], ['"targets" must be a list.']
+        errors = []
+        for i, target in enumerate(targets):
+            errors.extend(_validate_units(target, 'targets[{}]'.format(i)))
+        return targets, errors
 
+    target_filter = dict(received['target_filter'])
+    units = target_filter.pop('units', None)
+    if units is None:
+        errors = ['target_filter is missing units.']
+    else:
+        errors = _validate_units(
+            {'object_id': None, 'units': units}, 'target_filter')
+    unknown = set(target_filter) - _TARGET_FILTERS
+    if unknown:
+        errors.append('target_filter has unrecognized key(s): {}'.format(
+            ', '.join(sorted(unknown))))
+    if errors:
+        return [], errors
+    found = flask.g.db.find(
+        tesserae.db.entities.Text.collection,
+        **target_filter)
+    return [
+        {'object_id': str(text.id), 'units': units}
+        for text in found
+        if str(text.id) != received['source']['object_id']
+    ], []
+
+
+@bp.route('/batch/', methods=('POST',))
+def submit_batch_search():
+    """Run a Tesserae search of one source against many targets
+
+    Targets are given either as a list of unit specifications under
+    "targets", or as text metadata to match under "target_filter", along
+    with the units to use for every matching text.  One search is queued per
+    target; they run in parallel as workers allow, and identical searches
+    are shared as usual.
+    """
+    received = flask.request.get_json()
+    missing = [req for req in ('source', 'method') if req not in received]
+    if 'targets' not in received and 'target_filter' not in received:
+        missing.append('targets (or target_filter)')
+    if missing:
+        return tv5api.errors.error(
+            400,
+            data=received,
+            message='The request data payload is missing the following required key(s): {}'.format(', '.join(missing)))
+
+    source = received['source']
+    errors = _validate_units(source, 'source')
+    if errors:
+        return tv5api.errors.error(
+            400,
+            data=received,
+            message='The following errors were found in source and target unit specifications:\n{}'.format('\n\t'.join(errors)))
+    method_error = _method_error(received)
+    if method_error is not None:
+        return method_error
+
+    # look the source up only once for the whole batch
+    try:
+        source_found = flask.g.db.find(
+            tesserae.db.entities.Text.collection,
+            _id=ObjectId(source['object_id']))
+    except InvalidId:
+        source_found = []
+    if not source_found:
+        return tv5api.errors.error(
+            400,
+            data=received,
+            message='No source text with the provided identifier ({}) was found in the database.'.format(source['object_id']))
+
+    targets, errors = _batch_targets(received)
+    if errors:
+        return tv5api.errors.error(
+            400,
+            data=received,
+            message='The following errors were found in source and target unit specifications:\n{}'.format('\n\t'.join(errors)))
+    if not targets:
+        return tv5api.errors.error(
+            400,
+            data=received,
+            message='No targets were specified or matched.')
+    if not flask.g.search_queue.has_room(len(targets)):
+        return _queue_full_error(received)
+
+    entries = []
+    for target in targets:
+        results_id = uuid.uuid4().hex
+        try:
+            _queue_search(results_id, flask.g.db, {
+                'source': source,
+                'target': target,
+                'method': received['method'],
+            })
+        except tv5api.jobs.QueueFull:
+            # other submissions filled the queue after the check above
+            results_id = None
+        entries.append({'target': target, 'results_id': results_id})
+
+    batch_id = uuid.uuid4().hex
+    flask.g.db.connection[BATCHES_COLLECTION].insert_one({
+        'batch_id': batch_id,
+        'source': source,
+        'method': received['method'],
+        'entries': entries,
+    })
     response = flask.Response()
     response.status_code = 201
     response.status = '201 Created'
-    results_id = uuid.uuid4().hex
-    # we want the final '/' on the URL
-    response.headers['Location'] = os.path.join(bp.url_prefix, results_id, '')
+    response.headers['Location'] = os.path.join(
+        bp.url_prefix, 'batch', batch_id, '')
+    return response
+
+
+@bp.route('/batch/<batch_id>/')
+def retrieve_batch(batch_id):
+    """Report on every search of a batch search"""
+    database = flask.g.db.connection
+    batch = database[BATCHES_COLLECTION].find_one({'batch_id': batch_id})
+    if batch is None:
+        return tv5api.errors.error(
+            404,
+            batch_id=batch_id,
+            message='No batch search with the provided identifier ({}) was found.'.format(batch_id))
+    results = []
+    counts = {}
+    for entry in batch['entries']:
+        result = {'target': entry['target'], 'results_id': entry['results_id']}
+        status = None
+        if entry['results_id'] is not None:
+            status = tv5api.jobs.get_status(database, entry['results_id'])
+        if entry['results_id'] is None:
+            result['state'] = 'refused'
+        elif status is None:
+            # searches involving a deleted text are removed along with it
+            result['state'] = 'removed'
+        else:
+            result.update(tv5api.jobs.describe_status(status))
+            result['location'] = flask.url_for(
+                'parallels.retrieve_results', results_id=entry['results_id'])
+        counts[result['state']] = counts.get(result['state'], 0) + 1
+        results.append(result)
+    return flask.jsonify(batch_id=batch_id, source=batch['source'],
+            counts=counts, results=results)
+
+
+def _page_options(args):
+    """Read filtering, sorting, and paging options from query arguments
+
+    Parameters
+    ----------
+    args : werkzeug.datastructures.MultiDict
+        query arguments of the request
+
+    Returns
+    -------
+    options : dict
+        keyword arguments for tv5api.results.get_matches
+    errors : list of str
+        error messages corresponding to errors encountered
+    """
+    options = {}
+    errors = []
+    for name, convert, minimum in (('offset', int, 0), ('limit', int, 1),
+            ('top_k', int, 1), ('min_score', float, None)):
+        value = args.get(name, None)
+        if value is None:
+            continue
+        try:
+            options[name] = convert(value)
+        except ValueError:
+            errors.append('"{}" must be a number.'.format(name))
+            continue
+        if minimum is not None and options[name] < minimum:
+            errors.append('"{}" must be at least {}.'.format(name, minimum))
+    sort = args.get('sort', None)
+    if sort is not None:
+        if sort not in tv5api.results.SORTS:
+            errors.append('"sort" must be one of: {}'.format(
+                ', '.join(sorted(tv5api.results.SORTS))))
+        options['sort'] = sort
+    if 'top_k' in options:
+        if {'offset', 'limit', 'sort'} & set(options):
+            errors.append(
+                '"top_k" cannot be combined with "offset", "limit", or "sort".')
+        options['sort'] = '-score'
+        options['limit'] = options.pop('top_k')
+    return options, errors
+
+
+def _compress_stream(chunks, encoding):
+    """Compress chunks of bytes as they arrive"""
+    compressor = tv5api.encoding.compressor(
+        encoding, tv5api.encoding.level_for(encoding))
+    for chunk in chunks:
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+
+def _cache_key(match_set_id, args, encoding, mimetype, results_id=None):
+    """Name a variant of the results of a match set
+
+    Parameters
+    ----------
+    match_set_id : bson.objectid.ObjectId or str
+    args : werkzeug.datastructures.MultiDict
+        query arguments of the request
+    encoding : str
+        content encoding of the response
+    mimetype : str
+        media type of the response
+    results_id : str, optional
+        search whose results are asked for, if the response names it, as
+        pages linking to the next page do; identical searches share a match
+        set, but not such responses
+
+    Returns
+    -------
+    str
+        key beginning with the match set id, suitable as a file name and as
+        an entity tag
+    """
+    variant = json.dumps(
+        [sorted(args.items(multi=True)), encoding, mimetype, results_id])
+    return '{}-{}'.format(match_set_id,
+            hashlib.sha256(variant.encode()).hexdigest()[:32])
 
-    _queue_search(results_id, flask.g.db, received)
+
+def _results_response(body, etag, encoding, mimetype='application/json'):
+    response = flask.Response(
+        response=body,
+        mimetype=mimetype,
+    )
+    response.status_code = 200
+    response.status = '200 OK'
+    if encoding != tv5api.encoding.IDENTITY:
+        response.headers['Content-Encoding'] = encoding
+    response.vary.add('Accept-Encoding')
+    response.set_etag(etag)
     return response
 
 
+def _respond_if_unfinished(results_id):
+    """Build the response for a search that has not finished successfully
+
+    Returns None if the search finished, or if nothing is known about it.
+    """
+    status = tv5api.jobs.get_status(flask.g.db.connection, results_id)
+    if status is not None and status['state'] == tv5api.jobs.FAILED:
+        return tv5api.errors.error(
+            500,
+            results_id=results_id,
+            status=status['state'],
+            message='Search failed: {}'.format(status.get('message', '')))
+    if status is not None and status['state'] == tv5api.jobs.CANCELLED:
+        return tv5api.errors.error(
+            410,
+            results_id=results_id,
+            status=status['state'],
+            message='Search was cancelled: {}'.format(
+                status.get('message', '')))
+    if status is not None and status['state'] != tv5api.jobs.DONE:
+        response = flask.jsonify(results_id=results_id,
+                status=status['state'])
+        response.status_code = 202
+        return response
+    return None
+
+
+_STREAM_MIMETYPES = {
+    'json': 'application/json',
+    'ndjson': 'application/x-ndjson',
+}
+
+
 @bp.route('/<results_id>/')
 def retrieve_results(results_id):
+    """Retrieve results of the specified search
+
+    Query arguments "offset", "limit", "sort" ("score" or "-score"), and
+    "min_score" select a page of the parallels; "top_k" asks for the highest
+    scoring parallels only.  With "stream" set to "json" or "ndjson", the
+    parallels are sent as they are read from the database, either within the
+    usual JSON document or as newline-delimited JSON.
+
+    Clients that ask for MessagePack (application/msgpack) or Arrow
+    (application/vnd.apache.arrow.stream) in their Accept header get the
+    parallels in columns, streamed straight from the database; see
+    tv5api.results.stream_msgpack and tv5api.results.stream_arrow.
+    """
+    options, errors = _page_options(flask.request.args)
+    stream = flask.request.args.get('stream', None)
+    if stream is not None and stream not in _STREAM_MIMETYPES:
+        errors.append('"stream" must be one of: {}'.format(
+            ', '.join(sorted(_STREAM_MIMETYPES))))
+    if errors:
+        return tv5api.errors.error(
+            400,
+            results_id=results_id,
+            message='The following errors were found in the query arguments:\n{}'.format('\n\t'.join(errors)))
+
+    unfinished = _respond_if_unfinished(results_id)
+    if unfinished is not None:
+        return unfinished
+
     # get search results
-    found = flask.g.db.find(
-        tesserae.db.entities.ResultsPair.collection,
-        results_id=results_id
-    )
+    with tv5api.metrics.stage('find'):
+        found = flask.g.db.find(
+            tesserae.db.entities.ResultsPair.collection,
+            results_id=results_id
+        )
     if not found:
         response = flask.Response()
         response.status_code = 404
         return response
     params = found[0].parameters
+    match_set_id = found[0]['match_set_id']
 
-    found = flask.g.db.find(
-        tesserae.db.entities.MatchSet.collection,
-        _id=ObjectId(found[0]['match_set_id'])
-    )
+    # finished results never change, so each variant of the response is
+    # fully determined by the match set and the query arguments, and, for
+    # pages linking to the next, the search
+    encoding = tv5api.encoding.negotiate(flask.request.accept_encodings)
+    mimetype = flask.request.accept_mimetypes.best_match(
+        ['application/json'] + list(tv5api.results.BINARY_FORMATS),
+        default='application/json')
+    paged = 'limit' in options and 'top_k' not in flask.request.args
+    cache_key = _cache_key(match_set_id, flask.request.args, encoding,
+            mimetype, results_id=results_id if paged else None)
+    if flask.request.if_none_match.contains(cache_key):
+        response = flask.Response()
+        response.status_code = 304
+        response.set_etag(cache_key)
+        return response
+    if stream is None and mimetype == 'application/json':
+        cached = flask.g.results_cache.get(cache_key)
+        if cached is not None:
+            return _results_response(cached, cache_key, encoding)
+
+    with tv5api.metrics.stage('find'):
+        found = flask.g.db.find(
+            tesserae.db.entities.MatchSet.collection,
+            _id=ObjectId(match_set_id)
+        )
     if not found:
         response = flask.Response()
         response.status_code = 404
         return response
 
-    matches = flask.g.db.get_search_matches(found[0].id)
-    response = flask.Response(
-        response=gzip.compress(flask.json.dumps({
-            'data': params,
-            'parallels': matches
-        }).encode()),
-        mimetype='application/json',
+    if mimetype in tv5api.results.BINARY_FORMATS:
+        matches = tv5api.results.iter_matches(
+            flask.g.db, found[0].id, **options)
+        chunks = tv5api.results.BINARY_FORMATS[mimetype](params, matches)
+        return _results_response(
+            flask.stream_with_context(_compress_stream(chunks, encoding)),
+            cache_key, encoding, mimetype=mimetype)
+
+    if stream is not None:
+        matches = tv5api.results.iter_matches(
+            flask.g.db, found[0].id, **options)
+        if stream == 'ndjson':
+            chunks = tv5api.results.stream_ndjson(matches)
+        else:
+            chunks = tv5api.results.stream_json(params, matches)
+        chunks = (chunk.encode() for chunk in chunks)
+        return _results_response(
+            flask.stream_with_context(_compress_stream(chunks, encoding)),
+            cache_key, encoding, mimetype=_STREAM_MIMETYPES[stream])
+
+    with tv5api.metrics.stage('matches'):
+        matches = tv5api.results.get_matches(
+            flask.g.db, found[0].id, **options)
+    payload = {
+        'data': params,
+        'parallels': matches
+    }
+    if paged and len(matches) == options['limit']:
+        next_args = flask.request.args.to_dict()
+        next_args['offset'] = options.get('offset', 0) + len(matches)
+        payload['next'] = flask.url_for(
+            'parallels.retrieve_results', results_id=results_id, **next_args)
+    with tv5api.metrics.stage('serialize'):
+        body = flask.json.dumps(payload).encode()
+    with tv5api.metrics.stage('compress'):
+        body = tv5api.encoding.compress(body, encoding,
+                tv5api.encoding.level_for(encoding))
+    flask.g.results_cache.put(cache_key, body)
+    return _results_response(body, cache_key, encoding)
+
+
+_DELIMITERS = {
+    'csv': (',', 'text/csv'),
+    'tsv': ('\t', 'text/tab-separated-values'),
+}
+
+
+@bp.route('/<results_id>/export.<file_format>')
+def export_results(results_id, file_format):
+    """Download results of the specified search as a spreadsheet
+
+    "columns" picks which fields to include, as a comma-separated list;
+    "sort", "min_score", and "top_k" work as for retrieve_results.
+    """
+    if file_format not in _DELIMITERS:
+        return tv5api.errors.error(
+            404,
+            results_id=results_id,
+            message='Unrecognized export format: {}'.format(file_format))
+    options, errors = _page_options(flask.request.args)
+    columns = flask.request.args.get('columns', None)
+    if columns is None:
+        columns = tv5api.results.FIELDS
+    else:
+        columns = columns.split(',')
+        unknown = [c for c in columns if c not in tv5api.results.FIELDS]
+        if unknown:
+            errors.append('Unrecognized column(s): {}'.format(
+                ', '.join(unknown)))
+    if errors:
+        return tv5api.errors.error(
+            400,
+            results_id=results_id,
+            message='The following errors were found in the query arguments:\n{}'.format('\n\t'.join(errors)))
+
+    unfinished = _respond_if_unfinished(results_id)
+    if unfinished is not None:
+        return unfinished
+    found = flask.g.db.find(
+        tesserae.db.entities.ResultsPair.collection,
+        results_id=results_id
     )
-    response.status_code = 200
-    response.status = '200 OK'
-    response.headers['Content-Encoding'] = 'gzip'
+    if not found:
+        return tv5api.errors.error(
+            404,
+            results_id=results_id,
+            message='No results with the provided identifier ({}) were found.'.format(results_id))
+
+    delimiter, mimetype = _DELIMITERS[file_format]
+    encoding = tv5api.encoding.negotiate(flask.request.accept_encodings)
+    matches = tv5api.results.iter_matches(
+        flask.g.db, ObjectId(found[0]['match_set_id']), **options)
+    chunks = (
+        chunk.encode()
+        for chunk in tv5api.results.stream_delimited(
+            matches, columns, delimiter)
+    )
+    response = _results_response(
+        flask.stream_with_context(_compress_stream(chunks, encoding)),
+        _cache_key(found[0]['match_set_id'], flask.request.args, encoding,
+            mimetype),
+        encoding, mimetype=mimetype)
+    response.headers['Content-Disposition'] = \
+        'attachment; filename="{}.{}"'.format(results_id, file_format)
     return response
+
+
+@bp.route('/<results_id>/', methods=['DELETE'])
+def cancel_search(results_id):
+    """Cancel the specified search, if it is queued or running"""
+    database = flask.g.db.connection
+    status = tv5api.jobs.get_status(database, results_id, follow=False)
+    if status is None:
+        return tv5api.errors.error(
+            404,
+            results_id=results_id,
+            message='No search with the provided identifier ({}) was found.'.format(results_id))
+    if not _stop_search(flask.g.db, status, 'Cancelled by request'):
+        return tv5api.errors.error(
+            409,
+            results_id=results_id,
+            status=status['state'],
+            message='Only queued or running searches can be cancelled.')
+    response = flask.jsonify(tv5api.jobs.describe_status(
+        tv5api.jobs.get_status(database, results_id, follow=False)))
+    response.status_code = 202
+    return response
+
+
+@bp.route('/<results_id>/status/')
+def retrieve_status(results_id):
+    """Report how far along the specified search is"""
+    status = tv5api.jobs.get_status(flask.g.db.connection, results_id)
+    if status is None:
+        return tv5api.errors.error(
+            404,
+            results_id=results_id,
+            message='No search with the provided identifier ({}) was found.'.format(results_id))
+    return flask.jsonify(tv5api.jobs.describe_status(status))
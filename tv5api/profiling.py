@@ -0,0 +1,318 @@
+"""Profiling single requests on admin instances
+
+A request carrying an "X-Profile" header is run under a profiler: with
+"pstats", the deterministic cProfile, whose output pstats and tools like
+snakeviz read; with "collapsed", a sampler whose output is the collapsed
+stacks that flamegraph tools read.  Every database round trip the request
+makes is timed too, both by TessMongoConnection method and by MongoDB
+command.  The profile is stored in the database, and the response carries
+its location in an "X-Profile-Location" header.
+
+Only the work done before the response is returned is profiled, so the
+bodies of streamed responses are not.
+"""
+import collections
+import cProfile
+import datetime
+import marshal
+import os
+import pstats
+import sys
+import threading
+import time
+import uuid
+
+import flask
+import pymongo.monitoring
+
+import tv5api.errors
+
+PROFILES_COLLECTION = 'request_profiles'
+
+# request header asking for a profile, and the kinds of profile it may ask
+# for
+HEADER = 'X-Profile'
+KINDS = {
+    'pstats': 'application/octet-stream',
+    'collapsed': 'text/plain; charset=utf-8',
+}
+
+bp = flask.Blueprint('profiling', __name__, url_prefix='/profiles')
+
+# the Recorder of the request being profiled on this thread, if any
+_local = threading.local()
+
+
+class Recorder:
+    """Times of the database round trips of one request"""
+
+    def __init__(self):
+        # totals by TessMongoConnection method, and by command and collection
+        self.methods = collections.defaultdict(lambda: [0, 0.0])
+        self.commands = collections.defaultdict(lambda: [0, 0.0])
+        self._started = {}
+
+    def add_method(self, name, seconds):
+        self.methods[name][0] += 1
+        self.methods[name][1] += seconds
+
+    def command_started(self, request_id, key):
+        self._started[request_id] = (key, time.perf_counter())
+
+    def command_finished(self, request_id):
+        key, started = self._started.pop(request_id, (None, None))
+        if key is not None:
+            self.commands[key][0] += 1
+            self.commands[key][1] += time.perf_counter() - started
+
+    def breakdown(self):
+        """Summarize the round trips, in milliseconds"""
+        return {
+            'methods': [
+                {'method': name, 'calls': calls, 'ms': seconds * 1000}
+                for name, (calls, seconds) in sorted(
+                    self.methods.items(), key=lambda i: -i[1][1])
+            ],
+            'commands': [
+                {'command': command, 'collection': collection,
+                    'calls': calls, 'ms': seconds * 1000}
+                for (command, collection), (calls, seconds) in sorted(
+                    self.commands.items(), key=lambda i: -i[1][1])
+            ],
+        }
+
+
+class _CommandTimer(pymongo.monitoring.CommandListener):
+    """Time the MongoDB commands of requests being profiled
+
+    pymongo notifies listeners on the thread that issued the command, so
+    the thread's recorder, if any, is the one to notify.
+    """
+
+    def started(self, event):
+        recorder = getattr(_local, 'recorder', None)
+        if recorder is not None:
+            recorder.command_started(event.request_id, (
+                event.command_name,
+                str(event.command.get(event.command_name, ''))))
+
+    def succeeded(self, event):
+        recorder = getattr(_local, 'recorder', None)
+        if recorder is not None:
+            recorder.command_finished(event.request_id)
+
+    def failed(self, event):
+        self.succeeded(event)
+
+
+_command_timer = None
+
+
+def register_command_timer():
+    """Have MongoDB commands timed for profiled requests
+
+    Only clients created after this are affected.  Registering more than
+    once has no further effect.
+    """
+    global _command_timer
+    if _command_timer is None:
+        _command_timer = _CommandTimer()
+        pymongo.monitoring.register(_command_timer)
+
+
+class _TimedConnection:
+    """Stand-in for a TessMongoConnection that times its method calls"""
+
+    def __init__(self, connection, recorder):
+        self._connection = connection
+        self._recorder = recorder
+
+    def __getattr__(self, name):
+        attribute = getattr(self._connection, name)
+        if not callable(attribute):
+            return attribute
+
+        def timed(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return attribute(*args, **kwargs)
+            finally:
+                self._recorder.add_method(
+                    name, time.perf_counter() - started)
+        return timed
+
+
+def timed_connection(connection):
+    """Return `connection`, timing its method calls if profiling
+
+    Parameters
+    ----------
+    connection : tesserae.db.TessMongoConnection
+
+    Returns
+    -------
+    tesserae.db.TessMongoConnection or _TimedConnection
+        `connection` itself unless the current request is being profiled
+    """
+    recorder = getattr(_local, 'recorder', None)
+    if recorder is None:
+        return connection
+    return _TimedConnection(connection, recorder)
+
+
+class _Sampler:
+    """Sample the stack of one thread at regular intervals
+
+    Parameters
+    ----------
+    thread_id : int
+        identifier of the thread to sample
+    interval : float
+        seconds between samples
+    """
+
+    def __init__(self, thread_id, interval):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = collections.Counter()
+        self._stopping = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stopping.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stopping.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append('{} ({}:{})'.format(
+                    code.co_name, code.co_filename, code.co_firstlineno))
+                frame = frame.f_back
+            if stack:
+                self.stacks[';'.join(reversed(stack))] += 1
+
+    def collapsed(self):
+        """Render the samples as collapsed stacks, one per line"""
+        return ''.join(
+            '{} {}\n'.format(stack, count)
+            for stack, count in sorted(self.stacks.items()))
+
+
+def _top_functions(profiler, count=25):
+    """List the functions taking the most cumulative time"""
+    stats = pstats.Stats(profiler).stats
+    ranked = sorted(stats.items(), key=lambda i: -i[1][3])[:count]
+    return [
+        {
+            'function': '{} ({}:{})'.format(func, filename, line),
+            'calls': calls,
+            'own_ms': own * 1000,
+            'cumulative_ms': cumulative * 1000,
+        }
+        for (filename, line, func), (_, calls, own, cumulative, _)
+        in ranked
+    ]
+
+
+def start_profile():
+    """Start profiling the current request if asked to; a before_request hook
+
+    Must run before g.db is set, so that timed_connection knows to time it.
+    """
+    # a request that failed before finish_profile could leave its recorder
+    _local.recorder = None
+    kind = flask.request.headers.get(HEADER, None)
+    if kind not in KINDS:
+        return
+    recorder = Recorder()
+    _local.recorder = recorder
+    if kind == 'pstats':
+        profiler = cProfile.Profile()
+        profiler.enable()
+    else:
+        profiler = _Sampler(threading.get_ident(),
+                flask.current_app.config['PROFILE_SAMPLE_INTERVAL'])
+        profiler.start()
+    flask.g.profile = (kind, profiler, recorder, time.perf_counter())
+
+
+def finish_profile(response):
+    """Stop profiling the current request and store the profile
+
+    An after_request hook.
+    """
+    profile = flask.g.pop('profile', None)
+    if profile is None:
+        return response
+    kind, profiler, recorder, started = profile
+    elapsed = time.perf_counter() - started
+    if kind == 'pstats':
+        profiler.disable()
+        profiler.create_stats()
+        data = marshal.dumps(profiler.stats)
+        top = _top_functions(profiler)
+    else:
+        profiler.stop()
+        data = profiler.collapsed().encode('utf-8')
+        top = None
+    _local.recorder = None
+    profile_id = uuid.uuid4().hex
+    flask.g.db.connection[PROFILES_COLLECTION].insert_one({
+        'profile_id': profile_id,
+        'created': datetime.datetime.utcnow(),
+        'kind': kind,
+        'method': flask.request.method,
+        'path': flask.request.full_path,
+        'endpoint': flask.request.endpoint,
+        'status': response.status_code,
+        'ms': elapsed * 1000,
+        'database': recorder.breakdown(),
+        'top_functions': top,
+        'data': data,
+    })
+    response.headers['X-Profile-Location'] = flask.url_for(
+        'profiling.get_profile', profile_id=profile_id)
+    return response
+
+
+def _find_profile(profile_id, projection=None):
+    return flask.g.db.connection[PROFILES_COLLECTION].find_one(
+        {'profile_id': profile_id}, projection)
+
+
+def _missing_profile(profile_id):
+    return tv5api.errors.error(
+        404,
+        profile_id=profile_id,
+        message='No profile with the provided identifier ({}) was found.'.format(profile_id))
+
+
+if os.environ.get('ADMIN_INSTANCE') == 'true':
+    @bp.route('/<profile_id>/')
+    def get_profile(profile_id):
+        """Report what a profile found, short of the profile itself"""
+        profile = _find_profile(profile_id, {'_id': False, 'data': False})
+        if profile is None:
+            return _missing_profile(profile_id)
+        profile['download'] = flask.url_for(
+            'profiling.download_profile', profile_id=profile_id)
+        return flask.jsonify(profile)
+
+
+    @bp.route('/<profile_id>/download')
+    def download_profile(profile_id):
+        """Send the profile, for pstats or flamegraph tools to read"""
+        profile = _find_profile(profile_id, {'kind': True, 'data': True})
+        if profile is None:
+            return _missing_profile(profile_id)
+        response = flask.Response(
+            bytes(profile['data']), content_type=KINDS[profile['kind']])
+        response.headers['Content-Disposition'] = \
+            'attachment; filename="{}.{}"'.format(profile_id, profile['kind'])
+        return response
@@ -0,0 +1,317 @@
+"""Reading search results out of the database
+
+Matches are read through an aggregation pipeline so that filtering, sorting,
+and paging happen inside the database, and only the matches asked for are
+ever sent to the API.  Each match comes out of the pipeline as a flat dict:
+
+    source_tag : str
+        locus of the source unit
+    target_tag : str
+        locus of the target unit
+    source_snippet : str
+        text of the source unit
+    target_snippet : str
+        text of the target unit
+    matched_features : list of str
+        features the two units share
+    score : float
+        score assigned to the match
+"""
+import csv
+import io
+
+import flask
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import pyarrow
+    import pyarrow.ipc
+except ImportError:
+    pyarrow = None
+
+import tesserae.db.entities
+
+FIELDS = ['source_tag', 'target_tag', 'source_snippet', 'target_snippet',
+        'matched_features', 'score']
+
+# values accepted for the "sort" query parameter
+# ties are broken by _id in the direction of the score, so that the
+# (match_set, score, _id) index serves either order
+SORTS = {
+    'score': [('score', 1), ('_id', 1)],
+    '-score': [('score', -1), ('_id', -1)],
+}
+
+# order of pages taken without a sort, served by the (match_set, _id) index
+PAGE_ORDER = [('_id', 1)]
+
+
+def _unit_lookup(field):
+    return {
+        '$lookup': {
+            'from': tesserae.db.entities.Unit.collection,
+            'localField': field,
+            'foreignField': '_id',
+            'as': field,
+        }
+    }
+
+
+def match_pipeline(match_set_id, min_score=None, sort=None, offset=0,
+        limit=None):
+    """Build an aggregation pipeline over the matches of a match set
+
+    Parameters
+    ----------
+    match_set_id : bson.objectid.ObjectId
+        match set whose matches are wanted
+    min_score : float, optional
+        if given, leave out matches scoring below this
+    sort : str, optional
+        one of the keys of SORTS; if not given, matches come in storage
+        order, or by _id when paged with `offset` or `limit`
+    offset : int
+        number of matches to skip
+    limit : int, optional
+        if given, the most matches to return
+
+    Returns
+    -------
+    list of dict
+        pipeline to run against the Match collection
+    """
+    query = {'match_set': match_set_id}
+    if min_score is not None:
+        query['score'] = {'$gte': min_score}
+    pipeline = [{'$match': query}]
+    if sort is not None:
+        pipeline.append({'$sort': dict(SORTS[sort])})
+    elif offset or limit is not None:
+        # storage order may differ from one query to the next, so pages
+        # taken in it could skip or repeat matches
+        pipeline.append({'$sort': dict(PAGE_ORDER)})
+    if offset:
+        pipeline.append({'$skip': offset})
+    if limit is not None:
+        pipeline.append({'$limit': limit})
+    pipeline.extend([
+        {'$addFields': {
+            'source': {'$arrayElemAt': ['$units', 0]},
+            'target': {'$arrayElemAt': ['$units', 1]},
+        }},
+        _unit_lookup('source'),
+        _unit_lookup('target'),
+        {'$lookup': {
+            'from': tesserae.db.entities.Feature.collection,
+            'localField': 'tokens',
+            'foreignField': '_id',
+            'as': 'features',
+        }},
+        {'$unwind': {'path': '$source', 'preserveNullAndEmptyArrays': True}},
+        {'$unwind': {'path': '$target', 'preserveNullAndEmptyArrays': True}},
+        {'$project': {
+            '_id': False,
+            'source_tag': {'$ifNull': ['$source.tags', []]},
+            'target_tag': {'$ifNull': ['$target.tags', []]},
+            'source_snippet': {'$ifNull': ['$source.snippet', '']},
+            'target_snippet': {'$ifNull': ['$target.snippet', '']},
+            'matched_features': '$features.token',
+            'score': True,
+        }},
+    ])
+    return pipeline
+
+
+def _finish(match):
+    """Join each unit's tags into a single locus string"""
+    match['source_tag'] = ' '.join(str(t) for t in match['source_tag'])
+    match['target_tag'] = ' '.join(str(t) for t in match['target_tag'])
+    return match
+
+
+def iter_matches(connection, match_set_id, **kwargs):
+    """Iterate over matches of a match set as the database returns them
+
+    Parameters
+    ----------
+    connection : tesserae.db.TessMongoConnection
+    match_set_id : bson.objectid.ObjectId
+    **kwargs
+        filtering, sorting, and paging options, as for match_pipeline
+
+    Yields
+    ------
+    dict
+        a match, in the form described in this module's docstring
+    """
+    cursor = connection.connection[
+        tesserae.db.entities.Match.collection].aggregate(
+            match_pipeline(match_set_id, **kwargs), allowDiskUse=True)
+    for match in cursor:
+        yield _finish(match)
+
+
+def get_matches(connection, match_set_id, **kwargs):
+    """Retrieve matches of a match set
+
+    Takes the same arguments as iter_matches.
+
+    Returns
+    -------
+    list of dict
+        matches, in the form described in this module's docstring
+    """
+    return list(iter_matches(connection, match_set_id, **kwargs))
+
+
+def stream_json(params, matches):
+    """Produce the JSON results document a piece at a time
+
+    Parameters
+    ----------
+    params
+        search parameters, reported under "data"
+    matches : iterable of dict
+        matches, reported under "parallels"
+
+    Yields
+    ------
+    str
+        consecutive pieces of the document
+    """
+    yield '{"data": ' + flask.json.dumps(params) + ', "parallels": ['
+    for i, match in enumerate(matches):
+        yield (', ' if i else '') + flask.json.dumps(match)
+    yield ']}'
+
+
+def stream_ndjson(matches):
+    """Produce newline-delimited JSON, one match per line"""
+    for match in matches:
+        yield flask.json.dumps(match) + '\n'
+
+
+def _batches(matches, batch_size):
+    """Gather matches into columns of at most `batch_size` rows"""
+    columns = {field: [] for field in FIELDS}
+    count = 0
+    for match in matches:
+        for field in FIELDS:
+            columns[field].append(match[field])
+        count += 1
+        if count == batch_size:
+            yield columns
+            columns = {field: [] for field in FIELDS}
+            count = 0
+    if count:
+        yield columns
+
+
+def stream_msgpack(params, matches, batch_size=10000):
+    """Produce results as a sequence of MessagePack objects
+
+    The first object is a map holding the search parameters under "data".
+    Each object after that is a map from field name to a column of values
+    for up to `batch_size` consecutive matches.
+
+    Parameters
+    ----------
+    params
+        search parameters
+    matches : iterable of dict
+        matches, in the form described in this module's docstring
+    batch_size : int
+        most matches per column batch
+
+    Yields
+    ------
+    bytes
+        consecutive MessagePack objects
+    """
+    packer = msgpack.Packer(default=str)
+    yield packer.pack({'data': params})
+    for columns in _batches(matches, batch_size):
+        yield packer.pack(columns)
+
+
+def _arrow_schema(params):
+    return pyarrow.schema([
+        ('source_tag', pyarrow.string()),
+        ('target_tag', pyarrow.string()),
+        ('source_snippet', pyarrow.string()),
+        ('target_snippet', pyarrow.string()),
+        ('matched_features', pyarrow.list_(pyarrow.string())),
+        ('score', pyarrow.float64()),
+    ], metadata={'data': flask.json.dumps(params)})
+
+
+def stream_arrow(params, matches, batch_size=10000):
+    """Produce results in the Arrow IPC streaming format
+
+    Each record batch holds up to `batch_size` consecutive matches; the
+    search parameters are stored as JSON under "data" in the schema metadata.
+    Takes the same arguments as stream_msgpack.
+
+    Yields
+    ------
+    bytes
+        consecutive pieces of the Arrow stream
+    """
+    schema = _arrow_schema(params)
+    sink = io.BytesIO()
+    writer = pyarrow.ipc.new_stream(sink, schema)
+    for columns in _batches(matches, batch_size):
+        writer.write_batch(
+            pyarrow.RecordBatch.from_pydict(columns, schema=schema))
+        yield sink.getvalue()
+        sink.seek(0)
+        sink.truncate()
+    writer.close()
+    yield sink.getvalue()
+
+
+def stream_delimited(matches, columns, delimiter=','):
+    """Produce delimiter-separated rows, one match per row
+
+    Parameters
+    ----------
+    matches : iterable of dict
+        matches, in the form described in this module's docstring
+    columns : list of str
+        fields to include, in order; the first row names them
+    delimiter : str
+        field separator, such as ',' for CSV or '\\t' for TSV
+
+    Yields
+    ------
+    str
+        one row of text at a time
+    """
+    buf = io.StringIO()
+    writer = csv.writer(buf, delimiter=delimiter, lineterminator='\n')
+
+    def _row(values):
+        writer.writerow(values)
+        row = buf.getvalue()
+        buf.seek(0)
+        buf.truncate()
+        return row
+
+    yield _row(columns)
+    for match in matches:
+        yield _row([
+            '; '.join(match[c]) if c == 'matched_features' else match[c]
+            for c in columns
+        ])
+
+
+# binary formats that can be produced, by MIME type
+BINARY_FORMATS = {}
+if msgpack is not None:
+    BINARY_FORMATS['application/msgpack'] = stream_msgpack
+if pyarrow is not None:
+    BINARY_FORMATS['application/vnd.apache.arrow.stream'] = stream_arrow
@@ -2,43 +2,137 @@
 import json
 import os
 
+from bson.objectid import ObjectId
+from bson.errors import InvalidId
 import flask
 
+import tv5api.cache
+import tv5api.connections
 import tv5api.errors
+import tv5api.frequencies
 import tesserae.db.entities
 
 bp = flask.Blueprint('stopwords', __name__, url_prefix='/stopwords')
 
 
+def _etag():
+    """Tag stopwords responses with the version of the stopwords cache"""
+    return 'stopwords-{}'.format(flask.g.stopwords_cache.version)
+
+
+def _max_age():
+    return flask.current_app.config['STOPWORDS_MAX_AGE']
+
+
 @bp.route('/')
+@tv5api.connections.read_only
 def query_stopwords():
-    """Build a stopwords list"""
-    # TODO
-    return flask.jsonify({})
+    """Build a stopwords list from the most frequent features"""
+    feature = flask.request.args.get('feature', 'lemmata')
+    language = flask.request.args.get('language', None)
+    works = flask.request.args.get('works', None)
+    errors = []
+    try:
+        list_size = int(flask.request.args.get('list_size', 10))
+    except ValueError:
+        errors.append('"list_size" must be a number.')
+    else:
+        if list_size < 1:
+            errors.append('"list_size" must be at least 1.')
+    text_ids = None
+    if works is not None:
+        if language is not None:
+            errors.append('"works" and "language" cannot be combined.')
+        try:
+            text_ids = sorted(
+                {ObjectId(w.strip()) for w in works.split(',') if w.strip()})
+        except InvalidId:
+            errors.append('"works" must be a comma-separated list of text identifiers.')
+        else:
+            if not text_ids:
+                errors.append('"works" must name at least one text.')
+    if errors:
+        return tv5api.errors.error(
+            400,
+            message='The following errors were found in the query arguments:\n{}'.format('\n\t'.join(errors)))
+
+    # the frequency tables change with the texts
+    etag = '{}-{}'.format(_etag(), flask.g.text_cache.version)
+    unchanged = tv5api.cache.not_modified(etag, _max_age())
+    if unchanged is not None:
+        return unchanged
+    if text_ids is not None:
+        missing = set(text_ids) - tv5api.frequencies.texts_with_tables(
+            flask.g.db, feature, text_ids)
+        if missing:
+            return tv5api.errors.error(
+                400,
+                works=works,
+                feature=feature,
+                message='No {} frequencies were found for the following text(s): {}'.format(feature, ', '.join(sorted(str(m) for m in missing))))
+    ranked = flask.g.stopwords_cache.lookup(
+        json.dumps([
+            'generated', feature, list_size,
+            [str(t) for t in text_ids] if text_ids is not None else None,
+            language, flask.g.text_cache.version]),
+        lambda: tv5api.frequencies.most_frequent(
+            flask.g.primary_db, feature, list_size, text_ids=text_ids,
+            language=language))
+    return tv5api.cache.cacheable(
+        flask.jsonify({
+            'stopwords': [token for token, _ in ranked],
+            'counts': [count for _, count in ranked],
+        }), etag, _max_age())
 
 
 @bp.route('/lists/')
+@tv5api.connections.read_only
 def query_stopwords_lists():
     """Report curated stopwords lists in database"""
-    found = flask.g.db.find(
-        tesserae.db.entities.StopwordsList.collection
-    )
-    return flask.jsonify({'list_names': [a.name for a in found]})
+    etag = _etag()
+    unchanged = tv5api.cache.not_modified(etag, _max_age())
+    if unchanged is not None:
+        return unchanged
+    list_names = flask.g.stopwords_cache.lookup(
+        json.dumps(['lists']),
+        lambda: [
+            a.name for a in flask.g.primary_db.find(
+                tesserae.db.entities.StopwordsList.collection)
+        ])
+    return tv5api.cache.cacheable(
+        flask.jsonify({'list_names': list_names}), etag, _max_age())
 
 
 @bp.route('/lists/<name>/')
+@tv5api.connections.read_only
 def get_stopwords_list(name):
     """Retrieve specified stopwords list"""
-    found = flask.g.db.find(
-        tesserae.db.entities.StopwordsList.collection,
-        name=name
-    )
-    if not found:
+    etag = _etag()
+    unchanged = tv5api.cache.not_modified(etag, _max_age())
+    if unchanged is not None:
+        return unchanged
+    stopwords = flask.g.stopwords_cache.lookup(
+        json.dumps(['list', name]),
+        lambda: _find_list(flask.g.primary_db, name))
+    if stopwords is None:
         return tv5api.errors.error(
             404,
             name=name,
             message='No list with the provided name ({}) was found in the database.'.format(name))
-    return flask.jsonify({'name': name, 'stopwords': found[0].stopwords})
+    return tv5api.cache.cacheable(
+        flask.jsonify({'name': name, 'stopwords': stopwords}), etag,
+        _max_age())
+
+
+def _find_list(connection, name):
+    """Look up the stopwords of a curated list, or None if there is none"""
+    found = connection.find(
+        tesserae.db.entities.StopwordsList.collection,
+        name=name
+    )
+    if not found:
+        return None
+    return found[0].stopwords
 
 
 if os.environ.get('ADMIN_INSTANCE') == 'true':
@@ -92,6 +186,7 @@ if os.environ.get('ADMIN_INSTANCE') == 'true':
                 data=data,
                 message='Unknown server error'
             )
+        flask.g.stopwords_cache.invalidate()
         response = flask.jsonify({'stopwords': data['stopwords']})
         response.status_code = 201
         response.headers['Content-Location'] = os.path.join(
@@ -111,6 +206,7 @@ if os.environ.get('ADMIN_INSTANCE') == 'true':
                 name=name,
                 message='No stopwords list matches the specified name ({}).'.format(name))
         result = flask.g.db.delete(found[0])
+        flask.g.stopwords_cache.invalidate()
         if result.deleted_count != 1:
             return tv5api.errors.error(
                 500,
@@ -1,4 +1,6 @@
 """The family of /texts/ endpoints"""
+import base64
+import binascii
 import json
 import os
 import urllib.parse
@@ -7,7 +9,12 @@ from bson.objectid import ObjectId
 from bson.errors import InvalidId
 import flask
 
+import tv5api.cache
+import tv5api.connections
+import tv5api.deletion
 import tv5api.errors
+import tv5api.frequencies
+import tv5api.ingestion
 import tesserae.db.entities
 import tesserae.utils
 
@@ -25,7 +32,21 @@ def fix_id(entity_json):
     return entity_json
 
 
+def _etag():
+    """Tag text metadata responses with the version of the text cache
+
+    Entity tags apply to a single URL, so the version alone tells whether
+    what a client holds is still current.
+    """
+    return 'texts-{}'.format(flask.g.text_cache.version)
+
+
+def _max_age():
+    return flask.current_app.config['TEXTS_MAX_AGE']
+
+
 @bp.route('/')
+@tv5api.connections.read_only
 def query_texts():
     """Consult database for text metadata"""
     alloweds = {'author', 'is_prose', 'language', 'title'}
@@ -47,30 +68,194 @@ def query_texts():
             message='If used, "before" and "after" must have integer values.')
 
     if before_val is not None and after_val is not None:
-        results = flask.g.db.find(
-            tesserae.db.entities.Text.collection,
-            year_not=(before_val, after_val),
-            **filters)
+        filters['year_not'] = (before_val, after_val)
     elif before_val is not None and after_val is None:
-        results = flask.g.db.find(
-            tesserae.db.entities.Text.collection,
-            # Assuming that lower limit pre-dates all texts in database
-            year=(-999999999999, before_val),
-            **filters)
+        # Assuming that lower limit pre-dates all texts in database
+        filters['year'] = (-999999999999, before_val)
     elif not before_val is None and after_val is not None:
-        results = flask.g.db.find(
-            tesserae.db.entities.Text.collection,
-            # Assuming that upper limit post-dates all texts in database
-            year=(after_val, 999999999999),
-            **filters)
-    else:
-        results = flask.g.db.find(
-            tesserae.db.entities.Text.collection,
-            **filters)
-    return flask.jsonify(texts=[fix_id(r.json_encode()) for r in results])
+        # Assuming that upper limit post-dates all texts in database
+        filters['year'] = (after_val, 999999999999)
+
+    options, errors = _listing_options(flask.request.args)
+    if errors:
+        return tv5api.errors.error(
+            400,
+            message='The following errors were found in the query arguments:\n{}'.format('\n\t'.join(errors)))
+
+    etag = _etag()
+    unchanged = tv5api.cache.not_modified(etag, _max_age())
+    if unchanged is not None:
+        return unchanged
+    cache_key = json.dumps(['query', filters, options], sort_keys=True)
+    texts = flask.g.text_cache.lookup(
+        cache_key,
+        lambda: _find_texts(flask.g.primary_db, filters, **options))
+    payload = {'texts': texts}
+    if 'limit' in options and len(texts) == options['limit']:
+        next_args = flask.request.args.to_dict()
+        next_args['cursor'] = _make_cursor(texts[-1], options.get('sort'))
+        payload['next'] = flask.url_for('texts.query_texts', **next_args)
+    return tv5api.cache.cacheable(flask.jsonify(payload), etag, _max_age())
+
+
+# values accepted for the "sort" query parameter
+SORTS = {'author', 'title', 'year'}
+
+
+def _listing_options(args):
+    """Read projection, sorting, and paging options from query arguments
+
+    Parameters
+    ----------
+    args : werkzeug.datastructures.MultiDict
+        query arguments of the request
+
+    Returns
+    -------
+    options : dict
+        keyword arguments for _find_texts
+    errors : list of str
+        error messages corresponding to errors encountered
+    """
+    options = {}
+    errors = []
+    limit = args.get('limit', None)
+    if limit is not None:
+        try:
+            options['limit'] = int(limit)
+        except ValueError:
+            errors.append('"limit" must be a number.')
+        else:
+            if options['limit'] < 1:
+                errors.append('"limit" must be at least 1.')
+    sort = args.get('sort', None)
+    if sort is not None:
+        if sort.lstrip('-') not in SORTS:
+            errors.append('"sort" must be one of: {}, optionally preceded by "-"'.format(
+                ', '.join(sorted(SORTS))))
+        options['sort'] = sort
+    fields = args.get('fields', None)
+    if fields is not None:
+        options['fields'] = sorted(
+            {f.strip() for f in fields.split(',') if f.strip()})
+        bad = [
+            f for f in options['fields']
+            if not f.isidentifier() or f in ('_id', 'id')
+        ]
+        if bad or not options['fields']:
+            errors.append('"fields" must be a comma-separated list of text field names.')
+        elif sort is not None and sort.lstrip('-') not in options['fields']:
+            # later pages are found from the sort value of the last text
+            options['fields'].append(sort.lstrip('-'))
+    cursor = args.get('cursor', None)
+    if cursor is not None:
+        if 'limit' not in options:
+            errors.append('"cursor" requires "limit".')
+        try:
+            options['cursor'] = _read_cursor(cursor)
+        except ValueError:
+            errors.append('"cursor" is malformed.')
+    return options, errors
+
+
+def _make_cursor(last_text, sort):
+    """Encode where a page of texts ended, to resume after it"""
+    position = [last_text['object_id']]
+    if sort is not None:
+        position.append(last_text.get(sort.lstrip('-')))
+    return base64.urlsafe_b64encode(
+        json.dumps(position).encode('utf-8')).decode('ascii')
+
+
+def _read_cursor(cursor):
+    """Decode a cursor made by _make_cursor"""
+    try:
+        position = json.loads(
+            base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8'))
+        if not isinstance(position, list) or len(position) not in (1, 2):
+            raise ValueError(cursor)
+        position[0] = str(ObjectId(position[0]))
+    except (TypeError, UnicodeError, binascii.Error, InvalidId) as e:
+        raise ValueError(cursor) from e
+    return position
+
+
+def _after(field, direction, value, last_id):
+    """Build a query for texts sorting after (value, last_id)"""
+    # nulls sort before every other value
+    if value is None:
+        tied = {field: None, '_id': {'$gt': last_id}}
+        if direction < 0:
+            return tied
+        return {'$or': [tied, {field: {'$ne': None}}]}
+    beyond = {field: {'$gt' if direction > 0 else '$lt': value}}
+    if direction < 0:
+        # lesser values include every type that sorts before this one
+        beyond = {'$or': [beyond, {field: None}]}
+    return {'$or': [beyond, {field: value, '_id': {'$gt': last_id}}]}
+
+
+def _find_texts(connection, filters, limit=None, sort=None, fields=None,
+        cursor=None):
+    """Look up and encode the texts a query asks for
+
+    Parameters
+    ----------
+    connection : tesserae.db.TessMongoConnection
+    filters : dict
+        filters, as taken by tesserae.db.TessMongoConnection.find
+    limit : int, optional
+        if given, the most texts to return
+    sort : str, optional
+        one of SORTS, preceded by "-" for descending order; texts come in
+        storage order, or by identifier if paging, if not given
+    fields : list of str, optional
+        if given, the only fields to report besides "object_id"
+    cursor : list, optional
+        as returned by _read_cursor; return only texts after this position
+
+    Returns
+    -------
+    list of dict
+        encoded texts
+    """
+    query = connection.create_filter(**filters)
+    order = []
+    if sort is not None:
+        order.append((sort.lstrip('-'), -1 if sort.startswith('-') else 1))
+    if sort is not None or limit is not None:
+        order.append(('_id', 1))
+    if cursor is not None:
+        last_id = ObjectId(cursor[0])
+        if sort is None:
+            after = {'_id': {'$gt': last_id}}
+        else:
+            after = _after(order[0][0], order[0][1],
+                    cursor[1] if len(cursor) > 1 else None, last_id)
+        query = {'$and': [query, after]}
+    projection = None
+    if fields is not None:
+        projection = {f: True for f in fields}
+    found = connection.connection[tesserae.db.entities.Text.collection].find(
+        query, projection)
+    if order:
+        found = found.sort(order)
+    if limit is not None:
+        found = found.limit(limit)
+    texts = []
+    for doc in found:
+        text = fix_id(tesserae.db.entities.Text.json_decode(doc).json_encode())
+        if fields is not None:
+            text = {
+                k: v for k, v in text.items()
+                if k == 'object_id' or k in fields
+            }
+        texts.append(text)
+    return texts
 
 
 @bp.route('/<object_id>/')
+@tv5api.connections.read_only
 def get_text(object_id):
     """Retrieve specific text's metadata"""
     try:
@@ -80,23 +265,65 @@ def get_text(object_id):
             400,
             object_id=object_id,
             message='Provided identifier ({}) is malformed.'.format(object_id))
-    found = flask.g.db.find(
+    # the tag is shared by every text, so it says nothing of whether this
+    # one exists
+    result = flask.g.text_cache.lookup(
+        json.dumps(['text', str(object_id_obj)]),
+        lambda: _find_text(flask.g.primary_db, object_id_obj))
+    if result is None:
+        return tv5api.errors.error(
+            404,
+            object_id=object_id,
+            message='No text with the provided identifier ({}) was found in the database.'.format(object_id))
+    etag = _etag()
+    unchanged = tv5api.cache.not_modified(etag, _max_age())
+    if unchanged is not None:
+        return unchanged
+    return tv5api.cache.cacheable(flask.jsonify(result), etag, _max_age())
+
+
+def _find_text(connection, object_id_obj):
+    """Look up and encode a text, or return None if it is not there"""
+    found = connection.find(
         tesserae.db.entities.Text.collection,
         _id=object_id_obj)
     if not found:
+        return None
+    return fix_id(found[0].json_encode())
+
+
+@bp.route('/<object_id>/frequencies/<feature>/')
+@tv5api.connections.read_only
+def get_text_frequencies(object_id, feature):
+    """Retrieve specific text's precomputed feature frequencies"""
+    try:
+        object_id_obj = ObjectId(object_id)
+    except:
+        return tv5api.errors.error(
+            400,
+            object_id=object_id,
+            message='Provided identifier ({}) is malformed.'.format(object_id))
+    table = tv5api.frequencies.get_table(
+        flask.g.db, feature, text_id=object_id_obj)
+    if table is None:
         return tv5api.errors.error(
             404,
             object_id=object_id,
-            message='No text with the provided identifier ({}) was found in the database.'.format(object_id))
-    result = fix_id(found[0].json_encode())
-    return flask.jsonify(result)
+            feature=feature,
+            message='No {} frequencies for the provided identifier ({}) were found in the database.'.format(feature, object_id))
+    return flask.jsonify(object_id=object_id, feature=feature,
+            counts=table['counts'], total=table['total'])
 
 
 if os.environ.get('ADMIN_INSTANCE') == 'true':
-    @bp.route('/', methods=['POST'])
-    def add_text():
-        received = flask.request.get_json()
-        # error checking on request data
+    def _check_text_record(received):
+        """Describe what is wrong with text metadata to ingest, if anything
+
+        Returns
+        -------
+        str or None
+            error message, or None if there is nothing wrong
+        """
         requireds = {'author', 'is_prose', 'language', 'path',
                 'title', 'year'}
         missing = []
@@ -104,30 +331,54 @@ if os.environ.get('ADMIN_INSTANCE') == 'true':
             if req not in received:
                 missing.append(req)
         if missing:
-            return tv5api.errors.error(
-                400,
-                data=received,
-                message='The request data payload is missing the following required key(s): {}'.format(', '.join(missing)))
+            return 'The request data payload is missing the following required key(s): {}'.format(', '.join(missing))
         prohibiteds = {'_id', 'id', 'object_id'}
         found = []
         for prohib in prohibiteds:
             if prohib in received:
                 found.append(prohib)
         if found:
+            return 'The request data payload contains the following prohibited key(s): {}'.format(', '.join(found))
+        return None
+
+
+    @bp.route('/', methods=['POST'])
+    def add_text():
+        received = flask.request.get_json()
+        # error checking on request data
+        problem = _check_text_record(received)
+        if problem is not None:
             return tv5api.errors.error(
                 400,
                 data=received,
-                message='The request data payload contains the following prohibited key(s): {}'.format(', '.join(found)))
+                message=problem)
 
+        insert_id = None
         try:
             # add text to database
             insert_id = tesserae.utils.ingest_text(
                 flask.g.db, tesserae.db.entities.Text(**received))
+            tv5api.frequencies.update_text_tables(
+                flask.g.db,
+                flask.g.db.find(
+                    tesserae.db.entities.Text.collection,
+                    _id=insert_id)[0])
         except Exception as e:
+            if insert_id is None:
+                return tv5api.errors.error(
+                    500,
+                    data=received,
+                    message='Could not add to database: {}'.format(e))
+            # the text is in the database, so resubmitting it would add it
+            # twice; it can be removed through its id instead
             return tv5api.errors.error(
                 500,
                 data=received,
-                message='Could not add to database: {}'.format(e))
+                object_id=str(insert_id),
+                message='Added to database, but could not finish: {}'.format(e))
+        finally:
+            # even a failed ingest may have left part of the text behind
+            flask.g.text_cache.invalidate()
 
         object_id = str(insert_id)
         received['object_id'] = object_id
@@ -143,6 +394,61 @@ if os.environ.get('ADMIN_INSTANCE') == 'true':
         return response
 
 
+    @bp.route('/batch/', methods=['POST'])
+    def add_texts():
+        """Ingest many texts in the background
+
+        The texts, each given as for POST /texts/, are listed under "texts".
+        They are ingested in parallel, as many at once as the ingest queue
+        has workers; their progress is reported at the Location returned.
+        """
+        received = flask.request.get_json()
+        records = received.get('texts', None) \
+            if isinstance(received, dict) else None
+        if not isinstance(records, list) or not records:
+            return tv5api.errors.error(
+                400,
+                data=received,
+                message='"texts" must be a non-empty list of text metadata.')
+        problems = []
+        for i, record in enumerate(records):
+            problem = _check_text_record(record) \
+                if isinstance(record, dict) else 'Not an object.'
+            if problem is not None:
+                problems.append('texts[{}]: {}'.format(i, problem))
+        if problems:
+            return tv5api.errors.error(
+                400,
+                data=received,
+                message='The following errors were found in the texts:\n{}'.format('\n\t'.join(problems)))
+
+        batch_id, jobs = tv5api.ingestion.create_batch(
+            flask.g.db.connection, records)
+        for job in jobs:
+            flask.g.ingest_queue.submit(job)
+
+        response = flask.jsonify(batch_id=batch_id)
+        response.status_code = 201
+        response.status = '201 Created'
+        response.headers['Location'] = os.path.join(
+            bp.url_prefix, 'batch', batch_id, '')
+        return response
+
+
+    @bp.route('/batch/<batch_id>/')
+    def get_ingest_batch(batch_id):
+        """Report on the progress of every text of a bulk ingest"""
+        batch = flask.g.db.connection[
+            tv5api.ingestion.INGESTS_COLLECTION].find_one(
+                {'batch_id': batch_id})
+        if batch is None:
+            return tv5api.errors.error(
+                404,
+                batch_id=batch_id,
+                message='No ingest batch with the provided identifier ({}) was found.'.format(batch_id))
+        return flask.jsonify(tv5api.ingestion.describe_batch(batch))
+
+
     @bp.route('/<object_id>/', methods=['PATCH'])
     def update_text(object_id):
         try:
@@ -184,6 +490,10 @@ if os.environ.get('ADMIN_INSTANCE') == 'true':
                 object_id=object_id,
                 data=received,
                 message='Unexpected number of updates: {}'.format(updated.matched_count))
+        flask.g.text_cache.invalidate()
+        if 'language' in received:
+            # the text now counts towards a different corpus
+            tv5api.frequencies.update_text_tables(flask.g.db, found)
         return get_text(object_id)
 
 
@@ -204,9 +514,35 @@ if os.environ.get('ADMIN_INSTANCE') == 'true':
                 404,
                 object_id=object_id,
                 message='No text with the provided identifier ({}) was found in the database.'.format(object_id))
-        # TODO check for proper deletion?
-        flask.g.db.delete(found).deleted_count
-        response = flask.Response()
-        response.status_code = 204
-        response.status = '204 No Content'
+        deleted = flask.g.db.delete(found).deleted_count
+        flask.g.text_cache.invalidate()
+        if deleted != 1:
+            return tv5api.errors.error(
+                500,
+                object_id=object_id,
+                message='Server error in deleting: deleted {} documents'.format(deleted))
+        # the text is gone as far as clients are concerned; what was derived
+        # from it is removed in the background
+        deletion_id, job = tv5api.deletion.create_deletion(
+            flask.g.db.connection, found[0])
+        flask.g.deletion_queue.submit(job)
+        response = flask.jsonify(deletion_id=deletion_id, object_id=object_id)
+        response.status_code = 202
+        response.status = '202 Accepted'
+        response.headers['Location'] = os.path.join(
+            bp.url_prefix, 'deletions', deletion_id, '')
         return response
+
+
+    @bp.route('/deletions/<deletion_id>/')
+    def get_deletion(deletion_id):
+        """Report on the removal of a deleted text's derived data"""
+        record = flask.g.db.connection[
+            tv5api.deletion.DELETIONS_COLLECTION].find_one(
+                {'deletion_id': deletion_id})
+        if record is None:
+            return tv5api.errors.error(
+                404,
+                deletion_id=deletion_id,
+                message='No deletion with the provided identifier ({}) was found.'.format(deletion_id))
+        return flask.jsonify(tv5api.deletion.describe_deletion(record))